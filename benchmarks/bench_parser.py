@@ -0,0 +1,129 @@
+"""
+Times the parser and loader on synthetic uHTR data, run from the top folder of the repo:
+
+    python -m benchmarks.bench_parser --events 1e5 1e6 1e7
+
+Every benchmark runs in a fresh process, so the peak RSS (resident memory) it reports belongs to that benchmark alone.
+The rate is given in parsed events, ie. (ADC, TDC) pairs, per second. load_uHTR_data reads the files of both uHTRs,
+so its count covers both of them (before clean_data() removes any).
+"""
+
+import argparse
+import io
+import os
+import resource
+import shutil
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from multiprocessing import get_context
+
+BENCHMARKS = ["parse_text_file", "txt_to_bin", "parse_bin_file", "load_uHTR_data"]
+
+def peak_rss_mb():
+    """
+    Largest resident memory used so far by this process or any of its (finished) child processes, in MB
+    """
+    peak_kb = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return peak_kb / 1024
+
+def run_benchmark(name, folder, repeat):
+    """
+    Runs a single benchmark on the files in folder (uHTR4_0.txt/uHTR11_0.txt, see prepare_folder()) repeat times.
+    Returns the best time, the number of parsed events and the peak RSS
+    """
+    import tools.parser as parser
+
+    text_file = os.path.join(folder, "uHTR4_0.txt")
+    bin_file = os.path.join(folder, "uHTR4_0.uhtr")
+
+    def parse_text_file():
+        return len(parser.parse_text_file(text_file)[0])
+
+    def txt_to_bin():
+        if os.path.exists(bin_file): # Otherwise only the new part of the text file is converted
+            os.remove(bin_file)
+        return len(parser.txt_to_bin(text_file)[0])
+
+    def parse_bin_file():
+        return len(parser.parse_bin_file(bin_file)[0])
+
+    def load_uHTR_data():
+        import tools.plotting # Has to be imported before analysis_helpers
+        import tools.analysis_helpers as analysis_helpers
+
+        analysis_helpers.DATA_FOLDER = os.path.dirname(folder)
+        analysis_helpers.load_uHTR_data(os.path.basename(folder))
+
+        num_parsed = 0 # Events read from both files, the analysers only hold what's left after clean_data()
+        for uHTR in ["4", "11"]:
+            with open(os.path.join(folder, f"uHTR{uHTR}_0.uhtr"), "rb") as fp:
+                num_parsed += parser.read_bin_header(fp).array_len
+        return num_parsed
+
+    benchmark = {"parse_text_file": parse_text_file, "txt_to_bin": txt_to_bin,
+                 "parse_bin_file": parse_bin_file, "load_uHTR_data": load_uHTR_data}[name]
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        with redirect_stdout(io.StringIO()): # Keep the parser's warnings out of the results
+            num_events = benchmark()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best, num_events, peak_rss_mb()
+
+def prepare_folder(root, num_events, seed):
+    """
+    Writes the text and .uhtr files of both uHTRs for a benchmark size into their own data folder
+    """
+    import tools.parser as parser
+    from benchmarks.generate import write_uHTR_file
+
+    folder = os.path.join(root, f"bench_{num_events}")
+    os.makedirs(folder, exist_ok=True)
+    for i, uHTR in enumerate(["4", "11"]):
+        text_file = os.path.join(folder, f"uHTR{uHTR}_0.txt")
+        write_uHTR_file(text_file, num_events, seed=seed + i)
+        with redirect_stdout(io.StringIO()):
+            parser.txt_to_bin(text_file)
+    return folder
+
+def in_fresh_process(function, *args):
+    """
+    Calls function in a newly spawned process. Peak RSS can't be reset within a process, and a spawned process
+    starts out with the peak RSS of its parent, so this process has to stay small and leave all the work to others
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(function, *args).result()
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Times the uHTR parser and loader on synthetic data")
+    arg_parser.add_argument("--events", nargs="+", type=float, default=[1e5, 1e6, 1e7],
+                            help="Number of events (event headers) of every generated file")
+    arg_parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    arg_parser.add_argument("--repeat", type=int, default=3, help="Number of runs, the best one is reported")
+    arg_parser.add_argument("--seed", type=int, default=0)
+    arg_parser.add_argument("--dir", default=None, help="Where to write the generated data (a temporary folder by default)")
+    args = arg_parser.parse_args()
+
+    root = args.dir or tempfile.mkdtemp(prefix="uhtr_bench_")
+    os.makedirs(root, exist_ok=True)
+
+    print(f"{'benchmark':<16} {'events':>10} {'parsed':>10} {'time [s]':>10} {'events/s':>12} {'peak RSS [MB]':>14}")
+    try:
+        for num_events in args.events:
+            folder = in_fresh_process(prepare_folder, root, int(num_events), args.seed)
+
+            for name in args.benchmarks:
+                elapsed, parsed, peak_rss = in_fresh_process(run_benchmark, name, folder, args.repeat)
+
+                print(f"{name:<16} {int(num_events):>10} {parsed:>10} {elapsed:>10.3f} {parsed / elapsed:>12.3e} {peak_rss:>14.1f}")
+    finally:
+        if args.dir is None:
+            shutil.rmtree(root, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
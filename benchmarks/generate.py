@@ -0,0 +1,163 @@
+"""
+Generator for synthetic uHTR.txt files, written in the exact format the uHTR self trigger tool dumps:
+
+---------------------------------------------------------------------------
+--- START EVENT: 0, BX: 932, ORBIT: 4294002512, RUN: 367000
+---------------------------------------------------------------------------
+ 3 1 2 1 0 3 151 64 2 1 0 0 1 3 0 2 1 0 1 2 0 1
+33
+ 6 2 1 0 2 118 40 3 0 1 2 0 0 1 0 2 1 3 0 0 1 2
+28 62
+
+Every event header is followed by one or more (ADC line, TDC line) pairs. ADC lines hold the fibre and
+cable of the channel followed by 20 amplitudes, TDC lines hold the tdc value and an optional 62 flag (tdc_2).
+An empty TDC line means the TDC didn't trigger, and the pair gets dropped by the parser.
+"""
+
+import numpy as np
+import tools.hw_info as hw_info
+
+DASHES = "-" * 75
+
+# Literal text written in front of every value, the value (if there is one) comes right after it
+LITERALS = [b"",
+            f"{DASHES}\n--- START EVENT: ".encode(),
+            b", BX: ",
+            b", ORBIT: ",
+            b", RUN: ",
+            f"\n{DASHES}\n".encode(),
+            b" ",
+            b"\n"]
+NONE, EVENT, BX, ORBIT, RUN, HEADER_END, SPACE, NEWLINE = range(len(LITERALS))
+
+NUM_BX = 3564 # Number of bunch crossings in an orbit
+
+BATCH_EVENTS = 1 << 16 # Number of events formatted at once
+
+def uHTR_channels():
+    """
+    Every channel (fibre*10 + cable) that is hooked up to a detector on either uHTR
+    """
+    return sorted(set(hw_info.get_uHTR4_CMAP().values()) | set(hw_info.get_uHTR11_CMAP().values()))
+
+def format_pieces(literal, value):
+    """
+    Vectorized text formatting. Every piece is a literal (index into LITERALS) followed by an unsigned
+    integer value, value = -1 writes only the literal.
+    Returns the formatted bytes of all pieces back to back
+    """
+    literals = [np.frombuffer(text, dtype=np.uint8) for text in LITERALS]
+    literal_len = np.array([len(text) for text in LITERALS])[literal]
+
+    has_value = value >= 0
+    powers = 10 ** np.arange(1, 19, dtype=np.int64)
+    digits = np.where(has_value, np.searchsorted(powers, value, side="right") + 1, 0)
+
+    starts = np.concatenate(([0], np.cumsum(literal_len + digits)))
+    buf = np.empty(starts[-1], dtype=np.uint8)
+
+    for i, text in enumerate(literals):
+        if len(text) == 0:
+            continue
+        where = starts[:-1][literal == i]
+        buf[where[:, None] + np.arange(len(text))] = text
+
+    # Write the last digit of every value first, then keep going with the values that still have digits left
+    position = starts[1:][has_value] - 1
+    remaining = value[has_value]
+    while len(remaining) > 0:
+        buf[position] = ord("0") + remaining % 10
+        remaining //= 10
+        left = remaining > 0
+        position, remaining = position[left] - 1, remaining[left]
+
+    return buf.tobytes()
+
+def generate_events(rng, first_evt, num_events, orbit, first_run, channels, max_pairs, tdc2_fraction, untriggered_fraction, run_length):
+    """
+    Formats num_events events starting at event number first_evt, orbit is the orbit of the event before them.
+    Returns the text, the number of triggered (ADC, TDC) pairs and the orbit of the last event
+    """
+    evt = np.arange(first_evt, first_evt + num_events, dtype=np.int64)
+
+    orbit_steps = rng.integers(1, 3000, num_events)
+    orbits = (orbit + np.cumsum(orbit_steps)) % 2**32 # Orbit counter is 32 bits and wraps around
+    runs = first_run + evt // run_length
+    bx = rng.integers(0, NUM_BX, num_events)
+
+    pairs = rng.integers(1, max_pairs + 1, num_events)
+    num_pairs = int(pairs.sum())
+
+    # Every event is 5 header pieces followed by 25 pieces per pair: fibre, cable, 20 amplitudes, tdc, tdc_2 and the newline
+    event_len = 5 + 25 * pairs
+    event_start = np.concatenate(([0], np.cumsum(event_len)[:-1]))
+    literal = np.zeros(int(event_len.sum()), dtype=np.int64)
+    value = np.full(len(literal), -1, dtype=np.int64)
+
+    literal[event_start[:, None] + np.arange(5)] = [EVENT, BX, ORBIT, RUN, HEADER_END]
+    value[event_start] = evt
+    value[event_start + 1] = bx
+    value[event_start + 2] = orbits
+    value[event_start + 3] = runs
+
+    pair_event = np.repeat(np.arange(num_events), pairs)
+    pair_num = np.arange(num_pairs) - np.repeat(np.concatenate(([0], np.cumsum(pairs)[:-1])), pairs)
+    pair_start = event_start[pair_event] + 5 + 25 * pair_num
+
+    channel = rng.choice(channels, num_pairs)
+    ampl = rng.integers(0, 4, (num_pairs, 20)) # Pedestal noise with a single pulse on top of it
+    peak = rng.integers(3, 7, num_pairs)
+    ampl[np.arange(num_pairs), peak] += rng.integers(10, 180, num_pairs)
+    ampl[np.arange(num_pairs), peak + 1] += rng.integers(0, 60, num_pairs)
+
+    tdc = rng.integers(0, 50, num_pairs)
+    untriggered = rng.random(num_pairs) < untriggered_fraction
+    tdc2 = (rng.random(num_pairs) < tdc2_fraction) & ~untriggered
+
+    literal[pair_start[:, None] + np.arange(22)] = SPACE
+    value[pair_start] = channel // 10
+    value[pair_start + 1] = channel % 10
+    value[pair_start[:, None] + np.arange(2, 22)] = ampl
+    literal[pair_start + 22] = NEWLINE
+    value[pair_start + 22] = np.where(untriggered, -1, tdc)
+    literal[pair_start + 23] = np.where(tdc2, SPACE, NONE)
+    value[pair_start + 23] = np.where(tdc2, 62, -1)
+    literal[pair_start + 24] = NEWLINE
+
+    return format_pieces(literal, value), num_pairs - int(untriggered.sum()), int(orbits[-1])
+
+def write_uHTR_file(file_name, num_events, seed=0, channels=None, max_pairs=3, tdc2_fraction=0.1, untriggered_fraction=0.1,
+                    run_length=100_000, first_run=367000, first_orbit=4_294_000_000, nul_bytes=0):
+    """
+    Writes a synthetic uHTR.txt file with num_events events (event headers, each of them with 1 to max_pairs ADC/TDC pairs).
+
+    channels are the (fibre*10 + cable) channel numbers hits are spread over, every detector channel by default.
+    tdc2_fraction of the TDC lines get a 62 flag and untriggered_fraction of them are left empty. Runs are run_length
+    events long and the orbit counter starts right before its 32 bit overflow. nul_bytes NUL (0x00) characters are
+    written over random bytes of the file, just like a corrupted dump.
+    Returns the number of (ADC, TDC) pairs the parser should find
+    """
+    rng = np.random.default_rng(seed)
+    if channels is None:
+        channels = uHTR_channels()
+    channels = np.asarray(channels)
+
+    num_hits = 0
+    orbit = first_orbit
+    with open(file_name, "wb") as fp:
+        for first_evt in range(0, num_events, BATCH_EVENTS):
+            batch = min(BATCH_EVENTS, num_events - first_evt)
+            text, hits, orbit = generate_events(rng, first_evt, batch, orbit, first_run, channels, max_pairs,
+                                                tdc2_fraction, untriggered_fraction, run_length)
+            fp.write(text)
+            num_hits += hits
+
+        size = fp.tell()
+
+    if nul_bytes > 0 and size > 0:
+        with open(file_name, "r+b") as fp:
+            for offset in rng.integers(0, size, nul_bytes):
+                fp.seek(offset)
+                fp.write(b"\x00")
+
+    return num_hits
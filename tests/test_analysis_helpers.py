@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+import tools.plotting # Has to be imported before analysis_helpers
+import tools.analysis_helpers as analysis_helpers
+from tools.analysis_helpers import ORBIT_WRAP
+
+NUM_EVENTS = 200
+
+def make_events(seed=0):
+    """
+    Arrays of NUM_EVENTS events in time order, the way a single file holds them. Run 367000 ends after event 120
+    and the 32 bit orbit counter overflows around event 60
+    """
+    rng = np.random.default_rng(seed)
+    return {
+        "evt"  : np.arange(NUM_EVENTS).astype(">u4"),
+        "ch"   : rng.integers(0, 8, (NUM_EVENTS, 2)).astype(np.uint8),
+        "bx"   : rng.integers(0, 3564, NUM_EVENTS).astype(">u2"),
+        "orbit": ((ORBIT_WRAP - 30_000 + np.cumsum(rng.integers(1, 1000, NUM_EVENTS))) % ORBIT_WRAP).astype(">u8"),
+        "run"  : np.repeat([367000, 367001], [120, NUM_EVENTS - 120]).astype(">u4"),
+    }
+
+def take(events, index):
+    return {name: array[index].copy() for name, array in events.items()}
+
+def merge(files):
+    """
+    Events of the files put together the way load_uHTR_data() does
+    """
+    pieces = analysis_helpers.plan_file_merge(files)
+    return {name: np.concatenate([files[i][name][index] for i, index in pieces]) for name in files[0]}
+
+def assert_same(a, b):
+    for name in a:
+        assert np.array_equal(a[name], b[name]), name
+
+@pytest.fixture
+def events():
+    return make_events()
+
+@pytest.mark.parametrize("order", [[0, 1, 2], [2, 1, 0], [1, 2, 0]])
+def test_split_files(events, order):
+    files = [take(events, slice(start, stop)) for start, stop in ((0, 50), (50, 130), (130, None))]
+    assert_same(merge([files[i] for i in order]), events)
+
+def test_overflow_between_files(events):
+    wrap = int(np.flatnonzero(np.diff(events["orbit"].astype(np.int64)) < 0)[0]) + 1
+    before, after = take(events, slice(None, wrap)), take(events, slice(wrap, None))
+    assert after["orbit"][0] < before["orbit"][-1]
+    assert_same(merge([after, before]), events)
+
+@pytest.mark.parametrize("reverse", [False, True])
+def test_overlapping_files(events, reverse):
+    files = [take(events, slice(None, 120)), take(events, slice(80, None))] # Events 80 to 119 are in both
+    assert_same(merge(files[::-1] if reverse else files), events)
+
+def test_interleaved_files(events):
+    odd = events["evt"] % 2 == 1
+    assert_same(merge([take(events, odd), take(events, ~odd)]), events)
+
+def test_only_identical_events_are_duplicates(events):
+    first, second = take(events, slice(None, 120)), take(events, slice(80, None))
+    second["ch"][100 - 80] += 1 # Same event number and orbit, but not the same event
+    merged = merge([first, second])
+
+    assert len(merged["evt"]) == NUM_EVENTS + 1
+    assert np.array_equal(merged["ch"][100:102], [events["ch"][100], events["ch"][100] + 1])
+
+def test_unordered_files_are_kept_as_they_are(events):
+    index = np.arange(120)
+    index[[10, 11]] = index[[11, 10]]
+    files = [take(events, slice(80, None)), take(events, index)]
+
+    assert analysis_helpers.plan_file_merge(files) == [(1, slice(None)), (0, slice(None))]
@@ -0,0 +1,215 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+import tools.plotting # Has to be imported before bhm
+import tools.calibration as calib
+import tools.commonVars as commonVars
+import tools.dt_conv as dt_conv
+from tools.bhm import ChannelGroups, HistogramCube, bhm_analyser
+
+@pytest.fixture
+def ch_mapped():
+    rng = np.random.default_rng(0)
+    return (rng.integers(0, 4, 5000) * 10 + rng.integers(0, 8, 5000)).astype(np.uint8)
+
+def test_channel_groups(ch_mapped):
+    groups = ChannelGroups(ch_mapped)
+
+    for ch in range(-1, 50):
+        assert np.array_equal(groups.get_indices(ch), np.flatnonzero(ch_mapped == ch))
+    for channels in ([], [7], [3, 17, 35, 200]):
+        assert np.array_equal(groups.get_mask(channels), np.isin(ch_mapped, channels))
+
+def test_channel_groups_empty():
+    groups = ChannelGroups(np.empty(0, dtype=np.uint8))
+    assert len(groups.get_indices(3)) == 0 and len(groups.get_mask([3])) == 0
+
+def make_events(seed, channels, num=20_000):
+    """
+    Random (ch_mapped, tdc, peak_ampl) events: a signal peak in tdc < 15 and peak_ampl 128 to 179 for every channel on top of
+    flat noise, with the signal of some channels cut off below an adc threshold like a hardware cut would
+    """
+    rng = np.random.default_rng(seed)
+    ch, tdc, adc = [rng.choice(channels, num)], [rng.integers(0, 50, num)], [rng.integers(0, 256, num)]
+    for ch_num in channels:
+        num_signal = rng.integers(0, 2000)
+        signal_tdc = np.clip(np.round(rng.normal(rng.integers(3, 12), 1.5, num_signal)), 0, 49)
+        signal_adc = np.clip(np.round(rng.normal(rng.integers(135, 170), rng.uniform(2, 10), num_signal)), 0, 255)
+        keep = signal_adc >= rng.choice([0, 140])
+        ch.append(np.full(np.count_nonzero(keep), ch_num))
+        tdc.append(signal_tdc[keep])
+        adc.append(signal_adc[keep])
+    return tuple(np.concatenate(values).astype(np.uint8) for values in (ch, tdc, adc))
+
+BINS = [
+    (np.arange(-0.5, 50, 1), np.arange(-0.5, 256, 1)),
+    (np.arange(-0.5, 15, 1), np.arange(128, 180, 1)),
+    (np.array([0, 10, 12.5, 49]), np.array([0, 64, 100, 128, 200, 255])), # Values right on edges, including the last one
+]
+
+@pytest.mark.parametrize("tdc_bins, adc_bins", BINS)
+def test_histogram_cube_2d(tdc_bins, adc_bins):
+    channels = [30, 31, 40, 41, 50]
+    ch_mapped, tdc, peak_ampl = make_events(0, channels + [7, 99])
+    cube = HistogramCube(ch_mapped, tdc, peak_ampl, channels)
+    rebinned = cube.rebin(tdc_bins, adc_bins)
+
+    for i, ch_num in enumerate(channels + [None]):
+        events = ch_mapped == ch_num if ch_num is not None else slice(None)
+        expected = np.histogram2d(tdc[events], peak_ampl[events], bins=(tdc_bins, adc_bins))[0]
+        assert np.array_equal(cube.histogram2d(cube.get_counts(ch_num), tdc_bins, adc_bins)[0], expected)
+        if ch_num is not None:
+            assert np.array_equal(rebinned[i], expected)
+
+    others = ~np.isin(ch_mapped, channels) # Last row of the cube
+    assert np.array_equal(rebinned[-1], np.histogram2d(tdc[others], peak_ampl[others], bins=(tdc_bins, adc_bins))[0])
+
+@pytest.mark.parametrize("tdc_bins, adc_bins", BINS)
+def test_histogram_cube_1d(tdc_bins, adc_bins):
+    ch_mapped, tdc, peak_ampl = make_events(1, [30, 31])
+    cube = HistogramCube(ch_mapped, tdc, peak_ampl, [30, 31])
+    counts = cube.get_counts(31)
+    events = ch_mapped == 31
+
+    assert np.array_equal(cube.histogram(cube.tdc_values, counts.sum(axis=1), tdc_bins)[0], np.histogram(tdc[events], tdc_bins)[0])
+    assert np.array_equal(cube.histogram(cube.adc_values, counts.sum(axis=0), adc_bins)[0], np.histogram(peak_ampl[events], adc_bins)[0])
+
+def test_histogram_cube_stats():
+    channels = [30, 31, 40, 41]
+    ch_mapped, tdc, peak_ampl = make_events(2, [30, 31])
+    ch_mapped, tdc, peak_ampl = np.append(ch_mapped, 40), np.append(tdc, 7), np.append(peak_ampl, 150) # 40 has a single event, 41 none
+    cube = HistogramCube(ch_mapped, tdc, peak_ampl, channels)
+
+    for values, axis, column in ((cube.tdc_values, 2, tdc), (cube.adc_values, 1, peak_ampl)):
+        mean, mode, std = HistogramCube.stats(values, cube.counts.sum(axis=axis))
+        for i, ch_num in enumerate(channels):
+            events = pd.Series(column[ch_mapped == ch_num])
+            expected_mode = events.mode()[0] if len(events) > 0 else np.nan
+            assert np.allclose([mean[i], mode[i], std[i]], [events.mean(), expected_mode, events.std()], equal_nan=True)
+
+def align_one_by_one(ch_mapped, tdc, peak_ampl, cmap):
+    """
+    The TDC peaks and ADC cuts the way auto_align_adc_tdc() used to find them, one channel at a time
+    """
+    tdc_peaks, adc_cuts = {}, {}
+    for ch, ch_num in cmap.items():
+        h = np.histogram2d(tdc[ch_mapped == ch_num], peak_ampl[ch_mapped == ch_num], bins=(np.arange(-0.5, 15, 1), np.arange(128, 180, 1)))[0]
+        max_index = list(h.flatten()).index(np.max(h))
+        tdc_peak, adc_peak = int(max_index / h.shape[1]), max_index % h.shape[1]
+        tdc_peaks[ch] = tdc_peak
+        adc_vals = h[tdc_peak]
+
+        area_ratio = 0
+        left_bound = right_bound = adc_peak
+        min_index = max(0, adc_peak - 15)
+        max_index = min(50, adc_peak + 16)
+        total_counts = sum(adc_vals[min_index:max_index])
+        while area_ratio < .68 and total_counts != 0:
+            if left_bound >= min_index:
+                left_bound -= 1
+            if right_bound < max_index:
+                right_bound += 1
+            area_ratio = sum(adc_vals[left_bound+1:right_bound]) / total_counts
+
+        if total_counts == 0:
+            adc_cuts[ch] = calib.ADC_CUTS_v2[ch]
+        else:
+            while adc_vals[left_bound+1] == 0:
+                left_bound += 1
+            adc_cuts[ch] = left_bound + 128
+    return tdc_peaks, adc_cuts
+
+@pytest.mark.parametrize("seed", range(4))
+def test_auto_align_adc_tdc(monkeypatch, seed):
+    uHTR = bhm_analyser("4")
+    channels = list(uHTR.CMAP.values())
+    uHTR.ch_mapped, uHTR.tdc, uHTR.peak_ampl = make_events(seed, channels[:-1]) # The last channel gets no events
+    monkeypatch.setattr(calib, "TDC_PEAKS", {}, raising=False)
+    monkeypatch.setattr(calib, "ADC_CUTS", {}, raising=False)
+
+    uHTR.auto_align_adc_tdc()
+    assert (calib.TDC_PEAKS, calib.ADC_CUTS) == align_one_by_one(uHTR.ch_mapped, uHTR.tdc, uHTR.peak_ampl, uHTR.CMAP)
+
+@pytest.fixture
+def regions(monkeypatch):
+    """
+    An analyser with random events tagged with their regions (see get_SR_BR_AR_CP()), and the regions every event
+    should be in, worked out one channel at a time
+    """
+    rng = np.random.default_rng(3)
+    uHTR = bhm_analyser("4")
+    monkeypatch.setattr(calib, "TDC_PEAKS", {ch: int(rng.integers(3, 12)) for ch in uHTR.CMAP}, raising=False)
+    monkeypatch.setattr(calib, "ADC_CUTS", {ch: int(rng.integers(100, 160)) for ch in uHTR.CMAP}, raising=False)
+
+    num = 20_000
+    uHTR.ch_mapped = rng.choice(list(uHTR.CMAP.values()) + [7], num).astype(np.uint8) # 7 isn't connected
+    uHTR.tdc = rng.integers(0, 50, num).astype(np.uint8)
+    uHTR.peak_ampl = rng.integers(0, 256, num).astype(np.uint8)
+    uHTR.tdc_2 = np.full(num, -1, dtype=np.int8)
+    uHTR.bx = rng.integers(0, 3564, num).astype(np.uint16)
+    uHTR.orbit = np.arange(num, dtype=np.int64)
+    uHTR.run = np.full(num, 367000, dtype=np.uint32)
+    uHTR.get_SR_BR_AR_CP()
+
+    expected = {name: np.zeros(num, dtype=bool) for name in ("SR", "BR", "CP", "AR")}
+    for ch, ch_num in uHTR.CMAP.items():
+        events = uHTR.ch_mapped == ch_num
+        sr = (uHTR.tdc >= calib.TDC_PEAKS[ch] - 1) & (uHTR.tdc <= calib.TDC_PEAKS[ch] + 1) & (uHTR.peak_ampl >= calib.ADC_CUTS[ch])
+        cp = (uHTR.tdc > 28) & (uHTR.tdc < 34) & (uHTR.peak_ampl > 80) & (uHTR.peak_ampl < 140)
+        expected["SR"] |= events & sr
+        expected["BR"] |= events & ~sr
+        expected["CP"] |= events & cp
+        expected["AR"] |= events & ~sr & ~cp
+    return uHTR, expected
+
+@pytest.mark.parametrize("region", ["SR", "BR", "CP", "AR", "SR & AR", "SR & CP"])
+def test_region_mask_and_query(regions, region):
+    uHTR, expected = regions
+    in_region = np.zeros(len(uHTR), dtype=bool)
+    for name in region.split(" & "):
+        in_region |= expected[name]
+
+    assert np.array_equal(uHTR.get_region_mask(region), in_region)
+    selected = uHTR.df.query(uHTR.get_region_query(region))
+    assert np.array_equal(selected.index, np.flatnonzero(in_region)) # Events in more than one of the regions only show up once
+    assert np.array_equal(uHTR.get_region(region).index, selected.index)
+
+def test_region_df(regions):
+    uHTR, _ = regions
+    assert np.all(uHTR.get_region_mask("df")) and uHTR.get_region("df") is uHTR.df
+
+def test_region_toolbar_query(regions):
+    uHTR, expected = regions
+    # The kind of cut the occupancy and channel event plots put together, see tkinter_tools.PlotToolbar._get_data_cut()
+    theCut = f"(orbit >= 100 & orbit <= 15000) & ((ch == 30) | (ch == 41)) & ({uHTR.get_region_query('SR & AR')})"
+    in_cut = (uHTR.orbit >= 100) & (uHTR.orbit <= 15000) & np.isin(uHTR.ch_mapped, [30, 41]) & (expected["SR"] | expected["AR"])
+
+    assert np.array_equal(uHTR.get_region("df").query(theCut).index, np.flatnonzero(in_cut))
+    assert np.array_equal(uHTR.get_region("SR").query(theCut).index, np.flatnonzero(in_cut & expected["SR"]))
+
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_time_window(regions, monkeypatch, shuffle):
+    uHTR, _ = regions
+    monkeypatch.setattr(commonVars, "start_time_utc_ms", 1_700_000_000_000)
+    monkeypatch.setattr(commonVars, "reference_orbit", 5000)
+    if shuffle: # Out of order, like corrupted data would be
+        uHTR.orbit = np.random.default_rng(4).permutation(uHTR.orbit)
+
+    for start, end in ((1_699_999_999_000, 1_700_000_000_400.5), (1_700_000_000_100, 1_700_000_000_100), (0, 1)):
+        # Same cut as the query the toolbars put together for the pandas plots
+        start_orbit = dt_conv.utc_ms_to_orbit(start, commonVars.start_time_utc_ms, commonVars.reference_orbit)
+        end_orbit = dt_conv.utc_ms_to_orbit(end, commonVars.start_time_utc_ms, commonVars.reference_orbit)
+        expected = (uHTR.orbit >= start_orbit) & (uHTR.orbit <= end_orbit)
+        assert np.array_equal(uHTR.get_time_window(start, end), expected)
+
+def test_run_column(regions):
+    uHTR, _ = regions
+    uHTR.run = np.repeat([367005, 367000, 367010], [5000, 5000, len(uHTR) - 10_000]).astype(np.uint32)
+    uHTR.convert2pandas()
+
+    assert np.array_equal(uHTR.df["run"].to_numpy(), uHTR.run)
+    assert uHTR.df["run"].array.codes.itemsize == 1
+    for query, expected in (("run == 367005", uHTR.run == 367005), ("run >= 367005", uHTR.run >= 367005),
+                            ("run in [367000, 367010]", uHTR.run != 367005), ("run == -1", np.zeros(len(uHTR), dtype=bool))):
+        assert np.array_equal(uHTR.df.query(query).index, np.flatnonzero(expected))
@@ -0,0 +1,298 @@
+import numpy as np
+import pytest
+
+import tools.parser as parser
+from benchmarks.generate import write_uHTR_file
+
+SEPERATOR = "-" * 75
+
+def event_text(evt, pairs, bx=100, orbit=4294002434, run=367000):
+    """
+    Text of a single event the way it shows up in a uHTR.txt file, pairs is a list of (ADC line, TDC line)
+    """
+    lines = [SEPERATOR, f"--- START EVENT: {evt}, BX: {bx}, ORBIT: {orbit}, RUN: {run}", SEPERATOR]
+    for adc, tdc in pairs:
+        lines += [adc, tdc]
+    return "\n".join(lines) + "\n"
+
+ADC = " 1 2 " + " ".join(str(i) for i in range(20)) # ch = (1, 2), ampl = 0..19
+
+@pytest.fixture
+def uHTR_file(tmp_path):
+    file_name = str(tmp_path / "uHTR4.txt")
+    num_pairs = write_uHTR_file(file_name, 2000, seed=1)
+    return file_name, num_pairs
+
+def test_parse_text_file(uHTR_file):
+    file_name, num_pairs = uHTR_file
+    evt, ch, ampl, tdc, tdc2, bx, orbit, run = parser.parse_text_file(file_name)
+
+    assert len(evt) == num_pairs
+    assert ch.shape == (num_pairs, 2) and ampl.shape == (num_pairs, 20)
+    assert evt.dtype == np.dtype(">u4") and orbit.dtype == np.dtype(">u8") and tdc2.dtype == np.int8
+    assert np.all(np.diff(evt.astype(np.int64)) >= 0)
+
+def test_same_as_line_by_line_parser(uHTR_file):
+    file_name, _ = uHTR_file
+    evt, ch, ampl, tdc, tdc2, bx, orbit, run = parser.parse_text_file(file_name)
+    for a, b in zip((ch, ampl, tdc, tdc2, bx, orbit, run), parser.parse_text_file_old(file_name)):
+        assert np.array_equal(a, b)
+
+CLEAN_TEXT = (event_text(1, [(ADC, "9 62"), (ADC, "17"), (ADC, "")])
+              + event_text(2, [(" 3 4 " + "0 " * 19 + "180", "5")], bx=3563, orbit=17, run=1))
+
+@pytest.mark.parametrize("old, new, clean", [
+    ("", "", True),
+    (" 1 2 0", " 1 2  0", True), # Extra spaces don't change the tokens
+    ("9 62", "9 062", True),
+    ("9 62", "9 0062", False), # Values with more than 3 digits
+    ("9 62", "9 62 7", False), # Too many TDC values
+    ("17", "256", False), # Out of range
+    (" 1 2 0", " 1 2 x0", False),
+    ("RUN: 1", "RUN:  1", False), # The header text has to match exactly
+    ("ORBIT: 17", "ORBIT: 1234567890123456", False),
+    ("\n", "\r\n", False),
+    ("\n" + SEPERATOR, "\n" + SEPERATOR + "-", False),
+    ("", ADC + "\n9\n", False), # Pairs before the first header
+])
+def test_clean_chunk(tmp_path, monkeypatch, capsys, old, new, clean):
+    text = (new + CLEAN_TEXT if old == "" else CLEAN_TEXT.replace(old, new)).encode()
+    file_name = str(tmp_path / "uHTR4.txt")
+    with open(file_name, "wb") as fp:
+        fp.write(text)
+
+    assert (parser.parse_clean_chunk(text) is not None) == clean
+    data = parser.parse_text_file(file_name)
+    output = capsys.readouterr().out
+
+    monkeypatch.setattr(parser, "parse_clean_chunk", lambda chunk, header=None: None) # Only the general path
+    for a, b in zip(data, parser.parse_text_file(file_name)):
+        assert a.dtype == b.dtype and np.array_equal(a, b)
+    assert capsys.readouterr().out == output
+
+@pytest.mark.parametrize("chunk_size", [100, 4096, 100_000])
+def test_chunk_size(uHTR_file, chunk_size):
+    file_name, _ = uHTR_file
+    for a, b in zip(parser.parse_text_file(file_name), parser.parse_text_file(file_name, chunk_size=chunk_size)):
+        assert a.dtype == b.dtype and np.array_equal(a, b)
+
+@pytest.mark.parametrize("adc", [" 5 1 2 3 oops", " 5 1 2", ""])
+def test_garbled_last_event(uHTR_file, capsys, adc):
+    file_name, num_pairs = uHTR_file
+    with open(file_name, "a") as fp:
+        fp.write(event_text(7, [(adc, "33")]))
+
+    evt = parser.parse_text_file(file_name)[0]
+
+    assert len(evt) == num_pairs
+    assert capsys.readouterr().out == f"Failed for evt:7  {adc}\n"
+
+def test_seperator_after_adc_line(tmp_path, capsys):
+    file_name = str(tmp_path / "uHTR4.txt")
+    with open(file_name, "w") as fp: # The seperator is read as the TDC line of the last ADC line
+        fp.write(event_text(1, [(ADC, "9 62"), (ADC, SEPERATOR)]) + event_text(2, [(ADC, "10")]))
+
+    evt, ch, ampl, tdc, tdc2, bx, orbit, run = parser.parse_text_file(file_name)
+
+    assert list(evt) == [1, 2] and list(tdc) == [9, 10] and list(tdc2) == [62, -1]
+    assert list(ampl[0]) == list(range(20)) and list(ch[1]) == [1, 2]
+    assert capsys.readouterr().out == f"Failed for evt:1  {ADC}\n"
+
+def test_partial_header(tmp_path, capsys):
+    file_name = str(tmp_path / "uHTR4.txt")
+    with open(file_name, "w") as fp: # evt of the second header is read, bx onwards keep the first header's values
+        fp.write(event_text(1, [(ADC, "9")], bx=5) + event_text(2, [(ADC, "10")]).replace("BX: 100", "BX: 1x0"))
+
+    evt, ch, ampl, tdc, tdc2, bx, orbit, run = parser.parse_text_file(file_name)
+
+    assert list(evt) == [1, 2] and list(bx) == [5, 5] and list(tdc) == [9, 10]
+    assert capsys.readouterr().out == f"Failed to parse line 7 in {file_name}\n"
+
+def test_nul_character(tmp_path, capsys):
+    file_name = str(tmp_path / "uHTR4.txt")
+    with open(file_name, "w") as fp:
+        fp.write(event_text(1, [(" 1 x", "9")]) + event_text(2, [(ADC + "\x00", "10")]))
+
+    with pytest.raises(parser.CorruptionError, match="line 9 "):
+        parser.parse_text_file(file_name)
+    assert capsys.readouterr().out == "Failed for evt:1   1 x\n"
+
+@pytest.fixture
+def uHTR_data(tmp_path):
+    """
+    Parsed arrays of a file with a handful of runs and an orbit overflow in it
+    """
+    file_name = str(tmp_path / "uHTR11.txt")
+    write_uHTR_file(file_name, 3000, seed=2, run_length=700, first_orbit=2**32 - 400_000)
+    return parser.parse_text_file(file_name)
+
+def write_v1_file(file_name, evt, ch, ampl, tdc, tdc2, bx, orbit, run):
+    """
+    Writes a version 1 .uhtr file, the way txt_to_bin() used to (see read_bin_header())
+    """
+    with open(file_name, "wb") as fp:
+        fp.write(bytes([1]) + len(evt).to_bytes(4, "big"))
+        for array, dtype in [(evt, ">u4"), (tdc, "u1"), (tdc2, "i1"), (bx, ">u2"), (ampl, "u1"), (ch, "u1"), (orbit, ">u8"), (run, ">u4")]:
+            fp.write(np.ascontiguousarray(array, dtype=dtype).tobytes())
+
+def assert_same(arrays, expected):
+    assert len(arrays) == len(expected)
+    for array, expected_array in zip(arrays, expected):
+        assert np.array_equal(array, expected_array)
+
+def test_bin_file_round_trip(tmp_path, uHTR_data):
+    file_name = str(tmp_path / "uHTR11.uhtr")
+    parser.write_bin_file(file_name, *uHTR_data)
+
+    with open(file_name, "rb") as fp:
+        header = parser.read_bin_header(fp)
+    assert header.version == parser.BIN_VERSION and header.array_len == len(uHTR_data[0])
+    assert all(column.offset % parser.BIN_ALIGNMENT == 0 for column in header.columns)
+
+    assert_same(parser.parse_bin_file(file_name), uHTR_data)
+    assert_same(parser.parse_bin_file(file_name, memmap=True), uHTR_data)
+    assert_same(parser.parse_bin_file(file_name, events=(100, 1500)), [array[100:1500] for array in uHTR_data])
+
+def test_bin_file_run_index(tmp_path, uHTR_data):
+    file_name = str(tmp_path / "uHTR11.uhtr")
+    parser.write_bin_file(file_name, *uHTR_data)
+    run, orbit = uHTR_data[7], uHTR_data[6]
+
+    with open(file_name, "rb") as fp:
+        run_index = parser.read_bin_header(fp).run_index
+
+    assert len(run_index) == len(np.unique(run)) > 1
+    assert run_index[0].start == 0 and run_index[-1].stop == len(run)
+    for segment, next_segment in zip(run_index, run_index[1:] + [None]):
+        assert np.all(run[segment.start:segment.stop] == segment.run)
+        assert segment.orbit_min == orbit[segment.start:segment.stop].min()
+        assert segment.orbit_max == orbit[segment.start:segment.stop].max()
+        assert next_segment is None or next_segment.start == segment.stop
+
+def test_bin_file_selection(tmp_path, uHTR_data):
+    file_name = str(tmp_path / "uHTR11.uhtr")
+    parser.write_bin_file(file_name, *uHTR_data)
+    run, orbit = uHTR_data[7], uHTR_data[6]
+
+    runs = list(np.unique(run)[1:3])
+    assert_same(parser.parse_bin_file(file_name, runs=runs), [array[np.isin(run, runs)] for array in uHTR_data])
+
+    # The orbit counter overflows in the file, so the range is on the orbits as stored
+    orbit_range = (int(np.percentile(orbit, 30)), int(np.percentile(orbit, 60)))
+    in_range = (orbit >= orbit_range[0]) & (orbit <= orbit_range[1])
+    assert 0 < np.count_nonzero(in_range) < len(orbit)
+    assert_same(parser.parse_bin_file(file_name, orbit_range=orbit_range), [array[in_range] for array in uHTR_data])
+    assert_same(parser.parse_bin_file(file_name, runs=runs, orbit_range=orbit_range),
+                [array[in_range & np.isin(run, runs)] for array in uHTR_data])
+
+def test_upgrade_v1_file(tmp_path, uHTR_data):
+    file_name = str(tmp_path / "uHTR11.uhtr")
+    write_v1_file(file_name, *uHTR_data)
+
+    assert_same(parser.parse_bin_file(file_name), uHTR_data)
+    orbit_range = (int(uHTR_data[6][500]), int(uHTR_data[6][900])) # No run index yet, the run and orbit arrays are read instead
+    in_range = (uHTR_data[6] >= orbit_range[0]) & (uHTR_data[6] <= orbit_range[1])
+    assert_same(parser.parse_bin_file(file_name, orbit_range=orbit_range), [array[in_range] for array in uHTR_data])
+
+    assert parser.upgrade_bin_file(file_name)
+    with open(file_name, "rb") as fp:
+        header = parser.read_bin_header(fp)
+    assert header.version == parser.BIN_VERSION and header.run_index is not None
+    assert_same(parser.parse_bin_file(file_name), uHTR_data)
+
+    assert not parser.upgrade_bin_file(file_name)
+
+@pytest.mark.parametrize("compression", ["zlib", "lzma"])
+def test_compressed_bin_file_round_trip(tmp_path, uHTR_data, compression):
+    file_name = str(tmp_path / "uHTR11.uhtr")
+    block_size = 1000
+    assert len(uHTR_data[0]) % block_size != 0 # Last block is only partly filled
+    parser.write_bin_file(file_name, *uHTR_data, compression=compression, block_size=block_size)
+
+    with open(file_name, "rb") as fp:
+        header = parser.read_bin_header(fp)
+    assert header.version == parser.BIN_COMPRESSED_VERSION and header.array_len == len(uHTR_data[0])
+    for column in header.columns:
+        assert column.compression == compression and len(column.blocks) == -(-header.array_len // block_size)
+        assert column.encoding == ("delta" if column.name in parser.BIN_DELTA_COLUMNS else None)
+
+    assert_same(parser.parse_bin_file(file_name), uHTR_data)
+    for events in [(0, 1), (999, 1001), (2500, 2500), (3999, None), (len(uHTR_data[0]) - 1, None)]: # Across and at block edges
+        assert_same(parser.parse_bin_file(file_name, events=events), [array[slice(*events)] for array in uHTR_data])
+
+    runs = list(np.unique(uHTR_data[7])[1:3])
+    assert_same(parser.parse_bin_file(file_name, runs=runs), [array[np.isin(uHTR_data[7], runs)] for array in uHTR_data])
+
+def test_delta_encoding(tmp_path, uHTR_data):
+    file_name = str(tmp_path / "uHTR11.uhtr")
+    evt, ch, ampl, tdc, tdc2, bx, orbit, run = (np.array(array) for array in uHTR_data)
+    evt[1500:] -= 5 # evt steps down (wraps around in uint32 differences) and orbit overflows within a block
+    assert np.any(np.diff(orbit.astype(np.int64)) < 0)
+    parser.write_bin_file(file_name, evt, ch, ampl, tdc, tdc2, bx, orbit, run, compression="zlib", block_size=1000)
+
+    with open(file_name, "rb") as fp:
+        header = parser.read_bin_header(fp)
+        arrays = parser.read_bin_events(fp, header.columns, 1200, 2300)
+    assert np.array_equal(arrays["evt"], evt[1200:2300]) and np.array_equal(arrays["orbit"], orbit[1200:2300])
+    assert_same(parser.parse_bin_file(file_name), (evt, ch, ampl, tdc, tdc2, bx, orbit, run))
+
+def test_unknown_compression(tmp_path, uHTR_data):
+    with pytest.raises(ValueError):
+        parser.write_bin_file(str(tmp_path / "uHTR11.uhtr"), *uHTR_data, compression="zip")
+
+def partial_file(tmp_path, cut):
+    """
+    Writes a uHTR.txt file that stops cut bytes into its last event (like a file that is still being written to).
+    Returns the file name and the rest of the file
+    """
+    file_name = str(tmp_path / "uHTR4.txt")
+    write_uHTR_file(file_name, 500, seed=3)
+    with open(file_name, "a") as fp:
+        fp.write(event_text(500, [(ADC, "9 62"), (ADC, "17")]))
+    with open(file_name, "rb") as fp:
+        text = fp.read()
+
+    last_event = text.rfind(b"--- START")
+    with open(file_name, "wb") as fp:
+        fp.write(text[:last_event + cut])
+    return file_name, text[last_event + cut:]
+
+CUTS = [10, # In the middle of the event header
+        62, # Right after the event header
+        138, # After the seperator line, before any pair
+        150, # In the middle of the first ADC line
+        193, # After the first ADC line, before its TDC line
+        195, # In the middle of the first TDC line ("9 " of "9 62")
+        198] # After the first TDC line, the second pair is missing
+
+@pytest.mark.parametrize("cut", CUTS)
+@pytest.mark.parametrize("chunk_size", [1000, parser.CHUNK_SIZE])
+def test_parse_text_tail(tmp_path, cut, chunk_size):
+    file_name, rest = partial_file(tmp_path, cut)
+    data, resume = parser.parse_text_tail(file_name, chunk_size=chunk_size)
+
+    with open(file_name, "ab") as fp:
+        fp.write(rest)
+    new_data, next_resume = parser.parse_text_tail(file_name, resume, chunk_size=chunk_size)
+    full = parser.parse_text_file(file_name)
+
+    assert_same([np.concatenate((array[:resume.events], new_array)) for array, new_array in zip(data, new_data)], full)
+    assert next_resume.events + 2 == len(full[0]) # The resume point is the start of the last event
+    assert next_resume.header[0] == 499
+
+@pytest.mark.parametrize("cut", CUTS)
+def test_parse_text_update(tmp_path, cut):
+    file_name, rest = partial_file(tmp_path, cut)
+    parser.txt_to_bin(file_name)
+    with open(file_name[:-3] + "uhtr", "rb") as fp:
+        assert parser.read_bin_header(fp).source.offset > 0
+
+    with open(file_name, "ab") as fp:
+        fp.write(rest)
+    data = parser.txt_to_bin(file_name) # Only parses what is after the resume point stored in the .uhtr file
+    full = parser.parse_text_file(file_name)
+
+    assert_same(data, full)
+    assert_same(parser.parse_bin_file(file_name[:-3] + "uhtr"), full)
+    with open(file_name[:-3] + "uhtr", "rb") as fp:
+        assert parser.read_bin_header(fp).source.events + 2 == len(full[0])
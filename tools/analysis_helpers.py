@@ -9,10 +9,12 @@ import tools.plotting as plotting
 import tools.commonVars as commonVars
 from tools.get_run_info import *
 import pandas as pd
-from copy import deepcopy
 import traceback
 import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context, resource_tracker, shared_memory
 from datetime import datetime
+from functools import cmp_to_key
 from tkinter import messagebox
 import os
 
@@ -53,8 +55,7 @@ def find_unique_runs(uHTR4, uHTR11):
     """
     Finds and identifies all runs that are present in the data
     """
-    all_runs = np.concatenate((uHTR4.run, uHTR11.run))
-    return np.unique(all_runs).astype(np.uint32)
+    return np.union1d(uHTR4.run_index.runs, uHTR11.run_index.runs).astype(np.uint32)
 
 def find_data():
     """
@@ -80,7 +81,6 @@ def find_data():
 def create_empty_bhm(uHTR):
     uHTR = bhm_analyser(uHTR=uHTR)
 
-    uHTR.ch = np.empty(0,)
     uHTR.ampl = np.empty(0,)
     uHTR.tdc = np.empty(0,)
     uHTR.tdc_2 = np.empty(0,)
@@ -88,6 +88,8 @@ def create_empty_bhm(uHTR):
     uHTR.orbit = np.empty(0,)
     uHTR.run = np.empty(0,)
     uHTR.ch_mapped= np.empty(0,)
+    uHTR.peak_ampl = np.empty(0,)
+    uHTR.build_run_index()
 
     return uHTR
 
@@ -116,6 +118,134 @@ def run_handler(runs):
             else:
                 fp.write("{:^8}\n".format(run))
 
+ORBIT_WRAP = 2**32 # The uHTR orbit counter is 32 bits
+
+def is_sorted(arr):
+    """
+    Checks if array is sorted
+    """
+    return np.all(arr[:-1] <= arr[1:])
+
+def event_position(arrays, i):
+    """
+    (run, orbit, evt) of event i in the arrays of a single file
+    """
+    return int(arrays["run"][i]), int(arrays["orbit"][i]), int(arrays["evt"][i])
+
+def compare_positions(a, b):
+    """
+    Orders two (run, orbit, evt) event positions in time, returns -1, 0 or 1 like a cmp function.
+    Orbits are compared modulo 2^32 so that an orbit overflow between the two events doesn't matter
+    """
+    if a[0] != b[0]:
+        return -1 if a[0] < b[0] else 1
+
+    step = (b[1] - a[1]) % ORBIT_WRAP
+    if step == 0:
+        return (a[2] > b[2]) - (a[2] < b[2])
+    return -1 if step < ORBIT_WRAP // 2 else 1
+
+def plan_file_merge(arrays):
+    """
+    Works out the time order of a list of uHTR files (dicts of their arrays, each file sorted in time) from their first
+    and last events, instead of trusting their file names. Files that don't overlap in time are simply put one after
+    another, files that do are merged event by event (see merge_overlapping_files()).
+    Returns a list of (file number, events to take from it) in time order
+    """
+    files = [i for i, file_arrays in enumerate(arrays) if len(file_arrays["evt"]) > 0]
+    files.sort(key=cmp_to_key(lambda a, b: compare_positions(event_position(arrays[a], 0), event_position(arrays[b], 0))))
+
+    clusters = [] # [files, last event position] of every group of overlapping files
+    for i in files:
+        first, last = event_position(arrays[i], 0), event_position(arrays[i], -1)
+        if len(clusters) > 0 and compare_positions(first, clusters[-1][1]) <= 0:
+            clusters[-1][0].append(i)
+            if compare_positions(last, clusters[-1][1]) > 0:
+                clusters[-1][1] = last
+        else:
+            clusters.append([[i], last])
+
+    pieces = []
+    for cluster, _ in clusters:
+        if len(cluster) == 1:
+            pieces.append((cluster[0], slice(None)))
+        else:
+            pieces += merge_overlapping_files(arrays, cluster)
+
+    return pieces
+
+def merge_overlapping_files(arrays, files):
+    """
+    Merges files that overlap in time by (run, orbit), one file at a time into the already merged ones. Events
+    (every column identical) that were dumped into more than one file are only kept from the first of them.
+    Returns a list of (file number, event indices) in time order
+    """
+    # Orbits are counted from the earliest orbit of every run, so an overflow inside of a run doesn't break the order
+    base = {}
+    for i in files:
+        runs, first = np.unique(arrays[i]["run"], return_index=True)
+        for run, index in zip(runs.tolist(), first.tolist()):
+            orbit = int(arrays[i]["orbit"][index])
+            if run not in base or compare_positions((run, orbit, 0), (run, base[run], 0)) < 0:
+                base[run] = orbit
+    base_runs = np.array(sorted(base), dtype=np.int64)
+    base_orbits = np.array([base[run] for run in sorted(base)], dtype=np.int64)
+
+    def keys(i):
+        run = arrays[i]["run"].astype(np.int64)
+        orbit = arrays[i]["orbit"].astype(np.int64)
+        return run * ORBIT_WRAP + (orbit - base_orbits[np.searchsorted(base_runs, run)]) % ORBIT_WRAP
+
+    if not all(is_sorted(keys(i)) for i in files): # Files that aren't in time order on their own can't be merged, keep them as they are
+        return [(i, slice(None)) for i in files]
+
+    merged_keys = keys(files[0])
+    merged_file = np.full(len(merged_keys), files[0])
+    merged_index = np.arange(len(merged_keys))
+    for i in files[1:]: # Each file is sorted already, so it only has to be slotted in between the merged events
+        new_keys = keys(i)
+        new_slots = np.searchsorted(merged_keys, new_keys, side="right") + np.arange(len(new_keys))
+        is_new = np.zeros(len(merged_keys) + len(new_keys), dtype=bool)
+        is_new[new_slots] = True
+
+        def slot_in(merged, new):
+            out = np.empty(len(is_new), dtype=merged.dtype)
+            out[new_slots] = new
+            out[~is_new] = merged
+            return out
+
+        merged_keys = slot_in(merged_keys, new_keys)
+        merged_file = slot_in(merged_file, np.full(len(new_keys), i))
+        merged_index = slot_in(merged_index, np.arange(len(new_keys)))
+
+    # Duplicates can only be among events with the same key that came from different files
+    group_start = np.flatnonzero(np.diff(merged_keys, prepend=-1) != 0)
+    group = np.cumsum(np.diff(merged_keys, prepend=-1) != 0) - 1
+    mixed = np.minimum.reduceat(merged_file, group_start) != np.maximum.reduceat(merged_file, group_start)
+    candidates = np.flatnonzero(mixed[group])
+
+    keep = np.ones(len(merged_keys), dtype=bool)
+    if len(candidates) > 0:
+        rows = [merged_keys[candidates, None].view(np.uint8)]
+        for name in arrays[files[0]]:
+            row_bytes = arrays[files[0]][name].dtype.itemsize * int(np.prod(arrays[files[0]][name].shape[1:]))
+            column = np.empty((len(candidates), row_bytes), dtype=np.uint8)
+            for i in files:
+                from_file = merged_file[candidates] == i
+                values = np.ascontiguousarray(arrays[i][name][merged_index[candidates[from_file]]])
+                column[from_file] = values.view(np.uint8).reshape(len(values), row_bytes)
+            rows.append(column)
+        rows = np.ascontiguousarray(np.concatenate(rows, axis=1))
+        rows = rows.view(np.dtype((np.void, rows.shape[1]))).ravel()
+
+        _, first, label = np.unique(rows, return_index=True, return_inverse=True)
+        first_file = merged_file[candidates][first]
+        keep[candidates] = merged_file[candidates] == first_file[label.ravel()]
+
+    merged_file, merged_index = merged_file[keep], merged_index[keep]
+    bounds = np.flatnonzero(np.diff(merged_file) != 0) + 1
+    return [(int(file[0]), index) for file, index in zip(np.split(merged_file, bounds), np.split(merged_index, bounds))]
+
 def get_run_orbit_ref(uHTR4, uHTR11):
     """
     Finds a run that is shared in both uHTR4 and uHTR11 that can be best used for timing.
@@ -123,13 +253,14 @@ def get_run_orbit_ref(uHTR4, uHTR11):
     else timing could be off by anywhere from seconds to hours.
     Additionally, finds the lowest orbit value within that run to use as a reference point for timing.
     """
-    all_runs = sorted(find_unique_runs(uHTR4, uHTR11))
+    index4, index11 = uHTR4.run_index, uHTR11.run_index
+    all_runs = find_unique_runs(uHTR4, uHTR11) # Already sorted
     for i in range(1, len(all_runs)):
-        if all_runs[i] in uHTR4.run and all_runs[i] in uHTR11.run: # Check if run transition exists in both files
+        if all_runs[i] in index4 and all_runs[i] in index11: # Check if run transition exists in both files
             run = all_runs[i]
             break
-        elif (all_runs[i] == all_runs[i-1]+1 and all_runs[i] in uHTR4.run and all_runs[i-1] in uHTR4.run) or \
-             (all_runs[i] == all_runs[i-1]+1 and all_runs[i] in uHTR11.run and all_runs[i-1] in uHTR11.run): 
+        elif (all_runs[i] == all_runs[i-1]+1 and all_runs[i] in index4 and all_runs[i-1] in index4) or \
+             (all_runs[i] == all_runs[i-1]+1 and all_runs[i] in index11 and all_runs[i-1] in index11): 
             # Else check if run transition is +1 within a single file
             run = all_runs[i]
             break
@@ -145,7 +276,7 @@ def get_run_orbit_ref(uHTR4, uHTR11):
                     " Loaded run time data will be off from UTC by anywhere between a few seconds to multiple hours.")
         run = min(all_runs)
         
-    min_orbit = min(*uHTR4.orbit[uHTR4.run==run], *uHTR11.orbit[uHTR11.run==run])
+    min_orbit = min(index.get_orbit_range(run)[0] for index in (index4, index11) if run in index)
     return run, min_orbit
 
 def get_run_info(run_cut):
@@ -278,114 +409,220 @@ def get_run_info(run_cut):
     return run_time_ms, lumi_bins, delivered_lumi, beam_status
 
 
-def load_uHTR_data(data_folder_str):
+def load_uHTR_data(data_folder_str, load_ampl=False):
     """
     Loads in uHTR data from the specified folder path.
+    Only the peak of the 20 amplitudes of every event is loaded (peak_ampl), unless load_ampl is set,
+    since nothing in the analysis needs the full ampl matrix
     """
     def check_conversion_consent():
         """
-        Checks if the user would like to convert their text files to binary files
+        Checks if the user would like to convert their text files to binary files. The text files that get loaded
+        are converted while they are parsed (see parser.parse_file_shared()), so they are only parsed once
         """
         consent = askyesno("uHTR.txt files found. Would you like to convert them into a new format which loads"+\
                            " significantly faster and uses less disk space? (Note, this will not erase the original files)",
                            title="Data Conversion Check")
-        if consent:
-            for file in glob(f"{DATA_FOLDER}/{data_folder_str}/*.txt"):
-                parser.txt_to_bin(file)
+        return consent
 
-    def load_from_file(uHTR, files, data_type=None):
+    def convert_leftovers():
         """
-        Handles the actual loading process and creating bhm_analyser objects
+        Converts the text files in the folder that weren't loaded, and thus not converted while loading
         """
-        if data_type is None:
-
-            if any([".uhtr" in file for file in files]):
-                data_type = "binary"
-                files = [file for file in files if ".uhtr" in file]
+        for file in glob(f"{DATA_FOLDER}/{data_folder_str}/*.txt"):
+            if not os.path.exists(file[:-3] + "uhtr"):
+                parser.txt_to_bin(file)
 
-            else:
-                data_type = "text"
-        
-        files = sorted(files)
+    def check_upgrade_consent():
+        """
+        Checks if the user would like to upgrade their old .uhtr files to the newest version of the format
+        """
+        old_files = []
+        for file in glob(f"{DATA_FOLDER}/{data_folder_str}/*.uhtr"):
+            with open(file, "rb") as fp:
+                version = fp.read(1)
+            if version and version[0] < parser.BIN_VERSION:
+                old_files.append(file)
+
+        if len(old_files) > 0:
+            consent = askyesno("Old .uhtr files found. Would you like to upgrade them to the newest format, which loads"+\
+                               " faster? (Note, this will overwrite the old .uhtr files)",
+                               title="Data Upgrade Check")
+            if consent:
+                for file in old_files:
+                    parser.upgrade_bin_file(file)
+
+    def load_from_files(sides):
+        """
+        Handles the actual loading process and creating bhm_analyser objects. sides maps each uHTR ("4"/"11") to its
+        (files, data_type). The files of every side are parsed at once in a process pool, each worker hands its arrays
+        back through shared memory and they are copied once into preallocated arrays.
+        Text files are converted to .uhtr files on the way if the user agreed to it
+        """
+        def collect(futures):
+            """
+            Waits on the parsing jobs of a single side and attaches to their shared memory blocks.
+            If any job failed, every block is released before the error is raised
+            """
+            blocks = []
+            error = None
+            for future in futures:
+                try:
+                    blocks.append(future.result())
+                except Exception as err:
+                    error = error or err
+            
+            shms = [[shared_memory.SharedMemory(name=name) for name, _, _ in file_blocks] for file_blocks in blocks]
+            if error is not None:
+                release(shms)
+                raise error
+            return blocks, shms
 
-        commonVars.data_corrupted = False
+        def release(shms):
+            """
+            Frees the shared memory blocks made by parser.parse_file_shared()
+            """
+            for file_shms in shms:
+                for shm in file_shms:
+                    shm.close()
+                    shm.unlink()
 
-        def is_sorted(arr):
+        def combine(uHTR, blocks, shms):
             """
-            Checks if array is sorted
+            Concatenates the arrays of every file (in time order, see plan_file_merge()) into one bhm_analyser object
             """
-            return np.all(arr[:-1] <= arr[1:])
+            _uHTR = bhm_analyser(uHTR=f"{uHTR}")
+            data_corrupted = False
 
-        _uHTR = bhm_analyser(uHTR=f"{uHTR}")
+            arrays = [{name: np.ndarray(shape, dtype=dtype, buffer=shm.buf) for name, (_, dtype, shape), shm in zip(columns, file_blocks, file_shms)}
+                      for file_blocks, file_shms in zip(blocks, shms)]
+            
+            for file_arrays in arrays:
+                if not is_sorted(file_arrays["evt"]):
+                    data_corrupted = True
+
+            pieces = plan_file_merge(arrays)
+            total_evts = sum(len(arrays[i]["evt"][index]) for i, index in pieces)
+            if total_evts > 0: # only fill in arrays if data isn't empty
+                # Everything is native byte order, and orbit is always int64 no matter how the file stored it (text and version 1 files give uint64)
+                merged = {name: np.empty((total_evts,) + array.shape[1:], dtype=np.int64 if name == "orbit" else array.dtype.newbyteorder("="))
+                          for name, array in arrays[0].items()}
+                start = 0
+                for i, index in pieces:
+                    stop = start + len(arrays[i]["evt"][index])
+                    for name, array in arrays[i].items():
+                        merged[name][start:stop] = array[index]
+                    start = stop
+
+                _uHTR.ampl = merged.get("ampl")
+                _uHTR.peak_ampl = merged["peak_ampl"]
+                _uHTR.tdc = merged["tdc"]
+                _uHTR.tdc_2 = merged["tdc2"]
+                _uHTR.bx = merged["bx"]
+                _uHTR.orbit = merged["orbit"]
+                _uHTR.run = merged["run"]
+                _uHTR.ch_mapped = merged["ch"].T[0]*10 + merged["ch"].T[1] # ch itself isn't kept, ch_mapped is all that's needed
+
+            del arrays # views into shared memory must be gone before it can be closed
+
+            # The files were put in time order by their contents (see plan_file_merge()), not by their names
+            if total_evts > 0 and not data_corrupted:
+                # If orbits aren't in order and evts are in order, an integer overflow of orbits must have occured.
+                # Every step down in orbit is an overflow of the 32 bit counter, so everything after it gets ORBIT_WRAP added on top
+                # (orbit is int64 here, see above). The number of overflows before an event is the running count of them
+                wraps = np.flatnonzero(_uHTR.orbit[:-1] > _uHTR.orbit[1:]) + 1
+                if len(wraps) >= 100: # Too many overflows, it's likely the data files aren't in order or the data is corrupted.
+                    data_corrupted = True
+                    print(f"uHTR{uHTR}: found {len(wraps)} orbit overflows, the data is likely out of order or corrupted. Only the first 100 are unwrapped")
+                    wraps = wraps[:100]
+
+                _uHTR.orbit_wraps = np.vstack((wraps, _uHTR.orbit[wraps])) # Before the orbits get unwrapped
+
+                if len(wraps) > 0:
+                    num_wraps = np.zeros(total_evts, dtype=_uHTR.orbit.dtype)
+                    num_wraps[wraps] = 1
+                    np.cumsum(num_wraps, out=num_wraps)
+                    _uHTR.orbit += num_wraps * ORBIT_WRAP
+
+            _uHTR.build_run_index() # After the overflows are taken care of, so the orbit ranges are right
+            commonVars.data_corrupted |= data_corrupted
+            
+            return _uHTR
 
-        for i, file in enumerate(files): # this loads each uHTR file and will combine them into one object
-            if i == 0: _uHTR.load_data(file, data_type)
-            else:
-                if data_type == "binary":
-                    evt, ch, ampl, tdc, tdc_2, bx, orbit, run  = parser.parse_bin_file(file)
+        jobs = {}
+        for uHTR, (files, data_type) in sides.items():
+            if data_type is None:
+
+                if any([".uhtr" in file for file in files]):
+                    data_type = "binary"
+                    files = [file for file in files if ".uhtr" in file]
 
-                elif data_type == "text":
-                    evt, ch, ampl, tdc, tdc_2, bx, orbit, run  = parser.parse_text_file(file)
-                
                 else:
-                    raise ValueError(f"Unknown data type: \"{data_type}\"")
+                    data_type = "text"
 
-                if not is_sorted(evt):
-                    commonVars.data_corrupted = True
+            if data_type == "text" and converting:
+                data_type = "convert"
 
-                try:
-                    _uHTR.ch = np.append(_uHTR.ch, ch, axis=0)
-                    _uHTR.ampl = np.append(_uHTR.ampl, ampl, axis=0)
-                    _uHTR.tdc = np.append(_uHTR.tdc, tdc, axis=0)
-                    _uHTR.tdc_2 = np.append(_uHTR.tdc_2, tdc_2, axis=0)
-                    _uHTR.bx = np.append(_uHTR.bx, bx, axis=0)
-                    _uHTR.orbit = np.append(_uHTR.orbit, orbit, axis=0)
-                    _uHTR.run = np.append(_uHTR.run, run, axis=0)
-                    _uHTR.ch_mapped = np.append(_uHTR.ch_mapped, ch.T[0]*10 + ch.T[1], axis=0)
-
-                except AttributeError: # If i == 0 entry is empty, we need to create the bhm arrays first
-                    _uHTR.load_data(file, data_type)
-        
-        num_loops = 0
-        # Note, this assumes that uHTR*.txt files are named numerically in time (ie. uHTR4 -> uHTR4_1 -> uHTR4_2 -> ... etc)
-        while not is_sorted(_uHTR.orbit) and not commonVars.data_corrupted and num_loops < 100:
-            # If orbits aren't in order and evts are in order, an integer of orbits must have occured
-            # Add 2^32-1 to orbit values that aren't in order and check if orbits are sorted, repeat until
-            # all integer overflows have been accounted for (orbit dtype should be np.uint64)
+            if data_type not in ("binary", "text", "convert"):
+                raise ValueError(f"Unknown data type: \"{data_type}\"")
+            
+            jobs[uHTR] = (sorted(files), data_type) # Only a tie breaker, the files get put in time order by their contents
+
+        commonVars.data_corrupted = False
+
+        columns = ["evt", "ch", "tdc", "tdc2", "bx", "orbit", "run", "peak_ampl"] + (["ampl"] if load_ampl else [])
+
+        num_files = sum(len(files) for files, _ in jobs.values())
+        loaded = {}
+        resource_tracker.ensure_running() # Workers should share our tracker, since we are the ones unlinking their blocks
+        # We are usually called from the GUI's loader thread, forking a process with threads running can deadlock the workers.
+        # A fork server (or spawning where there isn't one) starts them from a clean single threaded process instead.
+        # Workers import the main script again, so scripts that load data need the usual if __name__ == "__main__": guard
+        mp_context = get_context("forkserver" if "forkserver" in get_all_start_methods() else "spawn")
+        with ProcessPoolExecutor(max_workers=max(min(num_files, os.cpu_count() or 1), 1), mp_context=mp_context) as pool:
+            futures = {uHTR: [pool.submit(parser.parse_file_shared, file, data_type, columns) for file in files]
+                       for uHTR, (files, data_type) in jobs.items()}
+            
+            pending = list(futures)
             try:
-                overflow_index = np.where((_uHTR.orbit[:-1] <= _uHTR.orbit[1:])==0)[0][0] + 1
-                _uHTR.orbit = np.concatenate((_uHTR.orbit[0:overflow_index], _uHTR.orbit[overflow_index:] + 4_294_967_295))
-            except IndexError:
-                commonVars.data_corrupted = True
-                break
+                while pending:
+                    uHTR = pending.pop(0)
+                    blocks, shms = collect(futures[uHTR])
+                    try:
+                        loaded[uHTR] = combine(uHTR, blocks, shms)
+                    finally:
+                        release(shms)
             finally:
-                num_loops += 1
-        
-        if num_loops >= 100: # If we are looping too many times, it's likely the data files aren't in order or the data is corrupted.
-            commonVars.data_corrupted = True
-            
-        
-        return _uHTR
+                for uHTR in pending: # Something went wrong, don't leave any shared memory behind
+                    try:
+                        release(collect(futures[uHTR])[1])
+                    except Exception:
+                        pass
+
+        return loaded
 
     uHTR4 = create_empty_bhm("4")
     uHTR11 = create_empty_bhm("11")
 
+    check_upgrade_consent()
+
     uHTR4_files = glob(f"{DATA_FOLDER}/{data_folder_str}/*uHTR4*.txt") + glob(f"{DATA_FOLDER}/{data_folder_str}/*uHTR_4*.txt") + \
                     glob(f"{DATA_FOLDER}/{data_folder_str}/*uHTR4*.uhtr") + glob(f"{DATA_FOLDER}/{data_folder_str}/*uHTR_4*.uhtr")
     
     uHTR11_files = glob(f"{DATA_FOLDER}/{data_folder_str}/*uHTR11*.txt") + glob(f"{DATA_FOLDER}/{data_folder_str}/*uHTR_11*.txt") + \
                     glob(f"{DATA_FOLDER}/{data_folder_str}/*uHTR11*.uhtr") + glob(f"{DATA_FOLDER}/{data_folder_str}/*uHTR_11*.uhtr")
     
+    converting = False
     if not any([".uhtr" in file for file in uHTR4_files + uHTR11_files]) and len(uHTR4_files + uHTR11_files) > 0:
-        check_conversion_consent()
+        converting = check_conversion_consent()
     
 
     if len(uHTR4_files) > 0 and len(uHTR11_files) > 0: # Check for standard file format
 
         commonVars.unknown_side = False
 
-        uHTR4 = load_from_file(uHTR="4", files=uHTR4_files)
-        uHTR11 = load_from_file(uHTR="11", files=uHTR11_files)
+        loaded = load_from_files({"4": (uHTR4_files, None), "11": (uHTR11_files, None)})
+        uHTR4, uHTR11 = loaded["4"], loaded["11"]
 
 
     else: # Check for different known file naming schemes
@@ -393,7 +630,7 @@ def load_uHTR_data(data_folder_str):
         data_files =  glob(f"{DATA_FOLDER}/{data_folder_str}/*.txt") + glob(f"{DATA_FOLDER}/{data_folder_str}/*.uhtr")
 
         if not any([".uhtr" in file for file in data_files]) and len(data_files) > 0:
-            check_conversion_consent()
+            converting = check_conversion_consent()
 
         if all(["MINUS" in file or "PLUS" in file for file in data_files]): # Check for MINUS or PLUS naming scheme
 
@@ -402,10 +639,9 @@ def load_uHTR_data(data_folder_str):
             uHTR4_files = glob(f"{DATA_FOLDER}/{data_folder_str}/*PLUS*.txt") + glob(f"{DATA_FOLDER}/{data_folder_str}/*PLUS*.uhtr")
             uHTR11_files = glob(f"{DATA_FOLDER}/{data_folder_str}/*MINUS*.txt") + glob(f"{DATA_FOLDER}/{data_folder_str}/*MINUS*.uhtr")
 
-            if len(uHTR4_files) > 0:
-                uHTR4 = load_from_file(uHTR="4", files=uHTR4_files)
-            if len(uHTR11_files) > 0:
-                uHTR11 = load_from_file(uHTR="11", files=uHTR11_files)
+            sides = {uHTR: (files, None) for uHTR, files in (("4", uHTR4_files), ("11", uHTR11_files)) if len(files) > 0}
+            loaded = load_from_files(sides)
+            uHTR4, uHTR11 = loaded.get("4", uHTR4), loaded.get("11", uHTR11)
 
 
         
@@ -416,16 +652,15 @@ def load_uHTR_data(data_folder_str):
             uHTR4_text_files = glob(f"{DATA_FOLDER}/{data_folder_str}/*PF*.txt") + glob(f"{DATA_FOLDER}/{data_folder_str}/*PN*.txt")
             uHTR11_text_files = glob(f"{DATA_FOLDER}/{data_folder_str}/*MF*.txt") + glob(f"{DATA_FOLDER}/{data_folder_str}/*MN*.txt")
 
-            if len(uHTR4_text_files) > 0:
-                uHTR4 = load_from_file(uHTR="4", data_type="text", files=uHTR4_text_files)
-            if len(uHTR11_text_files) > 0:
-                uHTR11 = load_from_file(uHTR="11", data_type="text", files=uHTR11_text_files)
+            sides = {uHTR: (files, "text") for uHTR, files in (("4", uHTR4_text_files), ("11", uHTR11_text_files)) if len(files) > 0}
+            loaded = load_from_files(sides)
+            uHTR4, uHTR11 = loaded.get("4", uHTR4), loaded.get("11", uHTR11)
 
 
 
         elif len(data_files) > 0: # Cannot determine consistent naming scheme, load everything in as uHTR4
 
-            uHTR4 = load_from_file(uHTR="4", data_type="text", files=data_files)
+            uHTR4 = load_from_files({"4": (data_files, "text")})["4"]
             
             commonVars.unknown_side = True
 
@@ -433,16 +668,24 @@ def load_uHTR_data(data_folder_str):
         
         else: # If no files are found, raise error
             raise FileNotFoundError
+
+    if converting:
+        convert_leftovers()
     
     commonVars.reference_run, commonVars.reference_orbit = get_run_orbit_ref(uHTR4, uHTR11) # Must be done before clean_data()
 
-    if len(uHTR4.run) > 0:
-        uHTR4.clean_data()
-    if len(uHTR11.run) > 0:
-        uHTR11.clean_data()
+    for uHTR in (uHTR4, uHTR11):
+        if len(uHTR) > 0:
+            cut_counts = uHTR.clean_data()
+            print(f"uHTR{uHTR.uHTR} events removed by clean_data(): " + ", ".join(f"{name}: {count}" for name, count in cut_counts.items()))
+            if uHTR.orbit_wraps.shape[1] > 0:
+                print(f"uHTR{uHTR.uHTR} orbit overflows (event, orbit): " + ", ".join(f"({index}, {orbit})" for index, orbit in uHTR.orbit_wraps.T))
     
     loaded_runs = find_unique_runs(uHTR4, uHTR11)
 
+    uHTR4.set_read_only() # Every analysis shares these arrays, see analysis()
+    uHTR11.set_read_only()
+
     return uHTR4, uHTR11, loaded_runs
 
 def analysis(uHTR4: bhm_analyser, uHTR11: bhm_analyser, figure_folder, run_cut=None, custom_range=False, 
@@ -464,7 +707,7 @@ def analysis(uHTR4: bhm_analyser, uHTR11: bhm_analyser, figure_folder, run_cut=N
     commonVars.beam_status = beam_status
 
     if start_time == 0:
-        commonVars.reference_orbit = min(min(uHTR4.orbit, default=float("inf")), min(uHTR11.orbit, default=float("inf")))
+        commonVars.reference_orbit = min((uHTR.run_index.orbit_min.min() for uHTR in (uHTR4, uHTR11) if len(uHTR.run_index) > 0), default=float("inf"))
 
     if save_fig:
         uHTR4.create_figure_folder()
@@ -487,8 +730,8 @@ def analysis(uHTR4: bhm_analyser, uHTR11: bhm_analyser, figure_folder, run_cut=N
         calib.ADC_CUTS = calib.ADC_CUTS_v2
         calib.TDC_PEAKS = calib.TDC_PEAKS_v2
 
-    commonVars.uHTR4 = deepcopy(uHTR4) # create copies so multiple analyses can be run without having to reload data
-    commonVars.uHTR11 = deepcopy(uHTR11) # Also allows us to access uHTR objects outside of analysis
+    commonVars.uHTR4 = uHTR4.new_session() # sessions share the loaded data, so multiple analyses can be run without having to reload
+    commonVars.uHTR11 = uHTR11.new_session() # or copy it. Also allows us to access uHTR objects outside of analysis
 
     if manual_calib:
         commonVars.uHTR4.analyse(reAdjust=False, run_cut=run_cut, custom_range=custom_range, plot_lego=plot_lego, plot_ch_events=plot_ch_events, save_fig=save_fig)
@@ -17,11 +17,205 @@ from mpl_toolkits.mplot3d.axes3d import Axes3D
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
 import pandas as pd
-import scipy.stats as stats
 import seaborn as sns
 import os
 import time
 import warnings
+from copy import copy
+
+class RunIndex():
+    '''
+    Per run summary of the loaded events, built in a single pass over the run array so that run lookups
+    don't have to scan through every event again.
+
+    Events of a run don't have to be next to each other, the index keeps every stretch of consecutive events
+    of the same run as a segment (seg_run, seg_start, seg_stop), in the order they appear in the data.
+    Everything else is per run, in the same (sorted) order as self.runs:
+        n_events        number of events of the run
+        orbit_min/max   lowest and highest orbit of the run
+    run can also be given as codes into a sorted run_table (see bhm_analyser.run), the index always holds the run numbers
+    '''
+    def __init__(self, run, orbit, run_table=None):
+        run = np.asarray(run)
+        orbit = np.asarray(orbit)
+
+        bounds = np.flatnonzero(run[1:] != run[:-1]) + 1
+        self.seg_start = np.concatenate(([0], bounds)).astype(np.int64) if len(run) > 0 else np.empty(0, dtype=np.int64)
+        self.seg_stop = np.append(self.seg_start[1:], len(run)).astype(np.int64)
+        self.seg_run = run[self.seg_start]
+
+        self.runs, seg_index = np.unique(self.seg_run, return_inverse=True)
+        seg_len = self.seg_stop - self.seg_start
+        self.n_events = np.bincount(seg_index, weights=seg_len, minlength=len(self.runs)).astype(np.int64)
+
+        # Orbit range of every segment first, then of every run (there are only a handful of segments per run)
+        if len(run) > 0:
+            by_run = np.argsort(seg_index, kind="stable")
+            run_start = np.searchsorted(seg_index[by_run], np.arange(len(self.runs)))
+            self.orbit_min = np.minimum.reduceat(np.minimum.reduceat(orbit, self.seg_start)[by_run], run_start)
+            self.orbit_max = np.maximum.reduceat(np.maximum.reduceat(orbit, self.seg_start)[by_run], run_start)
+        else:
+            self.orbit_min = np.empty(0, dtype=orbit.dtype)
+            self.orbit_max = np.empty(0, dtype=orbit.dtype)
+
+        if run_table is not None: # Codes keep the order of the runs, so only the values have to be swapped
+            self.seg_run = run_table[self.seg_run]
+            self.runs = run_table[self.runs]
+
+    def __len__(self):
+        return len(self.runs)
+
+    def __contains__(self, run):
+        i = np.searchsorted(self.runs, run)
+        return bool(i < len(self.runs) and self.runs[i] == run)
+
+    def find(self, run):
+        '''
+        Position of run in self.runs, raises KeyError if the run isn't loaded
+        '''
+        i = np.searchsorted(self.runs, run)
+        if i == len(self.runs) or self.runs[i] != run:
+            raise KeyError(run)
+        return i
+
+    def get_orbit_range(self, run):
+        '''
+        Returns the lowest and highest orbit of run
+        '''
+        i = self.find(run)
+        return self.orbit_min[i], self.orbit_max[i]
+
+    def select(self, selected):
+        '''
+        Indices of all events whose run is in selected (a boolean array over self.runs), in the order of the data
+        '''
+        keep = selected[np.searchsorted(self.runs, self.seg_run)]
+        starts, stops = self.seg_start[keep], self.seg_stop[keep]
+        lengths = stops - starts
+
+        # Every event index is its segment start plus how far it is into the segment
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        return np.arange(lengths.sum(), dtype=np.int64) + offsets
+
+class HistogramCube():
+    '''
+    Number of events for every (channel, tdc, peak_ampl) combination, filled with a single np.bincount over all events.
+    self.counts[i, tdc, adc] counts the events of channel self.channels[i], the extra last row holds the events of
+    every other channel (ie. non connected ones).
+
+    Every ADC, TDC and TDC vs ADC histogram is a sum over part of the cube (see get_counts()), the values the counts
+    belong to are self.tdc_values and self.adc_values, so they can be binned like the events (see histogram())
+    '''
+    def __init__(self, ch_mapped, tdc, peak_ampl, channels):
+        ch_mapped = np.asarray(ch_mapped)
+        tdc = np.asarray(tdc)
+        peak_ampl = np.asarray(peak_ampl)
+        self.channels = np.asarray(channels)
+
+        num_tdc = int(tdc.max()) + 1 if len(tdc) > 0 else 1
+        num_adc = int(peak_ampl.max()) + 1 if len(peak_ampl) > 0 else 1
+        # Same dtypes as the data, so cuts like np.abs(tdc - peak) work out exactly the same on these as on the events
+        self.tdc_values = np.arange(num_tdc).astype(tdc.dtype)
+        self.adc_values = np.arange(num_adc).astype(peak_ampl.dtype)
+
+        max_ch = max(int(ch_mapped.max()) if len(ch_mapped) > 0 else 0, int(self.channels.max()) if len(self.channels) > 0 else 0)
+        ch_index = np.full(max_ch + 1, len(self.channels), dtype=np.intp)
+        ch_index[self.channels] = np.arange(len(self.channels))
+
+        size = (len(self.channels) + 1) * num_tdc * num_adc
+        if len(ch_mapped) > 0:
+            key = ch_index[ch_mapped]
+            key *= num_tdc
+            key += tdc
+            key *= num_adc
+            key += peak_ampl
+            self.counts = np.bincount(key, minlength=size).reshape(len(self.channels) + 1, num_tdc, num_adc)
+        else:
+            self.counts = np.zeros((len(self.channels) + 1, num_tdc, num_adc), dtype=np.intp)
+
+    def get_counts(self, ch_num=None):
+        '''
+        Returns the (tdc, adc) counts of channel ch_num, or of all events if ch_num is None
+        '''
+        if ch_num is None:
+            return self.counts.sum(axis=0)
+        i = np.flatnonzero(self.channels == ch_num)
+        return self.counts[i[0] if len(i) > 0 else -1]
+
+    def histogram2d(self, counts, tdc_bins, adc_bins):
+        '''
+        Same as np.histogram2d(tdc, peak_ampl, bins=(tdc_bins, adc_bins)) of the events behind counts (see get_counts())
+        '''
+        tdc, adc = np.meshgrid(self.tdc_values, self.adc_values, indexing="ij")
+        return np.histogram2d(tdc.ravel(), adc.ravel(), bins=(tdc_bins, adc_bins), weights=counts.ravel())
+
+    def rebin(self, tdc_bins, adc_bins):
+        '''
+        Same as histogram2d() for every row of the cube at once, returns the counts with shape (channels + 1, tdc bins, adc bins)
+        '''
+        def bin_matrix(values, bins):
+            '''
+            matrix[i, j] is 1 if values[i] falls into bin j, same binning as np.histogram (the last bin includes its right edge)
+            '''
+            bins = np.asarray(bins)
+            index = np.searchsorted(bins, values, side="right") - 1
+            index[values == bins[-1]] = len(bins) - 2
+            inside = (index >= 0) & (index < len(bins) - 1)
+            matrix = np.zeros((len(values), len(bins) - 1), dtype=self.counts.dtype)
+            matrix[np.flatnonzero(inside), index[inside]] = 1
+            return matrix
+
+        counts = np.tensordot(self.counts, bin_matrix(self.tdc_values, tdc_bins), axes=(1, 0)) # (channels + 1, adc, tdc bins)
+        return np.tensordot(counts, bin_matrix(self.adc_values, adc_bins), axes=(1, 0))
+
+    @staticmethod
+    def histogram(values, counts, bins):
+        '''
+        Same as np.histogram() of the events behind counts, values are the tdc/adc values that the counts belong to
+        '''
+        return np.histogram(values, bins=bins, weights=counts)
+
+    @staticmethod
+    def stats(values, counts):
+        '''
+        Mean, mode (smallest of the most common values) and standard deviation (ddof=1) of the events behind counts along
+        its last axis, same as pandas' mean(), mode()[0] and std(). Rows without events (or a single one for std) give NaN
+        '''
+        values = values.astype(np.float64)
+        num_events = counts.sum(axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            mean = (counts * values).sum(axis=-1) / num_events
+            var = (counts * (values - mean[..., None])**2).sum(axis=-1) / (num_events - 1)
+        mode = np.where(num_events > 0, values[counts.argmax(axis=-1)], np.nan)
+        return mean, mode, np.where(num_events > 1, np.sqrt(var), np.nan)
+
+class ChannelGroups():
+    '''
+    Events grouped by channel: self.order is a stable argsort of ch_mapped, so the events of every channel sit next to
+    each other (still in their original order), from self.offsets[ch] up to self.offsets[ch+1].
+    Picking out a few channels only touches their own events, instead of a ch_mapped == ch pass over all events per channel
+    '''
+    def __init__(self, ch_mapped):
+        ch_mapped = np.asarray(ch_mapped)
+        self.order = np.argsort(ch_mapped, kind="stable") # A radix sort for the small integer types ch_mapped comes in
+        self.offsets = np.concatenate(([0], np.cumsum(np.bincount(ch_mapped)))) if len(ch_mapped) > 0 else np.zeros(1, dtype=np.intp)
+
+    def get_indices(self, ch_num):
+        '''
+        Indices of the events of channel ch_num, in the order of the data
+        '''
+        if 0 <= ch_num < len(self.offsets) - 1:
+            return self.order[self.offsets[ch_num]:self.offsets[ch_num+1]]
+        return self.order[:0]
+
+    def get_mask(self, channels):
+        '''
+        Truth array of the events that belong to any of channels
+        '''
+        mask = np.zeros(len(self.order), dtype=bool)
+        for ch_num in channels:
+            mask[self.get_indices(ch_num)] = True
+        return mask
 
 class bhm_analyser():
     __version__ ="0.1"
@@ -30,6 +224,17 @@ class bhm_analyser():
         "11":"-Z Side"
     }
 
+    # Every per event array that gets cut down along with the data
+    event_arrays = ("bx", "ampl", "tdc", "tdc_2", "ch_mapped", "orbit", "run_code", "peak_ampl", "region")
+
+    # Millions of events sit in a handful of arrays, so the analyser doesn't need a __dict__ on top of them
+    __slots__ = event_arrays + ("uHTR", "figure_folder", "save_fig", "adc_plt_tdc_width", "orbit_wraps", "run_table",
+                                "run_index", "histograms", "channel_groups",
+                                "CMAP", "inverted_CMAP", "df", "tdc_correction")
+
+    # Bits of the per event region code, see get_SR_BR_AR_CP()
+    region_bits = {"SR": 1, "BR": 2, "CP": 4, "AR": 8}
+
     def __init__(self,uHTR="4") -> None:
         #print(f"Initialized {self.beam_side[uHTR]}")
         self.uHTR=uHTR
@@ -39,6 +244,32 @@ class bhm_analyser():
 
         self.adc_plt_tdc_width = 1
 
+        # The full (N, 20) ampl matrix is only loaded when asked for (see analysis_helpers.load_uHTR_data()),
+        # everything downstream only needs peak_ampl
+        self.ampl = None
+        self.peak_ampl = None
+
+        # Nothing is loaded yet, see load_data() or analysis_helpers.load_uHTR_data()
+        self.bx = None
+        self.tdc = None
+        self.tdc_2 = None
+        self.ch_mapped = None
+        self.orbit = None
+        self.run_code = None # Run of every event as an index into run_table, see run
+        self.run_table = None
+        self.df = None # See convert2pandas()
+        self.inverted_CMAP = None
+        self.tdc_correction = None
+
+        # (event index, orbit) of every 32 bit orbit counter overflow that was unwrapped, orbit being the raw value of the first
+        # event after it. Indices are into the events as loaded, before clean_data(), see analysis_helpers.load_uHTR_data()
+        self.orbit_wraps = np.empty((2, 0), dtype=np.int64)
+
+        self.run_index = None # RunIndex of the loaded events, see build_run_index()
+        self.histograms = None # HistogramCube of the loaded events, see get_histograms()
+        self.channel_groups = None # ChannelGroups of the loaded events, see get_channel_groups()
+        self.region = None # Region code (bitmask of region_bits) of every event, see get_SR_BR_AR_CP()
+
         if self.uHTR=="4":
             self.CMAP = hw_info.get_uHTR4_CMAP()
         elif self.uHTR=="11":
@@ -46,6 +277,30 @@ class bhm_analyser():
         else:
             raise ValueError("Wrong Format for uHTR!!!")
 
+    def __len__(self):
+        '''
+        Number of loaded events
+        '''
+        return len(self.run_code) if self.run_code is not None else 0
+
+    @property
+    def run(self):
+        '''
+        Run of every event. There are only a few runs in the data, so the events only keep the index of their run in
+        self.run_table (self.run_code, as small as the number of runs allows) and the run numbers get looked up when asked for
+        '''
+        return self.run_table[self.run_code]
+
+    @run.setter
+    def run(self, run):
+        run = np.asarray(run)
+
+        # Runs come in long stretches of events, so only the first event of every stretch has to be looked up in the table
+        seg_start = np.flatnonzero(np.concatenate(([True], run[1:] != run[:-1]))) if len(run) > 0 else np.empty(0, dtype=np.int64)
+        seg_len = np.diff(np.append(seg_start, len(run)))
+        self.run_table, seg_code = np.unique(run[seg_start], return_inverse=True)
+        self.run_code = np.repeat(seg_code.astype(np.min_scalar_type(max(len(self.run_table) - 1, 0))), seg_len)
+
     def create_figure_folder(self,folder=None):
         '''
         create a folder to save the figures in ...
@@ -95,14 +350,94 @@ class bhm_analyser():
             commonVars.data_corrupted = True
 
         if len(evt) > 0: # only run if data isn't empty
-            self.ch = ch
             self.ampl = ampl
             self.tdc = tdc
             self.tdc_2 = tdc_2
             self.bx = bx
             self.orbit = orbit
             self.run = run
-            self.ch_mapped= ch.T[0]*10 + ch.T[1] #Quick Channel Mapping
+            self.ch_mapped= ch.T[0]*10 + ch.T[1] #Quick Channel Mapping, ch itself isn't needed after this
+            self.build_run_index()
+
+    def build_run_index(self):
+        '''
+        (Re)builds self.run_index from the loaded events, see RunIndex
+        '''
+        self.run_index = RunIndex(self.run_code, self.orbit, self.run_table)
+        return self.run_index
+
+    def get_histograms(self, theCut=None):
+        '''
+        Returns the HistogramCube of the loaded events, or of only the events where theCut is True.
+        The one of all events is only filled once, for as long as the data doesn't change
+        '''
+        if theCut is not None:
+            return HistogramCube(self.ch_mapped[theCut], self.tdc[theCut], self.peak_ampl[theCut], list(self.CMAP.values()))
+
+        if self.histograms is None:
+            self.histograms = HistogramCube(self.ch_mapped, self.tdc, self.peak_ampl, list(self.CMAP.values()))
+        return self.histograms
+
+    def get_channel_groups(self):
+        '''
+        Returns the events grouped by channel (see ChannelGroups), only put together once, for as long as the data doesn't change
+        '''
+        if self.channel_groups is None:
+            self.channel_groups = ChannelGroups(self.ch_mapped)
+        return self.channel_groups
+
+    def get_time_window(self, start_utc, end_utc):
+        '''
+        Returns a boolean array of the events with start_utc <= time <= end_utc (utc ms, counted from commonVars.start_time_utc_ms
+        at commonVars.reference_orbit). The times are turned into orbits (see dt_conv.utc_ms_to_orbit()), the same cut the pandas
+        queries use, so the events never have to be turned into times. Events are in time order after loading
+        (see analysis_helpers.load_uHTR_data()), so the window is a single stretch of them and its ends can be binary searched.
+        Only corrupted data that never got its orbit overflows fixed has to be compared event by event
+        '''
+        start_orbit = dt_conv.utc_ms_to_orbit(start_utc, commonVars.start_time_utc_ms, commonVars.reference_orbit)
+        end_orbit = dt_conv.utc_ms_to_orbit(end_utc, commonVars.start_time_utc_ms, commonVars.reference_orbit)
+        if not np.all(self.orbit[:-1] <= self.orbit[1:]):
+            return (self.orbit >= start_orbit) & (self.orbit <= end_orbit)
+
+        window = np.zeros(len(self.orbit), dtype=bool)
+        window[np.searchsorted(self.orbit, start_orbit, side="left"):np.searchsorted(self.orbit, end_orbit, side="right")] = True
+        return window
+
+    def new_session(self):
+        '''
+        Returns a copy of the analyser to run a single analysis on, without copying any of the data.
+        The event arrays are shared with this analyser and never written to (see set_read_only()), cuts on the
+        session replace its own arrays with views or gathered subsets and leave the ones in here alone
+        '''
+        return copy(self)
+
+    def set_read_only(self):
+        '''
+        Locks every loaded event array, so that sessions sharing them can't change the data under each other
+        '''
+        for name in self.event_arrays + ("run_table",):
+            array = getattr(self, name, None)
+            if isinstance(array, np.ndarray):
+                array.flags.writeable = False
+
+    def apply_cut(self, theCut):
+        '''
+        Keeps only the events where theCut is True (or the events at the indices in theCut, in increasing order),
+        in every per event array that is loaded
+        '''
+        if theCut.dtype == bool:
+            theCut = np.flatnonzero(theCut) # Gathering with indices is several times faster than boolean indexing on every array
+        if len(theCut) == 0 or theCut[-1] - theCut[0] == len(theCut) - 1: # One unbroken stretch of events, so a view will do
+            theCut = slice(theCut[0], theCut[-1] + 1) if len(theCut) > 0 else slice(0, 0)
+        for name in self.event_arrays:
+            array = getattr(self, name)
+            if array is not None:
+                setattr(self, name, array[theCut])
+
+        if self.run_index is not None: # Event ranges have moved, so the index has to follow
+            self.build_run_index()
+        self.histograms = None
+        self.channel_groups = None
 
     def removeNC(self):
         '''
@@ -110,19 +445,9 @@ class bhm_analyser():
         '''
         start = time.time()
         #removing non_connected_channels
-        for i, ch in enumerate(hw_info.not_connected_channels): # Create singular truth array 
-            if i == 0:
-                theCut = self.ch_mapped != ch
-            else:
-                theCut = theCut & (self.ch_mapped != ch)
-        self.bx = self.bx[theCut]
-        self.ampl   = self.ampl[theCut]
-        self.tdc    = self.tdc[theCut]
-        self.tdc_2  = self.tdc_2[theCut]
-        self.ch_mapped    = self.ch_mapped[theCut]
-        self.orbit  = self.orbit[theCut]
-        self.run    = self.run[theCut]
-        self.peak_ampl = self.ampl.max(axis=1)
+        self.apply_cut(~self.get_channel_groups().get_mask(hw_info.not_connected_channels))
+        if self.peak_ampl is None:
+            self.peak_ampl = self.ampl.max(axis=1)
 
         #Remove TDC value of 62!!!
     
@@ -131,14 +456,7 @@ class bhm_analyser():
         remove if the TDC has a 62 flag
         '''
         theCut = (self.tdc_2 != 62) & (self.tdc < 50)
-        self.bx           = self.bx[theCut]
-        self.ampl         = self.ampl[theCut]
-        self.tdc          = self.tdc[theCut]
-        self.tdc_2        = self.tdc_2[theCut]
-        self.ch_mapped    = self.ch_mapped[theCut]
-        self.orbit        = self.orbit[theCut]
-        self.run          = self.run[theCut]
-        self.peak_ampl    = self.peak_ampl[theCut]
+        self.apply_cut(theCut)
 
     def remove25glich(self):
         """
@@ -148,14 +466,7 @@ class bhm_analyser():
 
         #total_cuts = np.count_nonzero((self.tdc == 25) & (self.peak_ampl == 188))
 
-        self.bx           = self.bx[theCut]
-        self.ampl         = self.ampl[theCut]
-        self.tdc          = self.tdc[theCut]
-        self.tdc_2        = self.tdc_2[theCut]
-        self.ch_mapped    = self.ch_mapped[theCut]
-        self.orbit        = self.orbit[theCut]
-        self.run          = self.run[theCut]
-        self.peak_ampl    = self.peak_ampl[theCut]
+        self.apply_cut(theCut)
 
         #self.cut_188_25 = total_cuts
 
@@ -167,14 +478,7 @@ class bhm_analyser():
 
         #total_cuts = np.count_nonzero((self.tdc == 0) & (self.peak_ampl == 124))
 
-        self.bx           = self.bx[theCut]
-        self.ampl         = self.ampl[theCut]
-        self.tdc          = self.tdc[theCut]
-        self.tdc_2        = self.tdc_2[theCut]
-        self.ch_mapped    = self.ch_mapped[theCut]
-        self.orbit        = self.orbit[theCut]
-        self.run          = self.run[theCut]
-        self.peak_ampl    = self.peak_ampl[theCut]
+        self.apply_cut(theCut)
 
         #self.cut_124_0 = total_cuts
 
@@ -182,50 +486,67 @@ class bhm_analyser():
         """
         We add this functionality so that the available runs are accurate in the final_analysis.py file, otherwise
         we tend to have extraneous runs that may include data that will eventually be purged
+
+        Does the same as removeNC(), remove62(), remove25glich() and remove124amp0tdc() one after another, but all
+        of the cuts are combined into one mask first so the data is only sliced once.
+        Returns the number of events rejected by each cut (an event only counts towards the first cut that rejects it)
         """
-        self.removeNC()
-        self.remove62()
-        self.remove25glich()
-        self.remove124amp0tdc()
+        if self.peak_ampl is None:
+            self.peak_ampl = self.ampl.max(axis=1)
+
+        not_connected = self.get_channel_groups().get_mask(hw_info.not_connected_channels)
+
+        rejected = {
+            "NC"            : not_connected,
+            "TDC2=62"       : self.tdc_2 == 62,
+            "TDC>=50"       : self.tdc >= 50,
+            "25/188 glitch" : (self.tdc == 25) & (self.peak_ampl == 188),
+            "0/124"         : (self.tdc == 0) & (self.peak_ampl == 124),
+        }
+
+        theCut = np.ones(len(self), dtype=bool)
+        cut_counts = {}
+        for name, reject in rejected.items():
+            cut_counts[name] = int(np.count_nonzero(theCut & reject))
+            theCut &= ~reject
+
+        self.apply_cut(theCut)
+
+        return cut_counts
 
     def select_runs(self, run_cut, custom_range=False):
         '''
         run_cut [inclusive] --> give the lower and upper bound of the runs you are interested in if range = true
         OR if fed an integer, it will choose that run only
         OR you can feed an array of runs to choose from if range is set to false
+        The runs are looked up in self.run_index, so only the events that are kept get touched
         '''
+        run_index = self.run_index if self.run_index is not None else self.build_run_index()
+        runs = run_index.runs
+
         if isinstance(run_cut, (int, np.integer)): # checks for single value instead of range
-            theCut = (self.run == run_cut)
+            selected = (runs == run_cut)
             
         elif custom_range: # choice values
-            theCut = np.full(len(self.run), False)
-            for condition in run_cut:
-                theCut = theCut | (self.run == condition)
+            selected = np.isin(runs, np.asarray(run_cut))
 
         else: # range of values
-            theCut = (self.run >= run_cut[0]) & (self.run <= run_cut[1])
+            selected = (runs >= run_cut[0]) & (runs <= run_cut[1])
         
-        self.bx           = self.bx[theCut]
-        self.ampl         = self.ampl[theCut]
-        self.tdc          = self.tdc[theCut]
-        self.tdc_2        = self.tdc_2[theCut]
-        self.ch_mapped    = self.ch_mapped[theCut]
-        self.orbit        = self.orbit[theCut]
-        self.run          = self.run[theCut]
-        self.peak_ampl    = self.peak_ampl[theCut]
+        self.apply_cut(run_index.select(selected))
 
 
     def get_legoPlt(self):
         '''
         Lego Plot of peak ampl vs tdc
         '''
-        if len(self.run) == 0 and commonVars.root: # Draw empty plot in gui if data empty
+        if len(self) == 0 and commonVars.root: # Draw empty plot in gui if data empty
             plotting.plot_lego_gui(self.uHTR, None, None, None)
             return
         
-        xdata = self.tdc#[self.ch_mapped == self.CMAP["MN05"]]
-        ydata = self.peak_ampl#[self.ch_mapped == self.CMAP["MN05"]]
-        h, xbins, ybins = np.histogram2d(xdata,ydata, bins=(np.arange(-0.5,50,1),np.arange(0,180,1)))
+        histograms = self.get_histograms()
+        counts = histograms.get_counts()#(self.CMAP["MN05"])
+        h, xbins, ybins = histograms.histogram2d(counts, np.arange(-0.5,50,1), np.arange(0,180,1))
         # if you want to create your 3d axes in the current figure (plt.gcf()):
 
         if self.save_fig:
@@ -260,13 +581,17 @@ class bhm_analyser():
 
         if self.save_fig:
             f, ax = plt.subplots()
+        histograms = self.get_histograms()
+        x = histograms.adc_values
         for i, ch in enumerate(self.CMAP.keys()):
 
-            if len(self.run) == 0 and commonVars.root:
+            if len(self) == 0 and commonVars.root:
                 plotting.plot_adc_gui(ch, None, binx, binx_tick, self.adc_plt_tdc_width)
                 continue
 
-            x = self.peak_ampl[(np.abs(self.tdc-calib.TDC_PEAKS[ch]) < self.adc_plt_tdc_width)&(self.ch_mapped == self.CMAP[ch])]
+            # Counts of every peak_ampl value x within the TDC window
+            tdc_cut = np.abs(histograms.tdc_values-calib.TDC_PEAKS[ch]) < self.adc_plt_tdc_width
+            x_counts = histograms.get_counts(self.CMAP[ch])[tdc_cut].sum(axis=0)
 
             if self.save_fig:
                 if i == 0:
@@ -279,7 +604,7 @@ class bhm_analyser():
                         ax.set_xticklabels(labels=binx_tick, rotation=45)
                     ax.set_xlabel("ADC [a.u]")
                     text_obj = plotting.textbox(0.5,0.8,f"CH:{ch} \n $|$TDC - {calib.TDC_PEAKS[ch]} $| <$ {self.adc_plt_tdc_width}")
-                    counts, bins, polygon = ax.hist(x,bins=binx+0.5, histtype="stepfilled")
+                    counts, bins, polygon = ax.hist(x,bins=binx+0.5, weights=x_counts, histtype="stepfilled")
                     if max(counts) > 0:
                         ax.set_ylim(top=max(counts)/.95)
                     else:
@@ -289,7 +614,7 @@ class bhm_analyser():
                     It is *ever* so slightly faster (about 30-40ms faster per render on my machine) to change only the things we need to
                     (textbox, ylimits, histogram) on each iteration of the loop
                     """
-                    hist, bin_edges = np.histogram(x, bins=binx)
+                    hist, bin_edges = histograms.histogram(x, x_counts, bins=binx)
                     verticies = []
                     for j in range(len(hist)): # Generates the verticies of the new histogram polygon
                         if j == 0:
@@ -314,7 +639,7 @@ class bhm_analyser():
                 f.savefig(f"{self.figure_folder}/adc_peaks/uHTR_{self.uHTR}_{ch}.png",dpi=300)
 
             if commonVars.root:
-                plotting.plot_adc_gui(ch, x, binx, binx_tick, self.adc_plt_tdc_width)
+                plotting.plot_adc_gui(ch, x, binx, binx_tick, self.adc_plt_tdc_width, weights=x_counts)
 
         plt.close()
 
@@ -324,14 +649,17 @@ class bhm_analyser():
         '''
         if self.save_fig:
             f,ax = plt.subplots()
+        histograms = self.get_histograms()
+        x = histograms.tdc_values
 
         for i, ch in enumerate(self.CMAP.keys()):
 
-            if len(self.run) == 0 and commonVars.root:
+            if len(self) == 0 and commonVars.root:
                 plotting.plot_tdc_gui(ch, None, None)
                 continue
 
-            x = self.tdc[(self.peak_ampl > calib.ADC_CUTS[ch])&(self.ch_mapped == self.CMAP[ch])]
+            # Counts of every tdc value x above the ADC cut
+            x_counts = histograms.get_counts(self.CMAP[ch])[:, histograms.adc_values > calib.ADC_CUTS[ch]].sum(axis=1)
             binx = np.arange(-.5,50,1)
 
             if self.save_fig:
@@ -341,7 +669,7 @@ class bhm_analyser():
                     plotting.textbox(0.0,1.11,'Preliminary',15, ax=ax)
                     plotting.textbox(0.5,1.11,f'{self.beam_side[self.uHTR]} [uHTR-{self.uHTR}]',15, ax=ax)
                     ax.set_xlabel("TDC [a.u]")
-                    counts, bins, polygon = ax.hist(x,bins=binx,histtype='step',color='r')
+                    counts, bins, polygon = ax.hist(x,bins=binx,weights=x_counts,histtype='step',color='r')
                     peak = np.argmax(counts[delay:])
                     line = ax.axvline(peak+delay,color='k',linestyle='--')
                     if max(counts) > 0:
@@ -354,7 +682,7 @@ class bhm_analyser():
                     (textboxes, ylimits, histogram) on each iteration of the loop
                     """
                     # start = time.time()
-                    hist, bin_edges = np.histogram(x, bins=binx)
+                    hist, bin_edges = histograms.histogram(x, x_counts, bins=binx)
                     verticies = []
                     for j in range(len(hist)): # Generates the verticies of the new histogram polygon
                         if j == 0:
@@ -380,11 +708,11 @@ class bhm_analyser():
                 f.savefig(f"{self.figure_folder}/tdc_peaks/{ch}.png",dpi=300)
             
             else:
-                hist, bin_edges = np.histogram(x, bins=binx)
+                hist, bin_edges = histograms.histogram(x, x_counts, bins=binx)
                 peak = np.argmax(hist[delay:])
 
             if commonVars.root:
-                plotting.plot_tdc_gui(ch, x, peak, delay)
+                plotting.plot_tdc_gui(ch, x, peak, delay, weights=x_counts)
 
             plt.close()
     
@@ -397,61 +725,94 @@ class bhm_analyser():
 
         ADC Cut is determined by finding the approximate standard deviation (~68% of area within +/- 15 bins of peak adc value) 
         of the peak_ampl array at tdc == tdc peak value
+
+        Every channel is done at once, on the TDC vs ADC histograms of all channels stacked together
         """
 
-        for ch in self.CMAP.keys():
-            adc = self.peak_ampl[self.ch_mapped == self.CMAP[ch]]
-            tdc = self.tdc[self.ch_mapped == self.CMAP[ch]]
-
-            # We set the tdc peak as the max value of the tdc/adc lego plot with the region tdc < 15 and adc > 127, since the signal region should be there,
-            # given that the detectors are properly aligned (hardware level)
-            h, tdc_bins, adc_bins = np.histogram2d(tdc, adc, bins=(np.arange(-0.5,15,1),np.arange(128,180,1)))
-            max_index = list(h.flatten()).index(np.max(h))
-            tdc_peak, adc_peak = int(max_index / h.shape[1]), max_index % h.shape[1] # Note, adc peak is offset by -128 here and does not reflect the actual adc value
-
-            calib.TDC_PEAKS[ch] = tdc_peak
-            adc_vals = h[tdc_peak]
-
-            area_ratio = 0
-            left_bound = right_bound = adc_peak
-            min_index = max(0, adc_peak-15) # prevent index errors by establishing max and min values for index bounds
-            max_index = min(50, adc_peak + 16)
-            total_counts = sum(adc_vals[min_index:max_index])
-
-            while area_ratio < .68 and total_counts != 0: # Use ~1 sigma bounds as the adc cut
-                if left_bound >= min_index:
-                    left_bound -= 1
-                if right_bound < max_index:
-                    right_bound += 1
-                area_ratio = sum(adc_vals[left_bound+1:right_bound]) / total_counts # non-inclusive cut of endpoints
-
-            if total_counts == 0: 
+        channels = np.arange(len(self.CMAP))
+
+        # We set the tdc peak as the max value of the tdc/adc lego plot with the region tdc < 15 and adc > 127, since the signal region should be there,
+        # given that the detectors are properly aligned (hardware level)
+        h = self.get_histograms().rebin(np.arange(-0.5,15,1), np.arange(128,180,1))[:-1] # Last row is the non connected channels
+        max_index = h.reshape(len(channels), -1).argmax(axis=1)
+        tdc_peak, adc_peak = max_index // h.shape[2], max_index % h.shape[2] # Note, adc peak is offset by -128 here and does not reflect the actual adc value
+        adc_vals = h[channels, tdc_peak]
+
+        # The window grows by a bin on each side every step, until it holds ~1 sigma (68%) of the counts within +/- 15 bins of the peak.
+        # Sums over the window are differences of the cumulative sum, and 16 steps always cover all of the +/- 15 bins
+        min_index = np.maximum(0, adc_peak-15) # prevent index errors by establishing max and min values for index bounds
+        max_index = np.minimum(50, adc_peak + 16)
+        cumsum = np.concatenate((np.zeros((len(channels), 1), dtype=adc_vals.dtype), np.cumsum(adc_vals, axis=1)), axis=1)
+        total_counts = cumsum[channels, max_index] - cumsum[channels, min_index]
+
+        steps = np.arange(1, 17)
+        left_bound = np.maximum(adc_peak[:, None] - steps, min_index[:, None] - 1)
+        right_bound = np.minimum(adc_peak[:, None] + steps, max_index[:, None])
+        with np.errstate(divide="ignore", invalid="ignore"):
+            area_ratio = (np.take_along_axis(cumsum, right_bound, axis=1) - np.take_along_axis(cumsum, left_bound + 1, axis=1)) / total_counts[:, None] # non-inclusive cut of endpoints
+        # area_ratio only grows with every step, so the number of steps under 68% is where the window stops
+        left_bound = left_bound[channels, np.minimum((area_ratio < .68).sum(axis=1), len(steps) - 1)]
+
+        # If left bound is hovering over a data void (ie a hardware cut that is greater than it), then move left bound next to nearest non-zero point
+        # (this is primarily a visual thing, and should have no effect on analysis)
+        filled = (adc_vals != 0) & (np.arange(adc_vals.shape[1]) >= left_bound[:, None] + 1)
+        left_bound = filled.argmax(axis=1) - 1
+
+        for i, ch in enumerate(self.CMAP.keys()):
+            calib.TDC_PEAKS[ch] = int(tdc_peak[i])
+            if total_counts[i] == 0:
                 calib.ADC_CUTS[ch] = calib.ADC_CUTS_v2[ch] # if channel is empty, we don't want this to break, set cut to manually derived approximations
             else:
-                while adc_vals[left_bound+1] == 0:# If left bound is hovering over a data void (ie a hardware cut that is greater than it),
-                # then move left bound next to nearest non-zero point (this is primarily a visual thing, and should have no effect on analysis) 
-                        left_bound += 1
-                
-                calib.ADC_CUTS[ch] = left_bound + 128
-        
-        
+                calib.ADC_CUTS[ch] = int(left_bound[i]) + 128
 
 
     def convert2pandas(self):
-        self.df = pd.DataFrame()
-        self.df['bx']           =self.bx
-        # self.df['ampl']         =self.ampl
-        self.df['tdc']          =self.tdc
-        self.df['tdc_2']        =self.tdc_2
-        self.df['ch']           =self.ch_mapped
-
+        '''
+        Puts the events into self.df. The columns are the event arrays themselves (no copies), ch_name is a categorical
+        on top of the channel index of every event (its position in self.CMAP) and run one on top of self.run_code.
+        run is ordered like self.run_table, so queries can compare it with (or look for) any of the loaded runs
+        '''
         self.inverted_CMAP = {v: k for k, v in self.CMAP.items()}
-        self.df["ch_name"] = self.df["ch"].map(self.inverted_CMAP)
 
-        self.df['orbit']        =self.orbit
-        self.df['run']          =self.run
-        self.df['peak_ampl']    =self.peak_ampl
-        pass
+        # Channel index lookup table by ch_mapped, -1 (NaN in ch_name) for channels that aren't in self.CMAP
+        size = max(self.CMAP.values()) + 1
+        if len(self.ch_mapped) > 0:
+            size = max(size, int(self.ch_mapped.max()) + 1)
+        ch_index = np.full(size, -1, dtype=np.int8)
+        ch_index[list(self.CMAP.values())] = np.arange(len(self.CMAP))
+
+        columns = {
+            'bx'        : self.bx,
+            # 'ampl'      : self.ampl,
+            'tdc'       : self.tdc,
+            'tdc_2'     : self.tdc_2,
+            'ch'        : self.ch_mapped,
+            'ch_name'   : pd.Categorical.from_codes(ch_index[self.ch_mapped], categories=list(self.CMAP.keys())),
+            'orbit'     : self.orbit,
+            'run'       : pd.Categorical.from_codes(self.run_code, categories=self.run_table, ordered=True),
+            'peak_ampl' : self.peak_ampl,
+        }
+        if self.region is not None:
+            columns['region'] = self.region
+        self.df = pd.DataFrame(columns, copy=False)
+
+    def get_calib_tables(self):
+        '''
+        Returns the calibration of every channel as lookup tables indexed by channel number (ch_mapped):
+        whether the channel is in self.CMAP, its TDC peak (calib.TDC_PEAKS) and its ADC cut (calib.ADC_CUTS)
+        '''
+        size = max(self.CMAP.values()) + 1
+        if len(self.ch_mapped) > 0:
+            size = max(size, int(self.ch_mapped.max()) + 1)
+
+        known = np.zeros(size, dtype=bool)
+        tdc_peak = np.zeros(size, dtype=np.int16)
+        adc_cut = np.zeros(size, dtype=np.int16)
+        for ch, ch_num in self.CMAP.items():
+            known[ch_num] = True
+            tdc_peak[ch_num] = calib.TDC_PEAKS[ch]
+            adc_cut[ch_num] = calib.ADC_CUTS[ch]
+        return known, tdc_peak, adc_cut
 
     def get_SR_BR_AR_CP(self):
         '''
@@ -459,39 +820,57 @@ class bhm_analyser():
         SR --> Signal Region i.e, BIB region
         AR --> Activation Region (Bkg Regiion minus Collisions)
         CP --> Collision Products
-        applys the cuts and splits the data into CR & SR
+        applys the cuts and tags every event with the regions it is in, as a bitmask of region_bits kept in
+        self.region (and the region column of self.df). Use get_region() to get the events of a region
         '''
 
-        self.convert2pandas()
-
-        # Much more optimal
-        SR = []
-        BR = []
-        CP = []
-        AR = []
-        
         #width of the TDC window
         tdc_window = 1 # +/- 1
         #col_prod = "(tdc > 28) & (tdc < 34) & (peak_ampl > 80) & (peak_ampl < 140)"
 
-        for ch in self.CMAP.keys():
-            ch_num = self.CMAP[ch]
-            ch_df = self.df[self.df["ch"].values==ch_num]
-            
-            sr = ch_df[(ch_df["tdc"].values >= calib.TDC_PEAKS[ch]-tdc_window) & (ch_df["tdc"].values <= calib.TDC_PEAKS[ch]+tdc_window) & (ch_df["peak_ampl"] >= calib.ADC_CUTS[ch])]
-            br = ch_df[((ch_df["tdc"].values < calib.TDC_PEAKS[ch]-tdc_window) | (ch_df["tdc"].values > calib.TDC_PEAKS[ch]+tdc_window)) | (ch_df["peak_ampl"] < calib.ADC_CUTS[ch])]
-            cp = ch_df[(ch_df["tdc"].values > 28) & (ch_df["tdc"].values < 34) & (ch_df["peak_ampl"].values > 80) & (ch_df["peak_ampl"].values < 140)]
-            ar = br[~((br["tdc"].values > 28) & (br["tdc"].values < 34) & (br["peak_ampl"].values > 80) & (br["peak_ampl"].values < 140))]
+        # Every event gets the calibration of its own channel from the lookup tables, so all channels are cut at once
+        known, tdc_peak, adc_cut = self.get_calib_tables()
+        in_cmap = known[self.ch_mapped]
+        tdc_peak = tdc_peak[self.ch_mapped]
 
-            SR.append(sr)
-            BR.append(br)
-            CP.append(cp)
-            AR.append(ar)
+        in_sr = (self.tdc >= tdc_peak-tdc_window) & (self.tdc <= tdc_peak+tdc_window) & (self.peak_ampl >= adc_cut[self.ch_mapped]) & in_cmap
+        in_br = ~in_sr & in_cmap
+        in_cp = (self.tdc > 28) & (self.tdc < 34) & (self.peak_ampl > 80) & (self.peak_ampl < 140) & in_cmap
 
-        self.SR = pd.concat(SR)
-        self.BR = pd.concat(BR)
-        self.CP = pd.concat(CP)
-        self.AR = pd.concat(AR)
+        bits = {name: np.uint8(bit) for name, bit in self.region_bits.items()}
+        self.region = in_sr*bits["SR"] | in_br*bits["BR"] | in_cp*bits["CP"] | (in_br & ~in_cp)*bits["AR"]
+        self.convert2pandas() # Picks up the regions as well
+
+    def get_region_bits(self, region):
+        '''
+        Returns the region_bits of region, ie. "SR" or several regions joined together like "SR & AR"
+        '''
+        return sum(self.region_bits[name] for name in region.split(" & "))
+
+    def get_region_mask(self, region):
+        '''
+        Returns a boolean array telling which events are in region (see get_region_bits()), "df" is every event
+        '''
+        if region == "df":
+            return np.ones(len(self.df), dtype=bool)
+        return (self.df["region"].to_numpy() & self.get_region_bits(region)) != 0
+
+    def get_region_query(self, region):
+        '''
+        Returns a pd.DataFrame.query string selecting the events in region (see get_region_bits()).
+        query() can't do bitwise tests, so it's written out as every region code with one of the bits set
+        '''
+        bits = self.get_region_bits(region)
+        codes = [code for code in range(1 << len(self.region_bits)) if code & bits]
+        return f"region in {codes}"
+
+    def get_region(self, region):
+        '''
+        Returns the rows of self.df that are in region (see get_region_bits()), "df" is every event
+        '''
+        if region == "df":
+            return self.df
+        return self.df[self.get_region_mask(region)]
 
 
     def plot_OccupancySRBR(self):
@@ -499,11 +878,12 @@ class bhm_analyser():
         plot occupancy histogram (Events in BX)
         Collision & Activation against  BIB
         '''
-        # print(f"self.BR.bx: {self.BR.bx}")
-        # print(f"self.SR.bx: {self.SR.bx}")
-        if len(self.run) == 0 and commonVars.root:
+        if len(self) == 0 and commonVars.root:
             plotting.plot_occupancy_gui(self.uHTR, None, None)
             return
+
+        BR_bx = self.get_region("BR").bx
+        SR_bx = self.get_region("SR").bx
         
         if self.save_fig:
             f, ax = plt.subplots()
@@ -512,17 +892,52 @@ class bhm_analyser():
             plotting.textbox(0.5,1.11,f'{self.beam_side[self.uHTR]} [uHTR-{self.uHTR}]',15, ax=ax)
             ax.set_xlabel('BX ID')
             ax.set_ylabel('Events/1')
-            ax.hist(self.BR.bx, bins=np.arange(-0.5,3564,1), color='k', histtype="stepfilled", label="Collision $\&$ Activation")
-            ax.hist(self.SR.bx, bins=np.arange(-0.5,3564,1), color='r', histtype="stepfilled", label="BIB")
+            ax.hist(BR_bx, bins=np.arange(-0.5,3564,1), color='k', histtype="stepfilled", label="Collision $\&$ Activation")
+            ax.hist(SR_bx, bins=np.arange(-0.5,3564,1), color='r', histtype="stepfilled", label="BIB")
             ax.legend(loc='upper right',frameon=1)
             plt.savefig(f"{self.figure_folder}/occupancy_uHTR{self.uHTR}.png",dpi=300)
 
         if commonVars.root:
-            plotting.plot_occupancy_gui(self.uHTR, self.BR.bx, self.SR.bx)
+            plotting.plot_occupancy_gui(self.uHTR, BR_bx, SR_bx)
 
         plt.close()
 
     #Data Quality Plots
+    def get_tdc_stability(self, theCut=None):
+        '''
+        TDC distribution of the signal events (peak_ampl above the ADC cut and tdc within 5 of the TDC peak) of every channel,
+        of all events or only the ones where theCut is True. Everything comes from the TDC histograms (see get_histograms()).
+
+        Returns (t_df, _mean, _mode, _std_dev, _mode_val, _sig):
+            t_df        ch_name and tdc of every signal event, the violin plot input. Empty channels get a single NaN line so
+                        the x labels of the violin plot still line up
+            _mean, _mode, _std_dev      per channel (NaN if the channel is empty)
+            _mode_val, _sig             mode and standard deviation of all channels together (None if there are no signal events)
+        '''
+        histograms = self.get_histograms(theCut)
+        _, tdc_peak, adc_cut = self.get_calib_tables()
+        ch_nums = list(self.CMAP.values())
+        tdc_peak, adc_cut = tdc_peak[ch_nums, None], adc_cut[ch_nums, None]
+        tdc_values = histograms.tdc_values.astype(np.int16)
+
+        in_sr = (histograms.adc_values >= adc_cut)[:, None, :] & ((tdc_values >= tdc_peak-5) & (tdc_values < tdc_peak+5))[:, :, None]
+        tdc_counts = np.where(in_sr, histograms.counts[:-1], 0).sum(axis=2) # (channels, tdc), last row of the cube is the non connected channels
+
+        _mean, _mode, _std_dev = histograms.stats(tdc_values, tdc_counts)
+        _, mode_val, sig = histograms.stats(tdc_values, tdc_counts.sum(axis=0))
+        if tdc_counts.sum() == 0:
+            _mode_val = _sig = None
+        else:
+            _mode_val, _sig = float(mode_val), float(sig)
+
+        # Every (channel, tdc) count becomes that many lines, plus the NaN line of every empty channel
+        empty = tdc_counts.sum(axis=1) == 0
+        lines = np.concatenate((tdc_counts, empty[:, None]), axis=1)
+        t_df = pd.DataFrame({"ch_name": np.repeat(list(self.CMAP.keys()), lines.sum(axis=1)),
+                             "tdc": np.repeat(np.tile(np.append(tdc_values, np.nan), len(ch_nums)), lines.ravel())})
+
+        return t_df, list(_mean), list(_mode), list(_std_dev), _mode_val, _sig
+
     def tdc_stability(self):
         '''
         Plots the stability, and calculates the MVP of the TDC
@@ -531,66 +946,18 @@ class bhm_analyser():
         '''
         #Should only apply ADC cuts
 
-        if len(self.run) == 0 and commonVars.root:
+        if len(self) == 0 and commonVars.root:
             plotting.plot_tdc_stability_gui(self.uHTR, None, None, None, None, None)
             return
-        
-        if "df" not in self.__dict__.keys():
-            print("df not found: Calling convert2pandas()")
-            self.convert2pandas()
-
-        t_df = []
-        channels = []
-        _mean = []
-        _mode = []
-        _std_dev = []
-        for ch in self.CMAP.keys():
-            ch_num = self.CMAP[ch]
-            # print(f"ch: {ch}")
-            # print(f"sr condition: (ch=={ch_num})&(peak_ampl >= {calib.ADC_CUTS[ch]})&(tdc >= {calib.TDC_PEAKS[ch]-5})&(tdc < {calib.TDC_PEAKS[ch]+5})")
-            sr = self.df[(self.df["ch"].values == ch_num) & (self.df["peak_ampl"].values >= calib.ADC_CUTS[ch]) & (self.df["tdc"].values >= (calib.TDC_PEAKS[ch]-5)) & (self.df["tdc"].values < (calib.TDC_PEAKS[ch]+5))]
-            #sr2 = self.df.query(f"(ch=={ch_num})&(peak_ampl >= {calib.ADC_CUTS[ch]})&(tdc >= {calib.TDC_PEAKS[ch]-5})&(tdc < {calib.TDC_PEAKS[ch]+5})")
-            # print(f"sr.tdc: {sr.tdc}")
-            # print(f"sr.tdc.mean(): {sr.tdc.mean()}")
-            # print(f"sr.tdc.mode(): {sr.tdc.mode()}")
-            # print(f"sr.tdc.mode()[0]: {sr.tdc.mode()[0]}")
-            channels.append(ch)
-            if sr.empty:
-                # Changed from appending 0 to NaN so no data point is drawn
-                _mean.append(float("NaN"))
-                _mode.append(float("NaN"))
-                _std_dev.append(float("NaN"))
-                # Adds a filler line to sr so that when graphing violin plots, the x labels properly line up when dealing with empty data
-                # Passing NaN ensures no other calculations using t_df are changed
-                filler_data = {col_name : [float("NaN")] if col_name != "ch_name" else [ch] for col_name in ("bx", "tdc", "tdc_2", "ch", "ch_name", "orbit", "run", "peak_ampl")}
-                sr = pd.DataFrame(data=filler_data)
-            else:
-                _mean.append(sr.tdc.mean())
-                _mode.append(sr.tdc.mode()[0])
-                _std_dev.append(sr.tdc.std())
-
-            t_df.append(sr)
 
+        channels = list(self.CMAP.keys())
+        t_df, _mean, _mode, _std_dev, _mode_val, _sig = self.get_tdc_stability()
 
         #Computing the re
         # self.tdc_correction = pd.DataFrame()
         # self.tdc_correction['CH']  = channels
         # self.tdc_correction['MVP'] = _mode
 
-
-        t_df = pd.concat(t_df)
-
-        try:
-            _mode_val = t_df.tdc.mode()[0]
-        except KeyError: # If we get a KeyError, this means the data is empty
-            pass
-        else:
-
-            if len(t_df.tdc) == 1: # ensure std() doesn't break due to only one entry existing
-                _sig = 0
-            else:
-                _sig = t_df.tdc.std()
-
         if self.save_fig:
             with warnings.catch_warnings():
                 warnings.filterwarnings('ignore', r'All-NaN (slice|axis) encountered')
@@ -615,8 +982,9 @@ class bhm_analyser():
                             ,label="MPV of TDC"
                         )
 
-                plt.axhline(_mode_val,color='black',linewidth=2,linestyle='-.',label=r"MVP All Channels")
-                plt.fill_between(channels, _mode_val+_sig, _mode_val-_sig,color='orange',alpha=.5,label=r"$\sigma$ All Channels")
+                if _mode_val is not None:
+                    plt.axhline(_mode_val,color='black',linewidth=2,linestyle='-.',label=r"MVP All Channels")
+                    plt.fill_between(channels, _mode_val+_sig, _mode_val-_sig,color='orange',alpha=.5,label=r"$\sigma$ All Channels")
                 
                 plotting.textbox(0.0,1.11,'Preliminary',15)
                 plotting.textbox(0.5,1.11,f'{self.beam_side[self.uHTR]} [uHTR-{self.uHTR}]',15)
@@ -637,17 +1005,17 @@ class bhm_analyser():
         Checks the events per channel to ensure angular and HV consistency
         """
 
-        if len(self.run) == 0 and commonVars.root:
+        if len(self) == 0 and commonVars.root:
             plotting.plot_channel_events_gui(self.uHTR, None, None, None)
             return
         
-        if "df" not in self.__dict__.keys():
+        if self.df is None:
             print("df not found: Calling get_SR_BR_CP_AR()")
             self.get_SR_BR_AR_CP()
 
         channels = [ch for ch in self.CMAP.keys()]
-        SR_events = self.SR["ch"].value_counts(sort=False)#.to_numpy()
-        # BR_events = self.BR["ch"].value_counts(sort=False)#.to_numpy()
+        SR_events = self.get_region("SR")["ch"].value_counts(sort=False)#.to_numpy()
+        # BR_events = self.get_region("BR")["ch"].value_counts(sort=False)#.to_numpy()
 
         for ch in self.CMAP.values(): # Pad pd.Series with zeros to ensure proper plotting
             if ch not in SR_events:
@@ -686,7 +1054,7 @@ class bhm_analyser():
         
 
     def computeCorrection(self,alignment_target,currentConfig):
-        if "tdc_correction" not in self.__dict__.keys():
+        if self.tdc_correction is None:
             print("tdc_correction DataFrame has not been computed")
             print("Please run tdc_stability method before running compute Corrections!!!")
             pass
@@ -761,28 +1129,32 @@ class bhm_analyser():
             else:
                 raise TypeError
 
-        df = df.sort_values("orbit")
-
-        # Very important to cast to 64bit float to prevent crashing!!
-
-        # x = start_time+(df.orbit.to_numpy().astype(np.float64)-commonVars.reference_orbit)*(3564*25*10**-6)## miliseconds
+        # Loaded data is always in orbit order (see analysis_helpers.load_uHTR_data()) and cuts keep it that way,
+        # so only sort if someone hands us something else
+        orbit = df.orbit.to_numpy()
+        if not np.all(orbit[:-1] <= orbit[1:]):
+            orbit = np.sort(orbit)
 
-        # LHC length -> 26_659 m, speed of light -> 299_792_458 m/s. 
-        # Provides a much more accurate orbit time than 25ns per bx (of which there are 3564)
-        x = start_time+(df.orbit.to_numpy().astype(np.float64)-commonVars.reference_orbit)*(26_659/299_792_458*1000)## milliseconds
+        # x = start_time+(orbit.astype(np.float64)-commonVars.reference_orbit)*(3564*25*10**-6)## miliseconds
+        x = dt_conv.orbit_to_utc_ms(orbit, start_time, commonVars.reference_orbit)## milliseconds
         if len(x) == 1:
-            return [dt_conv.get_date_time(x[0])], [1], [None]
+            return dt_conv.utc_ms_to_datetime64(x), [1], [None]
         if bins==None:
-            y,binx,_ = stats.binned_statistic(x,np.ones(x.size),statistic='sum',bins=np.arange(np.min(x),np.max(x),23.5*1000)) # bins--> every sec
+            bins = np.arange(x[0],x[-1],23.5*1000) # bins--> every sec
         else:
-            if bins[-1] < np.max(x): # If lumi data cannot cover all of BHM data, artifically extend it
+            if bins[-1] < x[-1]: # If lumi data cannot cover all of BHM data, artifically extend it
                 bins = bins[:] # Make a shallow copy if we need to modify the lumi_bins list because we need lumi_bins to be constant in plotting.py
-                bins.extend(np.arange(bins[-1] + 23500, np.max(x)+1, 23500)) # +1 to capture end point
-            if bins[0] > np.min(x): # If BHM data exists before lumi data, add artificial bins
-                early_bins = list(np.arange(np.min(x), bins[0], 23500))
+                bins.extend(np.arange(bins[-1] + 23500, x[-1]+1, 23500)) # +1 to capture end point
+            if bins[0] > x[0]: # If BHM data exists before lumi data, add artificial bins
+                early_bins = list(np.arange(x[0], bins[0], 23500))
                 bins = early_bins + bins # Add extra bins in beginning
 
-            y,binx,_ = stats.binned_statistic(x,np.ones(x.size),statistic='sum',bins=bins)
+        # x is sorted, so the events in a bin are the ones between the positions of its edges in x.
+        # Same binning as np.histogram, the last bin includes its right edge
+        binx = np.asarray(bins, dtype=np.float64)
+        edge_index = np.searchsorted(x, binx, side="left")
+        edge_index[-1] = np.searchsorted(x, binx[-1], side="right")
+        y = np.diff(edge_index)
         # if uHTR11:
         #     y,binx,_ = stats.binned_statistic(x,np.ones(x.size),statistic='sum',bins=np.arange(np.min(x),np.max(x),25000))
         # else:
@@ -790,9 +1162,9 @@ class bhm_analyser():
 
         # plotting.textbox(1.1,0.7,f"Run No:{run}")
         # x = binx[:-1] + (binx[1:]-binx[:-1])*0.5
-        x = [dt_conv.get_date_time(i) for i in binx[:-1]]
+        x = dt_conv.utc_ms_to_datetime64(binx[:-1])
 
-        # Cast float64 to int64 for use with by_lumi plots (y vals are already integers anyway)
+        # int64 for use with by_lumi plots
         y: np.ndarray = y.astype(np.int64) 
         return x,y,binx
     
@@ -818,14 +1190,14 @@ class bhm_analyser():
         #self.print_values() # debug
         
 
-        if len(self.run) == 0 and not commonVars.root: # make sure it doesn't analyse data that doesn't exist if there is no gui to display
+        if len(self) == 0 and not commonVars.root: # make sure it doesn't analyse data that doesn't exist if there is no gui to display
             return
             
         #plotting lego, ADC, and TDC plots
         if plot_lego:
             self.get_legoPlt()
 
-        if reAdjust and len(self.run) != 0:
+        if reAdjust and len(self) != 0:
             self.auto_align_adc_tdc()
 
         adc_binx = np.arange(min(120, min(calib.ADC_CUTS.values())), 181, 1)
@@ -839,7 +1211,7 @@ class bhm_analyser():
             detector_side='M'
 
         # combine all the plots into pdfs
-        if len(self.run) != 0:
+        if len(self) != 0:
             if save_fig:
                 # montage is a command line executable of ImageMagick, so if we are failing here, you may not have it installed
                 os.system(f"montage -density 300 -tile 2x0 -geometry +5+50 -border 10  {self.figure_folder}/adc_peaks/uHTR_{self.uHTR}_{detector_side}F*.png  {self.figure_folder}/adc_{detector_side}F.pdf")
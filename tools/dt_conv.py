@@ -2,7 +2,12 @@
 
 from datetime import datetime,timezone
 import datetime as dt
+import numpy as np
 import pytz
+
+# LHC length -> 26_659 m, speed of light -> 299_792_458 m/s.
+# Provides a much more accurate orbit time than 25ns per bx (of which there are 3564)
+ORBIT_MS = 26_659/299_792_458*1000 # milliseconds
 def tz_from_utc_ms_ts(utc_ms_ts, tz_info):
     """Given millisecond utc timestamp and a timezone return dateime
 
@@ -37,8 +42,25 @@ def tz_to_utc_ms(year, month, day, hour, minute, second):
     """
     return int(dt.datetime.timestamp(dt.datetime(year, month, day, hour, minute, second, tzinfo=pytz.timezone("UTC"))) * 1000)
 
+def utc_ms_to_datetime64(utc_ms):
+    """
+    Converts utc ms timestamps (a single one or an array of them) to np.datetime64[ms], all at once.
+    Matplotlib plots these directly, as UTC dates just like get_date_time()
+    """
+    return np.round(np.asarray(utc_ms, dtype=np.float64)).astype("datetime64[ms]")
+
+def orbit_to_utc_ms(orbit, start_time, reference_orbit):
+    """
+    Converts orbit numbers (a single one or an array of them) to utc ms timestamps (given a reference start time (utc ms) and orbit).
+    Orbits are cast to 64bit float first, uint64 orbits minus a python int would crash
+    """
+    return start_time+(np.asarray(orbit).astype(np.float64)-reference_orbit)*ORBIT_MS
+
 def utc_ms_to_orbit(utc_ms, start_time, reference_orbit):
     """
-    Converts a utc ms timestamp to an orbit number (given a reference start time (utc ms) and orbit)
+    Converts utc ms timestamps (a single one or an array of them) to orbit numbers (given a reference start time (utc ms) and orbit)
     """
-    return int((utc_ms - start_time)/(26_659/299_792_458*1000) + reference_orbit)
+    orbit = (np.asarray(utc_ms, dtype=np.float64) - start_time)/ORBIT_MS + reference_orbit
+    if orbit.ndim == 0:
+        return int(orbit)
+    return orbit.astype(np.int64)
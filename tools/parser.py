@@ -1,5 +1,12 @@
 # Written by Rohith Saradhy rohithsaradhy@gmail.com and Zachariah Eberle zachariaheberle@gmail.com
 import numpy as np
+import json
+import lzma
+import os
+import zlib
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
 
 class CorruptionError(Exception):
     """
@@ -16,280 +23,1072 @@ def convert_int(x,extract_pos=False): # splits a single string to int
     else:
         return [int(i) for i in list(filter(None,x.split(" ")))]
 
-def parse_text_file(file_name, start_event=0, stop_event=-1): #expects a certain type of data, proceed with caution
+CHUNK_SIZE = 1 << 20 # Number of bytes read from a uHTR.txt file at a time (1 MiB keeps the working arrays in cache)
+
+EventBatch = namedtuple("EventBatch", ["evt", "ch", "ampl", "tdc", "tdc2", "bx", "orbit", "run"])
+EventBatch.__doc__ = """
+A batch of consecutive events, each field holds the same numpy array you would get from parse_text_file()/parse_bin_file()
+"""
+
+BATCH_SIZE = 1 << 20 # Default number of events handed out at a time by iter_events()
+
+MAX_DIGITS = 19 # Longest integer token we convert, anything longer can't be safely held in a uint64
+
+def str_to_int(buf, starts, ends):
     """
-    Function to unpack the uHTR.txt data files
-    returns numpy arrays of TDC, AMPL, CH, BX, ORBIT, RUN
-    """
-    EVT = bytearray() # Event number, may or may not be useful to keep track of
-    TDC = bytearray()  # Time of the pulse in the 40 MHz clock. 0 to 25 ns in steps of 0.5 ns.
-    TDC2 = bytearray() # if the threhold was crossed prior to recording
-    BX = bytearray()   #  Bunch crossing is ranges from zero to 3564.
-    AMPL = bytearray() # Pulse height of signal.
-    CH = bytearray()   # channel number 1 to 20
-    ORBIT = bytearray()  # Orbit counter which tells you where in the fill (run?) the event occured.
-    RUN_NO = bytearray() # Number of the data collection run.
-
-    line_num = 1
-    with open(file_name, "r") as fp:
-        for line in fp: # reads lines individually
-            if "\x00" in line:
-                raise CorruptionError(f"Failed to parse line {line_num} in {file_name}\nNULL (0x00) character found!")
-            if ("---------------------------------------------------------------------------" in line):
-                line_num += 1
+    Vectorized version of int() for many byte ranges [starts, ends) of buf at once.
+    Returns the integer values (as uint64) along with a truth array of which ranges
+    were valid unsigned integers
+    """
+    lengths = ends - starts
+    valid = (lengths > 0) & (lengths <= MAX_DIGITS)
+
+    values = np.zeros(len(starts), dtype=np.uint64)
+
+    for i in range(int(np.max(lengths, where=valid, initial=0))): # Consume one digit column at a time
+        active = valid & (lengths > i)
+        digit = buf[np.where(active, starts + i, 0)] - np.uint8(ord("0")) # wraps around for anything below "0"
+        valid &= ~active | (digit <= 9)
+        values = np.where(active, values * np.uint64(10) + digit, values)
+
+    return values, valid
+
+SEPERATOR = b"-" * 75 # Lines containing this are seperators
+
+def last_event_start(data):
+    """
+    Byte offset of the last "--- START" line in data that directly follows a seperator line, 0 if there is none.
+    The line after a seperator always starts a new event header or (ADC, TDC) pair, so data can be split there
+    """
+    end = len(data)
+    while True:
+        start = data.rfind(b"\n", 0, max(data.rfind(b"--- START", 0, end), 0)) + 1
+        if start == 0 or SEPERATOR in data[data.rfind(b"\n", 0, start - 1) + 1:start]:
+            return start
+        end = start
+
+def read_text_chunks(file_name, chunk_size=CHUNK_SIZE, offset=0, line_num=1):
+    """
+    Reads a uHTR.txt file in large byte chunks, starting at byte offset (which is line number line_num).
+    Every chunk is cut right before the last "--- START" line in it that follows a seperator line (see last_event_start()),
+    so an event is never split between two chunks, and the last chunk always starts at the last such line of the file.
+    Yields the chunk along with the line number of its first line
+    """
+    with open(file_name, "rb") as fp:
+        fp.seek(offset)
+        carry = b""
+        while True:
+            block = fp.read(chunk_size)
+            data = carry + block
+
+            if not block: # EOF, whatever is left over is the last chunk
+                if data:
+                    yield data if data.endswith(b"\n") else data + b"\n", line_num
+                return
+
+            cut = last_event_start(data)
+            if cut == 0: # No complete event in here yet, keep reading
+                carry = data
                 continue
-            if ("--- START" in line): #parse the event information
-                evt_stat = list(filter(None, line.split(" ")))
-                #print(evt_stat) #debugging
-                # collect evt information
-                try:
-                    evt_bytes = (int(evt_stat[3][:-1])).to_bytes(4, "big")
-                    bx_bytes = (int(evt_stat[5][:-1])).to_bytes(2, "big")
-                    orbit_bytes = (int(evt_stat[7][:-1])).to_bytes(8, "big")
-                    run_bytes = (int(evt_stat[9].rstrip(","))).to_bytes(4, "big")
-                    fp.readline() # skips a line
-                    line_num += 2
-                except (IndexError, ValueError):
-                    if fp.readline() == "":
-                        line_num += 2
-                        continue
-                    else:
-                        print(f"Failed to parse line {line_num} in {file_name}")
-                        line_num += 1
-    #           print(evt_no,bx_no,orbit_no,run_no) #debugging
-            else:
-                try:
-                    adc_line = line
-                    tdc_line = fp.readline() # read the next line in sequence for tdc values
-                    line_num += 1
-                    if len(tdc_line.strip()) > 0: #if TDC triggered
-                        tdc = convert_int(tdc_line[:-1])
-                        if len(tdc) <=2:
-                            tdc_bytes = tdc[0].to_bytes(1, "big")
-                            if len(tdc) == 2:
-                                tdc2_bytes = tdc[1].to_bytes(1, "big", signed=True)
-                            elif len(tdc) == 1:
-                                tdc2_bytes = (-1).to_bytes(1, "big", signed=True)
-                            else:
-                                tdc2_bytes = (-1).to_bytes(1, "big", signed=True)
-                                
-                                
-                            data = convert_int(adc_line[:-1])
-                            ampl_bytes = bytes(data[2:][:20])
-                            ch_bytes = bytes(data[:2])
-
-                            EVT.extend(evt_bytes)
-                            TDC.extend(tdc_bytes)
-                            TDC2.extend(tdc2_bytes)
-                            BX.extend(bx_bytes)
-                            AMPL.extend(ampl_bytes)
-                            CH.extend(ch_bytes)
-                            ORBIT.extend(orbit_bytes)
-                            RUN_NO.extend(run_bytes)
 
-                except:
-                    print (f"Failed for evt:{int.from_bytes(evt_bytes, 'big')} ",line[:-1])
-                finally:
-                    line_num += 1
+            yield data[:cut], line_num
+            line_num += int(np.count_nonzero(np.frombuffer(data, dtype=np.uint8, count=cut) == ord("\n"))) # a lot faster than bytes.count()
+            carry = data[cut:]
+
+def parse_header_line(line):
+    """
+    Reads "--- START EVENT: #, BX: #, ORBIT: #, RUN: #" one field at a time like the line by line parser always did.
+    Returns the values of the fields up to the first one that can't be read
+    """
+    tokens = list(filter(None, line.split(" ")))
+    values = []
+    try:
+        for index, bits in ((3, 32), (5, 16), (7, 64), (9, 32)):
+            value = int(tokens[index].rstrip(",") if index == 9 else tokens[index][:-1])
+            if not 0 <= value < 2**bits:
+                break
+            values.append(value)
+    except (IndexError, ValueError):
+        pass
+    return values
+
+def parse_pair_lines(adc_line, tdc_line):
+    """
+    Reads an (ADC line, TDC line) pair the way the line by line parser always did.
+    Returns None if the TDC didn't trigger (or has too many values), the (ch, ampl, tdc, tdc2) values otherwise.
+    Raises ValueError/IndexError/OverflowError for pairs that can't be read
+    """
+    if len(tdc_line.strip()) == 0: # if TDC triggered
+        return None
+    tdc = convert_int(tdc_line[:-1])
+    if len(tdc) > 2:
+        return None
+    tdc2 = tdc[1] if len(tdc) == 2 else -1
+    tdc[0].to_bytes(1, "big")
+    tdc2.to_bytes(1, "big", signed=True)
+    data = convert_int(adc_line[:-1])
+    if len(data) < 22:
+        raise IndexError("ADC line is too short")
+    return bytes(data[:2]), bytes(data[2:22]), tdc[0], tdc2
+
+HEADER_LITERALS = (b"--- START EVENT: ", b", BX: ", b", ORBIT: ", b", RUN: ") # Text around the 4 fields of a header line
+
+HEADER_DIGITS = 15 # Longest header field parse_clean_chunk() reads, float64 holds up to 15 digits exactly
+
+def gather_windows(data, starts, width):
+    """
+    Same as data[starts[:, None] + np.arange(width)] for a 1D array, but every window is copied as a whole,
+    which is a lot cheaper than gathering the items one by one
+    """
+    windows = np.ndarray((max(len(data) - width + 1, 0),), dtype=f"V{width * data.itemsize}", buffer=data, strides=data.strides)
+    return windows[starts].view(data.dtype).reshape(-1, width)
+
+def parse_clean_chunk(chunk, header=None):
+    """
+    Fast path of parse_text_chunk() for chunks that are laid out exactly the way the uHTR writes them:
+    seperators, "--- START EVENT: #, BX: #, ORBIT: #, RUN: #" headers each followed by a seperator, and
+    (ADC, TDC) pairs of lines that only hold digits and spaces, with no value longer than 3 digits.
+
+    Only the ends of digit runs and lines are located, and every value is built from the few bytes in front of its end.
+    Byte counts prove there is nothing else in the chunk, so the result is the same as parse_text_chunk()'s.
+    Returns None if the chunk is laid out any other way (or the pairs before the first header have no header to use)
+    """
+    size = len(chunk)
+    if size < 2 or chunk[-1] != ord("\n") or chunk[0] == ord("\n") or ord("0") <= chunk[0] <= ord("9"):
+        return None
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+    zero = np.uint8(ord("0"))
+    is_digit = (buf ^ zero) < 10
+
+    # Every token (and line) ends at a marked byte + 1, the last newline isn't marked
+    mark = np.greater(is_digit[1:-1], is_digit[2:])
+    mark |= buf[1:-1] == ord("\n")
+    end = np.flatnonzero(mark)
+
+    # Values of up to 2 digits, 3 digit values are fixed below
+    last = buf[1:][end] ^ zero
+    second = buf[end] ^ zero
+    two_digits = second < 10
+    np.multiply(second, np.uint8(10), out=second)
+    second *= two_digits
+    second += last
+    values = np.zeros(len(end) + 1, dtype=np.uint16) # spare room for the window of a TDC line with one value
+    values[:-1] = second
+
+    newline = np.append(np.flatnonzero(last == ord("\n") ^ ord("0")), len(end))
+    num_lines = len(newline)
+    first_tok = np.empty(num_lines, dtype=np.int64)
+    first_tok[0] = 0
+    first_tok[1:] = newline[:-1] + 1
+    num_tok = newline - first_tok
+    line_end = np.empty(num_lines, dtype=np.int64)
+    line_end[:-1] = end[newline[:-1]] + 1
+    line_end[-1] = size - 1
+    line_start = np.empty(num_lines, dtype=np.int64)
+    line_start[0] = 0
+    line_start[1:] = line_end[:-1] + 1
+
+    is_dash = buf[line_start] == ord("-")
+    is_sep = line_end - line_start == len(SEPERATOR)
+    is_sep &= is_dash
+    is_header = is_dash ^ is_sep
+    sep_lines = np.flatnonzero(is_sep)
+    header_lines = np.flatnonzero(is_header)
+
+    # Seperators are all dashes and header lines are checked below, past those only digits, spaces and newlines are allowed
+    if not np.all(gather_windows(buf, line_start[sep_lines], len(SEPERATOR)) == ord("-")):
+        return None
+    other = size - np.count_nonzero(is_digit) - np.count_nonzero(buf == ord(" ")) - num_lines - len(SEPERATOR) * len(sep_lines)
+    if other != sum(len(text) - text.count(b" ") for text in HEADER_LITERALS) * len(header_lines):
+        return None
+
+    # Every header is followed by a seperator, and the other lines come in (ADC, TDC) pairs of consecutive lines
+    if len(header_lines) > 0 and (header_lines[-1] == num_lines - 1 or not np.all(is_sep[header_lines + 1])):
+        return None
+    adc_lines = np.flatnonzero(~is_dash)
+    if len(adc_lines) % 2 != 0:
+        return None
+    tdc_lines = adc_lines[1::2]
+    adc_lines = adc_lines[0::2]
+    if not np.all(tdc_lines - adc_lines == 1):
+        return None
+
+    # Headers, the 4 digit runs in them are the fields and the text around them has to match
+    if not np.all(num_tok[header_lines] == 4):
+        return None
+    field_tok = first_tok[header_lines]
+    field_end = np.empty((4, len(header_lines)), dtype=np.int64) # last digit of every field
+    text_start = np.empty((4, len(header_lines)), dtype=np.int64)
+    text_start[0] = line_start[header_lines]
+    for i, text in enumerate(HEADER_LITERALS):
+        field_end[i] = end[field_tok + i] + 1
+        if i < 3:
+            text_start[i + 1] = field_end[i] + 1
+        if not np.all(gather_windows(buf, text_start[i], len(text)) == np.frombuffer(text, dtype=np.uint8)):
+            return None
+    field_start = text_start + np.array([len(text) for text in HEADER_LITERALS])[:, None]
+    if not (np.all(is_digit[field_start]) and np.all(buf[field_end[3] + 1] == ord("\n"))):
+        return None
+    field_len = field_end - field_start + 1
+
+    fields = np.empty((4, len(header_lines) + 1))
+    if len(header_lines) > 0:
+        max_len = np.max(field_len, axis=1)
+        if np.any(max_len > HEADER_DIGITS):
+            return None
+        for i in range(4):
+            width = int(max_len[i])
+            digits = gather_windows(buf, field_end[i] - (width - 1), width) ^ zero
+            digits = digits * (np.arange(1 - width, 1) > -field_len[i, :, None]) # bytes in front of shorter fields
+            fields[i, 1:] = digits @ 10.0 ** np.arange(width - 1, -1, -1)
+        if np.any(fields[:, 1:] > np.array([2**32-1, 2**16-1, 2**64-1, 2**32-1], dtype=np.float64)[:, None]):
+            return None
+
+    # Pairs whose TDC triggered, the header in effect is row 0 (the previous chunk's) or the last header line above them
+    num_tdc = num_tok[tdc_lines]
+    pairs = np.flatnonzero(num_tdc)
+    adc_lines, tdc_lines, num_tdc = adc_lines[pairs], tdc_lines[pairs], num_tdc[pairs]
+    if not (np.all(num_tok[adc_lines] == 22) and np.all(num_tdc <= 2)):
+        return None
+    header_index = np.cumsum(is_header)[adc_lines]
+    if header is None or None in header:
+        if len(header_index) > 0 and header_index[0] == 0:
+            return None
+        fields[:, 0] = 0
+    else:
+        fields[:, 0] = header
+
+    # The third digit of 3 digit values, values with more digits get pushed out of range
+    long_tok = np.flatnonzero(two_digits)
+    before = end[long_tok] - 1
+    third = buf[before] ^ zero
+    three_digits = np.flatnonzero(third < 10)
+    long_tok = long_tok[three_digits]
+    values[long_tok] += third[three_digits] * np.uint16(100)
+    before = before[three_digits] - 1
+    values[long_tok[np.flatnonzero((buf[before] ^ zero) < 10)]] = 1000
+
+    adc = gather_windows(values, first_tok[adc_lines], 22)
+    tdc = gather_windows(values, first_tok[tdc_lines], 2)
+    if np.any(adc > 255) or np.any(tdc[:, 0] > 255) or np.any(tdc[:, 1] * (num_tdc == 2) > 127):
+        return None
+
+    evt_info = fields[:, header_index]
+
+    uint16 = np.dtype(np.uint16).newbyteorder(">") # Force byte order for multi-byte values
+    uint32 = np.dtype(np.uint32).newbyteorder(">")
+    uint64 = np.dtype(np.uint64).newbyteorder(">")
+
+    evt   = evt_info[0].astype(uint32)
+    ch    = adc[:, :2].astype(np.uint8)
+    ampl  = adc[:, 2:].astype(np.uint8)
+    tdc2  = tdc[:, 1].astype(np.int8)
+    tdc2[num_tdc == 1] = -1 # -1 if tdc line length = 1
+    tdc   = tdc[:, 0].astype(np.uint8)
+    bx    = evt_info[1].astype(uint16)
+    orbit = evt_info[2].astype(np.uint64).astype(uint64)
+    run   = evt_info[3].astype(uint32)
+
+    if len(header_lines) > 0:
+        header = tuple(int(value) for value in fields[:, -1])
+
+    return (evt, ch, ampl, tdc, tdc2, bx, orbit, run), header
+
+def parse_text_chunk(chunk, file_name, line_num=1, header=None):
+    """
+    Tokenizes a chunk of a uHTR.txt file (made up of complete lines) all at once with numpy.
 
-    array_len = len(TDC) # Since TDC values are 1 byte long, bytearray length will match total array lengths for all values
+    The file is made up of "--- START" event header lines, each followed by a skipped line, and pairs of
+    ADC lines (2 channel values + 20 amplitudes) and TDC lines (tdc and an optional tdc_2 flag). Lines made of
+    dashes are seperators and are ignored. Just like the line by line parser, every line that isn't a seperator
+    uses up the line after it as well, so lines are paired up starting at the line after every seperator.
+
+    Lines in the expected format are read in bulk, anything else (bad values, extra tokens, control characters...)
+    falls back to parse_header_line()/parse_pair_lines(), so failures are handled the same way as they always were.
+
+    header holds the (evt, bx, orbit, run) values in effect at the end of a previous chunk (None for fields no header
+    has set yet), since the fields of an unreadable header line keep their old values from the first field that can't
+    be read. Returns the parsed arrays and the new header
+
+    Chunks laid out exactly the way the uHTR writes them are read by parse_clean_chunk() instead, which is a lot faster
+    """
+    parsed = parse_clean_chunk(chunk, header)
+    if parsed is not None:
+        return parsed
+
+    buf = np.frombuffer(chunk, dtype=np.uint8)
+
+    newlines = np.flatnonzero(buf == ord("\n"))
+    num_lines = len(newlines)
+    line_start = np.empty(num_lines + 1, dtype=np.int64)
+    line_start[0] = 0
+    line_start[1:] = newlines + 1
+
+    def line_text(line):
+        """
+        Text of a line including its newline, as the line by line parser saw it
+        """
+        text = chunk[line_start[line]:line_start[line + 1]].decode(errors="replace")
+        return text[:-2] + "\n" if text.endswith("\r\n") else text
+
+    # Control characters (other than line endings) aren't whitespace to int(), those lines take the slow path
+    odd = np.zeros(num_lines + 1, dtype=bool)
+    if np.count_nonzero(buf < ord(" ")) != num_lines:
+        control = np.flatnonzero((buf < ord(" ")) & (buf != ord("\n")))
+        control = control[(buf[control] != ord("\r")) | (buf[control + 1] != ord("\n"))]
+        odd[np.searchsorted(newlines, control)] = True
+
+    # Runs of dashes, seperator lines have one at least 75 long and header lines have "--- START"
+    dash = np.empty(len(buf) + 1, dtype=bool)
+    dash[0] = False
+    np.equal(buf, ord("-"), out=dash[1:])
+    dash_bounds = np.flatnonzero(dash[:-1] != dash[1:])
+    dash_start = dash_bounds[0::2]
+    dash_end = dash_bounds[1::2]
+    dash_len = dash_end - dash_start
+
+    is_dash = np.zeros(num_lines, dtype=bool)
+    is_dash[np.searchsorted(newlines, dash_start[dash_len >= 75])] = True
+
+    start = dash_end[dash_len >= 3]
+    start = start[start + 6 < len(buf)]
+    for i, char in enumerate(b" START"):
+        start = start[buf[start + i] == char]
+    is_header = np.zeros(num_lines, dtype=bool)
+    is_header[np.searchsorted(newlines, start)] = True
+    is_header &= ~is_dash
+
+    # Every line that isn't a seperator uses up the next line too, so only every other line after a seperator is read
+    lines = np.arange(num_lines)
+    block_start = np.zeros(num_lines, dtype=np.int64)
+    np.maximum.accumulate(np.where(is_dash[:-1], lines[1:], 0), out=block_start[1:])
+    is_read = (lines - block_start) % 2 == 0
+
+    nul = np.flatnonzero(is_read & odd[:-1])
+    nul = nul[[b"\x00" in chunk[line_start[line]:line_start[line + 1]] for line in nul]]
+    if len(nul) > 0: # Nothing after the corrupted line gets parsed
+        nul_line = nul[0]
+        is_read[nul_line:] = False
+
+    # Token boundaries are wherever we switch between whitespace and non-whitespace. Every ASCII control character
+    # is treated as whitespace, the chunk always ends on a newline so tokens come in (start, end) pairs
+    ws = np.empty(len(buf) + 1, dtype=bool)
+    ws[0] = True
+    np.less_equal(buf, ord(" "), out=ws[1:])
+    bounds = np.flatnonzero(ws[:-1] != ws[1:])
+
+    first_tok = np.searchsorted(bounds, line_start) // 2 # first token of every line, a line never starts inside a token
+    num_tok = np.diff(first_tok, append=first_tok[-1]) # 0 for the (missing) line after the last one
+
+    def small_values(tok):
+        """
+        Values of tokens up to 3 digits long (every ADC/TDC value), built from the last three bytes of each token.
+        Bytes in front of shorter tokens are masked out by their length. Returns the values and which tokens were valid
+        """
+        ends = bounds[2 * tok + 1]
+        lengths = ends - bounds[2 * tok]
+        zero = np.uint8(ord("0"))
+        d2 = buf[ends - 1] - zero # wraps around for anything below "0"
+        d1 = buf[ends - 2] - zero
+        d0 = buf[ends - 3] - zero
+        two_digits = lengths >= 2
+        three_digits = lengths >= 3
+        values = d2 + d1 * two_digits * np.uint16(10) + d0 * three_digits * np.uint16(100)
+        return values, (lengths <= 3) & (d2 <= 9) & ((d1 <= 9) | ~two_digits) & ((d0 <= 9) | ~three_digits)
+
+    messages = [] # (line, message) of every line that couldn't be parsed, printed in order at the end
+
+    # collect evt information, "--- START EVENT: #, BX: #, ORBIT: #, RUN: #"
+    header_lines = np.flatnonzero(is_read & is_header)
+    fast = ~odd[header_lines] & (num_tok[header_lines] >= 10)
+    field_tok = first_tok[header_lines[fast]][:, None] + np.array([3, 5, 7, 9])
+    field_end = bounds[2 * field_tok + 1]
+    field_end[:, :3] -= 1 # Trailing character is dropped from the first three values
+    field_end[:, 3] -= (buf[field_end[:, 3] - 1] == ord(",")) & (buf[field_end[:, 3]] == ord(" ")) # Run number may have a trailing comma
+    fields = np.zeros((len(header_lines), 4), dtype=np.uint64)
+    fields[fast], fields_ok = (array.reshape(-1, 4) for array in str_to_int(buf, bounds[2 * field_tok].ravel(), field_end.ravel()))
+    fast[fast] = np.all(fields_ok & (fields[fast] <= np.array([2**32-1, 2**16-1, 2**64-1, 2**32-1], dtype=np.uint64)), axis=1)
+
+    num_fields = np.full(len(header_lines), 4)
+    for i in np.flatnonzero(~fast):
+        values = parse_header_line(line_text(header_lines[i]))
+        fields[i, :len(values)] = values
+        num_fields[i] = len(values)
+        if len(values) < 4 and header_lines[i] + 1 < num_lines: # the last line of the file fails silently
+            messages.append((header_lines[i], (f"Failed to parse line {line_num + header_lines[i]} in {file_name}",)))
+
+    # Every field keeps the value of the last header that got to it, the previous chunk's values are row 0
+    if header is None:
+        header = (None,) * 4
+    fields = np.vstack(([value or 0 for value in header], fields)).astype(np.uint64)
+    has_field = np.vstack(([value is not None for value in header], num_fields[:, None] > np.arange(4)))
+    field_row = np.maximum.accumulate(np.where(has_field, np.arange(len(fields))[:, None], 0), axis=0)
+    fields = np.take_along_axis(fields, field_row, axis=0)
+    has_field = np.take_along_axis(has_field, field_row, axis=0)
+
+    # Everything else is read in (ADC line, TDC line) pairs
+    adc_lines = np.flatnonzero(is_read & ~is_dash & ~is_header)
+    tdc_lines = adc_lines + 1
+    num_tdc = num_tok[tdc_lines]
+    pairs = (num_tdc > 0) | odd[tdc_lines] # if TDC triggered, or the slow path needs to check
+    adc_lines, tdc_lines, num_tdc = adc_lines[pairs], tdc_lines[pairs], num_tdc[pairs]
+
+    header_index = np.searchsorted(header_lines, adc_lines) # row of fields that holds each pair's header
+    has_header = np.all(has_field[header_index], axis=1)
+
+    fast = ~odd[adc_lines] & ~odd[tdc_lines] & (num_tok[adc_lines] == 22) & (num_tdc <= 2) & has_header
+    fast_index = np.flatnonzero(fast)
+
+    adc = np.zeros((len(adc_lines), 22), dtype=np.uint16)
+    adc[fast_index], adc_ok = small_values(first_tok[adc_lines[fast_index]][:, None] + np.arange(22))
+    fast[fast_index] = np.all(adc_ok & (adc[fast_index] <= 255), axis=1)
+
+    tdc = np.zeros((len(adc_lines), 2), dtype=np.int16)
+    tdc_tok = first_tok[tdc_lines[fast_index]]
+    tdc_tok = np.stack((tdc_tok, tdc_tok + (num_tdc[fast_index] == 2)), axis=1) # second TDC value only if it's there
+    tdc_values, tdc_ok = small_values(tdc_tok)
+    tdc[fast_index] = tdc_values
+    tdc[fast_index[num_tdc[fast_index] == 1], 1] = -1 # -1 if tdc line length = 1
+    fast[fast_index] &= np.all(tdc_ok, axis=1) & (tdc_values[:, 0] <= 255) & ((tdc_tok[:, 0] == tdc_tok[:, 1]) | (tdc_values[:, 1] <= 127))
+
+    valid = fast.copy()
+    for i in np.flatnonzero(~fast):
+        try:
+            values = parse_pair_lines(line_text(adc_lines[i]), line_text(tdc_lines[i]) if tdc_lines[i] < num_lines else "")
+            if values is not None and not has_header[i]:
+                raise ValueError("No event header")
+        except (IndexError, ValueError, OverflowError):
+            evt = fields[header_index[i], 0] if has_field[header_index[i], 0] else None
+            messages.append((adc_lines[i], (f"Failed for evt:{evt} ", line_text(adc_lines[i])[:-1])))
+            continue
+        if values is not None:
+            adc[i, :2] = list(values[0])
+            adc[i, 2:] = list(values[1])
+            tdc[i] = values[2:]
+            valid[i] = True
+
+    for _, message in sorted(messages, key=lambda message: message[0]):
+        print(*message)
+
+    if len(nul) > 0:
+        raise CorruptionError(f"Failed to parse line {line_num + nul_line} in {file_name}\nNULL (0x00) character found!")
+
+    evt_info = fields[header_index[valid]]
 
     uint16 = np.dtype(np.uint16).newbyteorder(">") # Force byte order for multi-byte values
     uint32 = np.dtype(np.uint32).newbyteorder(">")
     uint64 = np.dtype(np.uint64).newbyteorder(">")
 
-    evt   = np.ndarray(shape=(array_len,),     dtype=uint32,    buffer=EVT,    order="C")
-    tdc   = np.ndarray(shape=(array_len,),     dtype=np.uint8,  buffer=TDC,    order="C")
-    tdc2  = np.ndarray(shape=(array_len,),     dtype=np.int8,   buffer=TDC2,   order="C")
-    bx    = np.ndarray(shape=(array_len,),     dtype=uint16,    buffer=BX,     order="C")
-    ampl  = np.ndarray(shape=(array_len, 20),  dtype=np.uint8,  buffer=AMPL,   order="C")
-    ch    = np.ndarray(shape=(array_len, 2),   dtype=np.uint8,  buffer=CH,     order="C")
-    orbit = np.ndarray(shape=(array_len,),     dtype=uint64,    buffer=ORBIT,  order="C")
-    run   = np.ndarray(shape=(array_len,),     dtype=uint32,    buffer=RUN_NO, order="C")
+    evt   = evt_info[:, 0].astype(uint32)
+    ch    = adc[valid, :2].astype(np.uint8)
+    ampl  = adc[valid, 2:].astype(np.uint8)
+    tdc2  = tdc[valid, 1].astype(np.int8)
+    tdc   = tdc[valid, 0].astype(np.uint8)
+    bx    = evt_info[:, 1].astype(uint16)
+    orbit = evt_info[:, 2].astype(uint64)
+    run   = evt_info[:, 3].astype(uint32)
+
+    header = tuple(int(value) if present else None for value, present in zip(fields[-1], has_field[-1]))
 
-    return evt, ch, ampl, tdc, tdc2, bx, orbit, run
+    return (evt, ch, ampl, tdc, tdc2, bx, orbit, run), header
 
-def txt_to_bin(file_name):
+def parse_text_file(file_name, start_event=0, stop_event=-1, chunk_size=CHUNK_SIZE): #expects a certain type of data, proceed with caution
+    """
+    Function to unpack the uHTR.txt data files
+    Reads the file in large chunks that are tokenized in bulk by parse_text_chunk()
+    returns numpy arrays of EVT, CH, AMPL, TDC, TDC2, BX, ORBIT, RUN
+    """
+    data, _ = parse_text_tail(file_name, chunk_size=chunk_size)
+
+    return data
+
+def parse_text_tail(file_name, resume=None, chunk_size=CHUNK_SIZE):
+    """
+    Same as parse_text_file(), but starts parsing at a TextResume point returned by an earlier call
+    (None starts from the beginning of the file), so only data added to the file since then is read.
+    Returns the arrays along with the TextResume point for the next call
+    """
+    if resume is None:
+        resume = TextResume(0, 1, 0, None)
+
+    columns = []
+    header = resume.header
+    offset = resume.offset
+    events = resume.events
+    next_resume = resume
+    for chunk, line_num in read_text_chunks(file_name, chunk_size, resume.offset, resume.line_num):
+        # The last event in the file may still be written to, so the next call starts over from its header line
+        next_resume = TextResume(offset, line_num, events, header)
+
+        data, header = parse_text_chunk(chunk, file_name, line_num, header)
+        columns.append(data)
+        offset += len(chunk)
+        events += len(data[0])
+
+    if not columns:
+        data, _ = parse_text_chunk(b"", file_name)
+        columns.append(data)
+
+    evt, ch, ampl, tdc, tdc2, bx, orbit, run = [np.concatenate(column, dtype=column[0].dtype) for column in zip(*columns)]
+
+    return (evt, ch, ampl, tdc, tdc2, bx, orbit, run), next_resume
+
+BIN_VERSION = 2 # .uhtr version written by txt_to_bin()
+
+BIN_COMPRESSED_VERSION = 3 # .uhtr version written by txt_to_bin() when compression is used
+
+BIN_ALIGNMENT = 64 # Byte alignment of every array in a version 2 .uhtr file
+
+BIN_BLOCK_SIZE = 1 << 16 # Number of events in every compressed block of a version 3 .uhtr file
+
+BIN_COMPRESSORS = { # compression name -> (compress, decompress), these all release the GIL so blocks are (de)compressed in threads
+    "zlib": (zlib.compress, zlib.decompress),
+    "lzma": (lzma.compress, lzma.decompress),
+}
+
+BIN_DELTA_COLUMNS = ["evt", "orbit"] # Columns that are stored as differences between consecutive events when compressed
+
+BinColumn = namedtuple("BinColumn", ["name", "dtype", "shape", "offset", "compression", "encoding", "block_size", "blocks"])
+BinColumn.__doc__ = """
+Where and how an array is stored in a .uhtr file. offset is the absolute position of an uncompressed array,
+blocks is a list of (absolute position, number of bytes) of every compressed block of a compressed array
+"""
+
+TextResume = namedtuple("TextResume", ["offset", "line_num", "events", "header"])
+TextResume.__doc__ = """
+Where parse_text_tail() left off in a uHTR.txt file: byte offset and line number of the last event header line,
+the number of events parsed before it and the (evt, bx, orbit, run) header values in effect there (None for fields
+no event header has set yet), see parse_text_chunk()
+"""
+
+BinHeader = namedtuple("BinHeader", ["version", "array_len", "columns", "run_index", "source"])
+BinHeader.__doc__ = """
+Everything read_bin_header() knows about a .uhtr file. run_index is a list of RunSegment and source is the TextResume
+point of the uHTR.txt file the file was converted from, both are None for files that don't have them
+"""
+
+RunSegment = namedtuple("RunSegment", ["run", "start", "stop", "orbit_min", "orbit_max"])
+RunSegment.__doc__ = """
+A stretch of consecutive events [start, stop) of a single run in a .uhtr file, along with the smallest
+and largest orbit number found in it. See build_run_index()
+"""
+
+def txt_to_bin(file_name, compression=None, update=None):
     """
     Converts the uHTR.txt format into a much more compact binary format
     that can be read much faster. Saved as uHTR4.uhtr/uHTR11.uhtr
+    See write_bin_file() for the file structure
 
-    Binary Format: Big Endian -> MSB ... LSB
+    The .uhtr file remembers how far into the text file it got, so if the text file is still
+    being written to (during fills), converting it again only parses what was added since the last
+    conversion and appends it to the events that are already in the .uhtr file (see parse_text_update()).
+    update can be the result of an earlier parse_text_update() call, so the text file isn't parsed again.
+    Returns numpy arrays of EVT, CH, AMPL, TDC, TDC2, BX, ORBIT, RUN of the whole file
+    """
+    new_file_name = file_name[:-3] + "uhtr"
 
-    How values are stored (values are unsigned unless stated otherwise):
-        version number -> 8 bits / 1 byte (This is in the event that the file format changes)
-        total number of events -> 32 bits / 4 bytes
-        evt_no -> 32 bits / 4 bytes
-        bx_no -> 16 bits / 2 bytes
-        orbit_no -> 64 bits / 8 bytes
-        run_no -> 32 bits / 4 bytes
-        ch -> 16 bits / 2 bytes
-            One byte for each value in ch
-        ampl -> 20*8 bits / 20 bytes
-        tdc -> 8 bits / 1 byte
-        tdc_2 -> 8 bits / 1 byte
-            tdc_2 values are SIGNED
-            example: tdc = [5] -> b'11111111' (tdc_2 = -1 if tdc line length = 1)
-            example 2: tdc = [52, 62] -> b'00111110'
+    data, source = update or parse_text_update(file_name)
+
+    temp_file_name = new_file_name + ".tmp"
+    write_bin_file(temp_file_name, *data, compression=compression, source=source)
+    os.replace(temp_file_name, new_file_name)
+
+    return data
+
+def parse_text_update(file_name):
+    """
+    Parses a uHTR.txt file that may have been converted before, only the part of it that the .uhtr file
+    doesn't hold yet is parsed, the rest is read from the .uhtr file.
+    Returns numpy arrays of EVT, CH, AMPL, TDC, TDC2, BX, ORBIT, RUN of the whole file
+    along with the TextResume point to store in the new .uhtr file
+    """
+    def find_resume():
+        """
+        Returns the TextResume point of a previous conversion, or None if the text file has to be converted from scratch
+        """
+        try:
+            with open(bin_file_name, "rb") as fp:
+                resume = read_bin_header(fp).source
+        except (OSError, ValueError, IndexError): # No .uhtr file yet, or one we can't read
+            return None
+
+        if resume is None:
+            return None
+
+        with open(file_name, "rb") as fp: # Make sure this is still the same text file and not a new one with the same name
+            fp.seek(resume.offset)
+            line = fp.readline()
+        if resume.offset > 0 and b"--- START" not in line:
+            return None
+
+        return resume
+
+    bin_file_name = file_name[:-3] + "uhtr"
+
+    resume = find_resume()
+    data, next_resume = parse_text_tail(file_name, resume)
+
+    if resume is not None and resume.events > 0:
+        old_data = parse_bin_file(bin_file_name, memmap=True, events=(0, resume.events))
+        data = tuple(np.concatenate((old, new), dtype=old.dtype) for old, new in zip(old_data, data))
+        del old_data # Close the memory map before the file gets replaced
+
+    return data, next_resume
+
+def build_run_index(run, orbit):
+    """
+    Splits the events into stretches of consecutive events that belong to the same run.
+    Runs are written one after another, so this is usually one RunSegment per run,
+    but a run that shows up more than once gets a segment for every time it does.
+    Returns a list of RunSegment
+    """
+    if len(run) == 0:
+        return []
+
+    bounds = np.flatnonzero(run[1:] != run[:-1]) + 1
+    starts = np.concatenate(([0], bounds))
+    stops = np.concatenate((bounds, [len(run)]))
+    orbit_min = np.minimum.reduceat(orbit, starts)
+    orbit_max = np.maximum.reduceat(orbit, starts)
+
+    return [RunSegment(*map(int, segment)) for segment in zip(run[starts], starts, stops, orbit_min, orbit_max)]
+
+def write_bin_file(file_name, evt, ch, ampl, tdc, tdc2, bx, orbit, run, compression=None, block_size=BIN_BLOCK_SIZE, source=None):
+    """
+    Writes the uHTR arrays to a version 2 .uhtr file, or a version 3 .uhtr file if compression
+    ("zlib" or "lzma") is given.
+
+    Binary Format (version 2): Little Endian, every array starts on a 64 byte boundary
 
     How values are formatted:
-    
-        [version number][total number of events][evt_no array][tdc array][tdc_2 array][bx_no array]
-        [ampl array][ch array][orbit_no array][run_no array] -> all arrays are stored sequentially
-        right next to each other, as they have the same length.
+
+        [version number (1 byte)][header length (4 bytes)][header][padding][evt_no array][padding][ch array] ...
+
+        The header is a JSON object padded with spaces so that the arrays start on a 64 byte boundary:
+            {"n_events": total number of events,
+             "columns": [{"name": "evt", "dtype": "<u4", "shape": [], "offset": 0}, ...],
+             "runs": [[run, start, stop, orbit_min, orbit_max], ...]}
+        dtype is the numpy dtype string of an array, shape is the shape of a single event
+        and offset is the position of the array relative to the end of the header.
+        runs is the run index (see build_run_index()), it lets parse_bin_file() read single runs
+        without touching the rest of the file. Files written before it existed don't have it.
+        Files converted by txt_to_bin() also have a "source" entry, the TextResume point
+        [offset, line_num, events, header] of the text file, so the conversion can pick up where it left off.
+
+    Binary Format (version 3): Same as version 2, except every array is split into blocks of block_size
+    events which are compressed on their own, so any range of events can be read by only decompressing
+    the blocks holding it. evt_no and orbit_no are delta encoded within each block (first value, then the
+    differences between consecutive values). The header becomes:
+            {"n_events": total number of events, "compression": "zlib", "block_size": 65536,
+             "columns": [{"name": "evt", "dtype": "<u4", "shape": [], "encoding": "delta",
+                          "blocks": [[offset, number of bytes], ...]}, ...], "runs": [...]}
+
+    How values are stored (values are unsigned unless stated otherwise):
+        evt_no -> uint32
+        ch -> 2 x uint8
+        ampl -> 20 x uint8
+        tdc -> uint8
+        tdc_2 -> int8 (tdc_2 = -1 if tdc line length = 1)
+        bx_no -> uint16
+        orbit_no -> int64
+        run_no -> uint32
+
+    Version 1 files (big endian, no header, see read_bin_header()) can be converted with upgrade_bin_file()
     """
+    def align(offset):
+        return -(-offset // BIN_ALIGNMENT) * BIN_ALIGNMENT
 
-    VERSION = bytes([1])
+    def encode(name, array):
+        """
+        Splits an array into its compressed blocks
+        """
+        blocks = []
+        for start in range(0, len(array), block_size):
+            block = array[start:start+block_size]
+            if name in BIN_DELTA_COLUMNS:
+                block = np.concatenate((block[:1], np.diff(block))) # wraps around for unsigned values, undone by cumsum
+            blocks.append(block.tobytes())
+        return blocks
 
-    EVT = bytearray() # Event number, may or may not be useful to keep track of
-    TDC = bytearray()  # Time of the pulse in the 40 MHz clock. 0 to 25 ns in steps of 0.5 ns.
-    TDC2 = bytearray() # if the threhold was crossed prior to recording
-    BX = bytearray()   #  Bunch crossing is ranges from zero to 3564.
-    AMPL = bytearray() # Pulse height of signal.
-    CH = bytearray()   # channel number 1 to 20
-    ORBIT = bytearray()  # Orbit counter which tells you where in the fill (run?) the event occured.
-    RUN_NO = bytearray() # Number of the data collection run.
+    if compression is not None and compression not in BIN_COMPRESSORS:
+        raise ValueError(f"Unknown compression: \"{compression}\"")
 
-    new_file_name = file_name[:-3] + "uhtr"
-    line_num = 1
-    with open(file_name, "r") as fp:
-        for line in fp: # reads lines individually
-            if "\x00" in line:
-                raise CorruptionError(f"Failed to parse line {line_num} in {file_name}\nNULL (0x00) character found!")
-            if ("---------------------------------------------------------------------------" in line):
-                line_num += 1
-                continue
-            if ("--- START" in line): #parse the event information
-                evt_stat = list(filter(None, line.split(" ")))
-                #print(evt_stat) #debugging
-                # collect evt information
-                try:
-                    evt_bytes = (int(evt_stat[3][:-1])).to_bytes(4, "big")
-                    bx_bytes = (int(evt_stat[5][:-1])).to_bytes(2, "big")
-                    orbit_bytes = (int(evt_stat[7][:-1])).to_bytes(8, "big")
-                    run_bytes = (int(evt_stat[9].rstrip(","))).to_bytes(4, "big")
-                    fp.readline() # skips a line
-                    line_num += 2
-                except (IndexError, ValueError):
-                    if fp.readline() == "":
-                        line_num += 2
-                        continue
-                    else:
-                        print(f"Failed to parse line {line_num} in {file_name}")
-                        line_num += 1
-    #           print(evt_no,bx_no,orbit_no,run_no) #debugging
-            else:
-                try:
-                    adc_line = line
-                    tdc_line = fp.readline() # read the next line in sequence for tdc values
-                    line_num += 1
-                    if len(tdc_line.strip()) > 0: #if TDC triggered
-                        tdc = convert_int(tdc_line[:-1])
-                        if len(tdc) <=2:
-                            tdc_bytes = tdc[0].to_bytes(1, "big")
-                            if len(tdc) == 2:
-                                tdc2_bytes = tdc[1].to_bytes(1, "big", signed=True)
-                            elif len(tdc) == 1:
-                                tdc2_bytes = (-1).to_bytes(1, "big", signed=True)
-                            else:
-                                tdc2_bytes = (-1).to_bytes(1, "big", signed=True)
-                                
-                                
-                            data = convert_int(adc_line[:-1])
-                            ampl_bytes = bytes(data[2:][:20])
-                            ch_bytes = bytes(data[:2])
-
-                            EVT.extend(evt_bytes)
-                            TDC.extend(tdc_bytes)
-                            TDC2.extend(tdc2_bytes)
-                            BX.extend(bx_bytes)
-                            AMPL.extend(ampl_bytes)
-                            CH.extend(ch_bytes)
-                            ORBIT.extend(orbit_bytes)
-                            RUN_NO.extend(run_bytes)
+    dtypes = [np.dtype("<u4"), np.dtype("u1"), np.dtype("u1"), np.dtype("u1"), np.dtype("i1"), np.dtype("<u2"), np.dtype("<i8"), np.dtype("<u4")]
+    arrays = [np.ascontiguousarray(array, dtype=dtype) for array, dtype in zip((evt, ch, ampl, tdc, tdc2, bx, orbit, run), dtypes)]
 
-                except:
-                    print (f"Failed for evt:{int.from_bytes(evt_bytes, 'big')} ",line[:-1])
-                finally:
-                    line_num += 1
-
-
-    with open(new_file_name, "wb") as fp:
-        total_evts = len(TDC).to_bytes(4, "big") # Since TDC length is 1 bytes, its length represents all array lengths
-        buffer = VERSION + total_evts + bytes(EVT) + bytes(TDC) + bytes(TDC2)\
-              + bytes(BX) + bytes(AMPL) + bytes(CH) + bytes(ORBIT) + bytes(RUN_NO)
-        # The order in which these are saved is VERY important
-
-        # print(f"Event length: {len(EVT) // 4}") debug
-        # print(f"TDC length: {len(TDC)}")
-        # print(f"TDC2 length: {len(TDC2)}")
-        # print(f"BX length: {len(BX) // 2}")
-        # print(f"Ampl length: {len(AMPL) // 20}")
-        # print(f"Channel length: {len(CH)}")
-        # print(f"Orbit length: {len(ORBIT) // 8}")
-        # print(f"Run number: {len(RUN_NO) // 4}")
-
-        if (len(EVT) // 4) == (len(TDC)) == (len(TDC2)) == (len(BX) // 2) == (len(AMPL) // 20)\
-            == (len(CH) // 2) == (len(ORBIT) // 8) == (len(RUN_NO) // 4):
-            # Really ugly looking sanity check to ensure all arrays are the same length
-            fp.write(buffer)
-        else:
-            raise AssertionError("Array lengths do not match!")
+    columns = []
+    payloads = []
+    offset = 0
+    if compression is None:
+        version = BIN_VERSION
+        for name, array in zip(EventBatch._fields, arrays):
+            columns.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape[1:]), "offset": offset})
+            payloads.append([array.tobytes()])
+            offset = align(offset + array.nbytes)
+        header = {"n_events": len(arrays[0]), "columns": columns}
+
+    else:
+        version = BIN_COMPRESSED_VERSION
+        compress = BIN_COMPRESSORS[compression][0]
+        with ThreadPoolExecutor(max_workers=os.cpu_count() or 1) as pool:
+            for name, array in zip(EventBatch._fields, arrays):
+                blocks = list(pool.map(compress, encode(name, array)))
+                columns.append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape[1:]),
+                                "encoding": "delta" if name in BIN_DELTA_COLUMNS else None, "blocks": []})
+                for block in blocks:
+                    columns[-1]["blocks"].append([offset, len(block)])
+                    offset += len(block)
+                payloads.append(blocks)
+        header = {"n_events": len(arrays[0]), "compression": compression, "block_size": block_size, "columns": columns}
+
+    header["runs"] = [list(segment) for segment in build_run_index(arrays[7], arrays[6])]
+    if source is not None:
+        header["source"] = [source.offset, source.line_num, source.events,
+                            None if source.header is None else [None if value is None else int(value) for value in source.header]]
+    header = json.dumps(header).encode()
+    header += b" " * (align(5 + len(header)) - 5 - len(header))
 
-def parse_bin_file(file_name):
+    with open(file_name, "wb") as fp:
+        fp.write(bytes([version]) + len(header).to_bytes(4, "little") + header)
+        data_start = fp.tell()
+        for column, blocks in zip(columns, payloads):
+            if compression is None:
+                fp.write(b"\x00" * (data_start + column["offset"] - fp.tell()))
+            for block in blocks:
+                fp.write(block)
+
+def read_bin_header(fp):
     """
-    Parses through the custom .uhtr binary file format for the uHTR data.
-    See txt_to_bin() for documentation on the file structure of the
-    .uhtr file type.
-    Returns numpy arrays of TDC, TDC2, AMPL, CH, BX, ORBIT, and RUN
+    Reads the header of an open .uhtr file.
+    Returns a BinHeader with the version number, the number of events, a BinColumn for every array in the file,
+    the run index of the file and the TextResume point of the text file it was converted from
     """
     def v1():
         """
-        Parses version 1 of the .uhtr file format
-        """
-        def get_offsets(data_bytes):
-            """
-            Returns a list of the byte position of the start of all
-            arrays in the file
-            [4, 1, 1, 2, 20, 2, 8, 4] represents the order and byte length
-            of an individual element in their respective arrays
-            """
-            offset_list = [5]
-            bytes_read = 5
-            array_len = int.from_bytes(data_bytes[1:5], "big")
-            for byte_len in [4, 1, 1, 2, 20, 2, 8, 4]: # byte lengths of each array, order matters
-                offset_list.append(bytes_read + byte_len * array_len)
-                bytes_read += byte_len * array_len
-            return offset_list, array_len
-        
-        offset, array_len = get_offsets(file_data)
+        Version 1 of the .uhtr file format
 
-        uint16 = np.dtype(np.uint16).newbyteorder(">") # Force byte order for multi-byte values
-        uint32 = np.dtype(np.uint32).newbyteorder(">")
-        uint64 = np.dtype(np.uint64).newbyteorder(">")
-        
-        evt   = np.ndarray(shape=(array_len,),     dtype=uint32,    buffer=file_data[offset[0]:offset[1]],  order="C")
-        tdc   = np.ndarray(shape=(array_len,),     dtype=np.uint8,  buffer=file_data[offset[1]:offset[2]],  order="C")
-        tdc2  = np.ndarray(shape=(array_len,),     dtype=np.int8,   buffer=file_data[offset[2]:offset[3]],  order="C")
-        bx    = np.ndarray(shape=(array_len,),     dtype=uint16,    buffer=file_data[offset[3]:offset[4]],  order="C")
-        ampl  = np.ndarray(shape=(array_len, 20),  dtype=np.uint8,  buffer=file_data[offset[4]:offset[5]],  order="C")
-        ch    = np.ndarray(shape=(array_len, 2),   dtype=np.uint8,  buffer=file_data[offset[5]:offset[6]],  order="C")
-        orbit = np.ndarray(shape=(array_len,),     dtype=uint64,    buffer=file_data[offset[6]:offset[7]],  order="C")
-        run   = np.ndarray(shape=(array_len,),     dtype=uint32,    buffer=file_data[offset[7]:offset[8]],  order="C")
+        Binary Format: Big Endian -> MSB ... LSB
+
+        How values are stored (values are unsigned unless stated otherwise):
+            version number -> 8 bits / 1 byte (This is in the event that the file format changes)
+            total number of events -> 32 bits / 4 bytes
+            evt_no -> 32 bits / 4 bytes
+            bx_no -> 16 bits / 2 bytes
+            orbit_no -> 64 bits / 8 bytes
+            run_no -> 32 bits / 4 bytes
+            ch -> 16 bits / 2 bytes
+                One byte for each value in ch
+            ampl -> 20*8 bits / 20 bytes
+            tdc -> 8 bits / 1 byte
+            tdc_2 -> 8 bits / 1 byte
+                tdc_2 values are SIGNED
+                example: tdc = [5] -> b'11111111' (tdc_2 = -1 if tdc line length = 1)
+                example 2: tdc = [52, 62] -> b'00111110'
+
+        How values are formatted:
         
-        return evt, ch, ampl, tdc, tdc2, bx, orbit, run
+            [version number][total number of events][evt_no array][tdc array][tdc_2 array][bx_no array]
+            [ampl array][ch array][orbit_no array][run_no array] -> all arrays are stored sequentially
+            right next to each other, as they have the same length.
+        """
+        array_len = int.from_bytes(fp.read(4), "big")
 
-    with open(file_name, "rb") as fp:
-        file_data = fp.read()
-    
-    version = file_data[0]
+        # (name, dtype, shape) of every array, order matters
+        layout = [("evt", ">u4", ()), ("tdc", "u1", ()), ("tdc2", "i1", ()), ("bx", ">u2", ()),
+                  ("ampl", "u1", (20,)), ("ch", "u1", (2,)), ("orbit", ">u8", ()), ("run", ">u4", ())]
+
+        columns = []
+        offset = 5
+        for name, dtype, shape in layout:
+            dtype = np.dtype(dtype)
+            columns.append(BinColumn(name, dtype, shape, offset, None, None, None, None))
+            offset += dtype.itemsize * int(np.prod(shape)) * array_len
+        return array_len, columns, {}
+
+    def v2():
+        """
+        Version 2 of the .uhtr file format, see write_bin_file()
+        """
+        header_len = int.from_bytes(fp.read(4), "little")
+        header = json.loads(fp.read(header_len))
+        data_start = 5 + header_len
+        columns = [BinColumn(column["name"], np.dtype(column["dtype"]), tuple(column["shape"]), data_start + column["offset"],
+                             None, None, None, None) for column in header["columns"]]
+        return header["n_events"], columns, header
+
+    def v3():
+        """
+        Version 3 (block compressed) of the .uhtr file format, see write_bin_file()
+        """
+        header_len = int.from_bytes(fp.read(4), "little")
+        header = json.loads(fp.read(header_len))
+        data_start = 5 + header_len
+        columns = [BinColumn(column["name"], np.dtype(column["dtype"]), tuple(column["shape"]), None, header["compression"],
+                             column["encoding"], header["block_size"], [(data_start + offset, length) for offset, length in column["blocks"]])
+                   for column in header["columns"]]
+        return header["n_events"], columns, header
+
+    version = fp.read(1)[0]
 
     if version == 1:
-        evt, ch, ampl, tdc, tdc2, bx, orbit, run = v1()
+        array_len, columns, header = v1()
+    elif version == 2:
+        array_len, columns, header = v2()
+    elif version == 3:
+        array_len, columns, header = v3()
     else:
         raise ValueError(f"Version number {version} does not exist.")
 
-    return evt, ch, ampl, tdc, tdc2, bx, orbit, run
+    run_index = header.get("runs")
+    if run_index is not None:
+        run_index = [RunSegment(*segment) for segment in run_index]
+
+    source = header.get("source")
+    if source is not None:
+        source = TextResume(*source[:3], None if source[3] is None else tuple(source[3]))
+    
+    return BinHeader(version, array_len, columns, run_index, source)
+
+def read_bin_events(fp, columns, start, stop):
+    """
+    Reads events [start, stop) of every column (see read_bin_header()) from an open .uhtr file.
+    Only the compressed blocks holding those events are read, they are decompressed in parallel threads.
+    Returns a dictionary of column name -> numpy array
+    """
+    def decompress(job):
+        """
+        Decompresses a single block and copies the requested part of it into its array
+        """
+        column, block_num, payload, array = job
+        block = np.frombuffer(BIN_COMPRESSORS[column.compression][1](payload), dtype=column.dtype).reshape(-1, *column.shape)
+        if column.encoding == "delta":
+            block = np.cumsum(block, dtype=column.dtype)
+
+        block_start = block_num * column.block_size
+        lo, hi = max(start, block_start), min(stop, block_start + len(block))
+        array[lo-start:hi-start] = block[lo-block_start:hi-block_start]
+
+    arrays = {}
+    jobs = []
+    for column in columns:
+        if column.compression is None:
+            row_size = column.dtype.itemsize * int(np.prod(column.shape))
+            fp.seek(column.offset + row_size * start)
+            arrays[column.name] = np.frombuffer(fp.read(row_size * (stop - start)), dtype=column.dtype).reshape(stop - start, *column.shape)
+
+        else:
+            arrays[column.name] = np.empty((stop - start, *column.shape), dtype=column.dtype)
+            for block_num in range(start // column.block_size, -(-stop // column.block_size)):
+                offset, length = column.blocks[block_num]
+                fp.seek(offset)
+                jobs.append((column, block_num, fp.read(length), arrays[column.name]))
+
+    if len(jobs) > 0:
+        with ThreadPoolExecutor(max_workers=min(len(jobs), os.cpu_count() or 1)) as pool:
+            list(pool.map(decompress, jobs))
+
+    return arrays
+
+def parse_bin_file(file_name, memmap=False, events=None, runs=None, orbit_range=None):
+    """
+    Parses through the custom .uhtr binary file format for the uHTR data.
+    See write_bin_file() and read_bin_header() for documentation on the file structure 
+    of the .uhtr file type (versions 1, 2 and 3 are supported).
+
+    Arrays of uncompressed files are read-only views into the file data, nothing is copied.
+    With memmap=True the file is memory mapped instead of read in, so opening it
+    is nearly instant and pages are only loaded from disk once an array is touched.
+    events can be a (start, stop) range of events to read instead of the whole file, for compressed
+    files only the blocks holding those events are decompressed.
+
+    runs (a run number or a list of them) and orbit_range (inclusive (lower, upper) bounds on the orbit number
+    as stored in the file) only keep the matching events. The run index in the header is used to only read
+    the parts of the file holding those events, files without one have their run and orbit arrays read first.
+    Returns numpy arrays of EVT, CH, AMPL, TDC, TDC2, BX, ORBIT, and RUN
+    """
+    def select_events(run_index):
+        """
+        Finds the (start, stop) ranges of events in [start, stop) that can hold the selected runs and orbits
+        """
+        if isinstance(runs, (int, np.integer)):
+            selected_runs = {int(runs)}
+        elif runs is not None:
+            selected_runs = {int(run) for run in runs}
+
+        ranges = []
+        for segment in run_index:
+            if runs is not None and segment.run not in selected_runs:
+                continue
+            if orbit_range is not None and (segment.orbit_max < orbit_range[0] or segment.orbit_min > orbit_range[1]):
+                continue
+
+            lo, hi = max(start, segment.start), min(stop, segment.stop)
+            if lo >= hi:
+                continue
+            if len(ranges) > 0 and ranges[-1][1] == lo: # Merge with the previous range if they touch
+                ranges[-1] = (ranges[-1][0], hi)
+            else:
+                ranges.append((lo, hi))
+
+        return ranges if len(ranges) > 0 else [(start, start)]
+
+    selecting = runs is not None or orbit_range is not None
+
+    with open(file_name, "rb") as fp:
+        _, array_len, columns, run_index, _ = read_bin_header(fp)
+        start, stop, _ = slice(*(events or (None,))).indices(array_len)
+        stop = max(start, stop)
+        compressed = any(column.compression is not None for column in columns)
+
+        ranges = [(start, stop)]
+        if selecting:
+            if run_index is None: # Older files don't have a run index, so build one from the run and orbit arrays
+                index_arrays = read_bin_events(fp, [column for column in columns if column.name in ("run", "orbit")], 0, array_len)
+                run_index = build_run_index(index_arrays["run"], index_arrays["orbit"])
+            ranges = select_events(run_index)
+
+        if compressed or (not memmap and (events is not None or selecting)):
+            parts = [read_bin_events(fp, columns, lo, hi) for lo, hi in ranges]
+        elif not memmap:
+            fp.seek(0)
+            file_data = fp.read()
+
+    if not compressed and (memmap or (events is None and not selecting)):
+        if memmap:
+            file_data = np.memmap(file_name, dtype=np.uint8, mode="r") # The arrays keep the mapping open for as long as they exist
+
+        views = {column.name: np.ndarray(shape=(array_len, *column.shape), dtype=column.dtype, buffer=file_data, 
+                                         offset=column.offset, order="C") for column in columns}
+        parts = [{name: view[lo:hi] for name, view in views.items()} for lo, hi in ranges]
+
+    if len(parts) == 1:
+        arrays = parts[0]
+    else:
+        arrays = {name: np.concatenate([part[name] for part in parts], dtype=parts[0][name].dtype) for name in parts[0]}
+
+    if orbit_range is not None: # The run index only narrows things down to whole runs, so cut out the exact orbits
+        orbit_cut = (arrays["orbit"] >= orbit_range[0]) & (arrays["orbit"] <= orbit_range[1])
+        if not np.all(orbit_cut):
+            arrays = {name: array[orbit_cut] for name, array in arrays.items()}
+
+    return tuple(arrays[name] for name in EventBatch._fields)
+
+def upgrade_bin_file(file_name):
+    """
+    Rewrites a version 1 .uhtr file (big endian, unaligned) as a version 2 .uhtr file in place.
+    Returns True if the file was upgraded, False if it was already up to date
+    """
+    with open(file_name, "rb") as fp:
+        header = read_bin_header(fp)
+    
+    if header.version >= BIN_VERSION:
+        return False
+
+    temp_file_name = file_name + ".tmp"
+    write_bin_file(temp_file_name, *parse_bin_file(file_name), source=header.source)
+    os.replace(temp_file_name, file_name) # Only replace the old file once the new one is completely written
+
+    return True
+
+def parse_file_shared(file_name, data_type, columns=None):
+    """
+    Parses a single uHTR file inside of a worker process (see analysis_helpers.load_uHTR_data()). Every array is copied
+    into its own block of shared memory, so only the block names have to be sent back to the parent process.
+    data_type "convert" parses a uHTR.txt file once and also converts it to a .uhtr file (see txt_to_bin()),
+    the .uhtr file is written on a separate thread while the arrays are being copied.
+
+    columns are the names of the arrays to hand back (EventBatch fields), all of them by default. "peak_ampl" can be
+    asked for as well, it is the largest of the 20 amplitudes of every event. Asking for it instead of ampl saves
+    20 bytes per event, and with memory mapped .uhtr files ampl never has to be copied at all.
+    Returns a (shared memory name, dtype, shape) tuple for every column.
+    The parent process is responsible for unlinking the blocks once it is done with them
+    """
+    def share(arrays):
+        """
+        Copies every requested column into a new block of shared memory
+        """
+        arrays = EventBatch(*arrays)
+        blocks = []
+        for name in columns or EventBatch._fields:
+            if name == "peak_ampl":
+                array = arrays.ampl.max(axis=1, initial=0)
+            else:
+                array = getattr(arrays, name)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1)) # Empty blocks are not allowed
+            np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+            blocks.append((shm.name, array.dtype.str, array.shape))
+            shm.close()
+        return blocks
+
+    if data_type == "binary":
+        return share(parse_bin_file(file_name, memmap=True))
+    elif data_type == "text":
+        return share(parse_text_file(file_name))
+    elif data_type != "convert":
+        raise ValueError(f"Unknown data type: \"{data_type}\"")
+
+    update = parse_text_update(file_name)
+    with ThreadPoolExecutor(max_workers=1) as writer:
+        written = writer.submit(txt_to_bin, file_name, update=update)
+        blocks = share(update[0])
+
+        try:
+            written.result()
+        except Exception:
+            for name, _, _ in blocks: # Nobody is going to pick these up
+                shm = shared_memory.SharedMemory(name=name)
+                shm.close()
+                shm.unlink()
+            raise
+
+    return blocks
+
+def iter_events(file_name, batch_size=BATCH_SIZE):
+    """
+    Generator version of parse_text_file()/parse_bin_file(). Yields EventBatch records of at most batch_size events
+    (only the last batch may be shorter), so files larger than memory can be worked through a piece at a time.
+    .uhtr files are read straight from disk column by column, anything else is treated as a uHTR.txt file
+    """
+    def text_batches():
+        """
+        Parses the uHTR.txt file chunk by chunk and regroups the parsed events into batch_size pieces
+        """
+        pending = []
+        num_pending = 0
+        header = None
+        for chunk, line_num in read_text_chunks(file_name):
+            data, header = parse_text_chunk(chunk, file_name, line_num, header)
+            pending.append(data)
+            num_pending += len(data[0])
+
+            if num_pending >= batch_size:
+                columns = [np.concatenate(column, dtype=column[0].dtype) for column in zip(*pending)]
+                num_full = num_pending - num_pending % batch_size
+                for start in range(0, num_full, batch_size):
+                    yield EventBatch(*[column[start:start+batch_size] for column in columns])
+                pending = [[column[num_full:] for column in columns]]
+                num_pending -= num_full
+
+        if num_pending > 0:
+            yield EventBatch(*[np.concatenate(column, dtype=column[0].dtype) for column in zip(*pending)])
+
+    def bin_batches():
+        """
+        Reads batch_size slices of every array in the .uhtr file, see txt_to_bin() for the file layout
+        """
+        with open(file_name, "rb") as fp:
+            _, array_len, columns, _, _ = read_bin_header(fp)
+
+            for start in range(0, array_len, batch_size):
+                yield EventBatch(**read_bin_events(fp, columns, start, min(start + batch_size, array_len)))
+
+    if batch_size < 1:
+        raise ValueError(f"batch_size must be at least 1, got {batch_size}")
+
+    if file_name.endswith(".uhtr"):
+        yield from bin_batches()
+    else:
+        yield from text_batches()
 
     
 
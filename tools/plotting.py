@@ -1182,10 +1182,10 @@ def rate_plots(uHTR4: bhm_analyser, uHTR11: bhm_analyser, plot_regions: list[str
 
 
 
-    for uHTR in (uHTR4, uHTR11): # Make sure getattr() and query don't break if we don't have any data and thus never generated the uHTR dataframe
-        if len(uHTR.run) == 0:
-            # Fill attributes with (empty) placeholder dataframes
-            uHTR.df = uHTR.SR = uHTR.AR = uHTR.BR = uHTR.CP = pd.DataFrame(columns=("bx", "tdc", "tdc_2", "ch", "ch_name", "orbit", "run", "peak_ampl"))
+    for uHTR in (uHTR4, uHTR11): # Make sure get_region() and query don't break if we don't have any data and thus never generated the uHTR dataframe
+        if len(uHTR) == 0:
+            # Fill df with an (empty) placeholder dataframe
+            uHTR.df = pd.DataFrame(columns=("bx", "tdc", "tdc_2", "ch", "ch_name", "orbit", "run", "peak_ampl", "region"))
 
     if delivered_lumi is not None:
         delivered_lumi = np.asarray(delivered_lumi)
@@ -1193,20 +1193,14 @@ def rate_plots(uHTR4: bhm_analyser, uHTR11: bhm_analyser, plot_regions: list[str
     beam_status = np.asarray(beam_status)
 
     if lumi_bins is not None:
-        lumi_time = [dt_conv.get_date_time(utc_ms) for utc_ms in lumi_bins]
+        lumi_time = dt_conv.utc_ms_to_datetime64(lumi_bins)
     else:
         lumi_time = None
     
     region_df_list: list[tuple[pd.DataFrame, pd.DataFrame]] = []
 
-    for region in plot_regions:
-        if " & " in region:
-            regions = region.split(" & ")
-            uHTR4_df = pd.concat((getattr(uHTR4, regions[0]), getattr(uHTR4, regions[1])))
-            uHTR11_df = pd.concat((getattr(uHTR11, regions[0]), getattr(uHTR11, regions[1])))
-            region_df_list.append((uHTR4_df, uHTR11_df))
-        else:
-            region_df_list.append((getattr(uHTR4, region), getattr(uHTR11, region)))
+    for region in plot_regions: # Combined regions ("SR & AR") are every event that is in either of them
+        region_df_list.append((uHTR4.get_region(region), uHTR11.get_region(region)))
 
     for i, (region_name, region4, region11) in enumerate([(plot_regions[0], region_df_list[0][0], region_df_list[0][1]), 
                                                           (plot_regions[1], region_df_list[1][0], region_df_list[1][1])]):
@@ -1399,9 +1393,11 @@ def plot_lego_gui(uHTR, xbins, ybins, h):
     ax3d.set_ylim3d(bottom=0, top=180)
     
     
-def plot_adc_gui(ch, x, binx, binx_tick, adc_plt_tdc_width):
+def plot_adc_gui(ch, x, binx, binx_tick, adc_plt_tdc_width, weights=None):
     """
     Plots the ADC plots to the GUI (does not save to disk)
+    x are either the peak_ampl values of every event, or the adc values with their number of events as weights
+    (see bhm.HistogramCube)
     """
     try:
         # More complex ord mapping
@@ -1417,7 +1413,7 @@ def plot_adc_gui(ch, x, binx, binx_tick, adc_plt_tdc_width):
 
     textbox(0.6,0.8,f"CH:{ch} \n $|$TDC - {calib.TDC_PEAKS[ch]} $| <$ {adc_plt_tdc_width}", size=15, ax=ax)
 
-    if x is None or len(x) == 0:
+    if x is None or len(x) == 0 or (weights is not None and not np.any(weights)):
         ax.set_xlabel("ADC [a.u]")
         ax.set_xticks(binx_tick)
         ax.set_xticklabels(labels=binx_tick, rotation=45)
@@ -1428,16 +1424,18 @@ def plot_adc_gui(ch, x, binx, binx_tick, adc_plt_tdc_width):
         ax.set_xlim(binx[0]-margin, binx[-1]+margin+1)
         return
     
-    ax.hist(x,bins=binx+0.5, histtype="stepfilled")
+    ax.hist(x,bins=binx+0.5, weights=weights, histtype="stepfilled")
     ax.axvline(calib.ADC_CUTS[ch],color='r',linestyle='--')
     ax.set_xticks(binx_tick)
     ax.set_xticklabels(labels=binx_tick, rotation=45)
     ax.set_xlabel("ADC [a.u]")
     
 
-def plot_tdc_gui(ch, x, peak, delay=0):
+def plot_tdc_gui(ch, x, peak, delay=0, weights=None):
     """
     Plots the TDC plots to the GUI (does not save to disk)
+    x are either the tdc values of every event, or the tdc values with their number of events as weights
+    (see bhm.HistogramCube)
     """
     try:
         ax = commonVars.tdc_fig.axes[int(20*(80 - ord(ch[0]))/3 + 10*(78-ord(ch[1]))/8 + int(ch[2:]) - 1)]
@@ -1447,14 +1445,14 @@ def plot_tdc_gui(ch, x, peak, delay=0):
 
     textbox(0.5,.8,f'All BX, \n {ch} \n Ampl $>$ {calib.ADC_CUTS[ch]}',15, ax=ax) 
 
-    if x is None or len(x) == 0:
+    if x is None or len(x) == 0 or (weights is not None and not np.any(weights)):
         margin = ((50/10) - int(50/10))/2 + (50/10) // 2 # Cursed 5% margins
         # Margins have a -1 on the left rather than a +1 on the right.
         ax.set_xlim(-margin-1, 50+margin)
         ax.set_xlabel("TDC [a.u]")
         return
 
-    ax.hist(x, bins=np.arange(-0.5, 50, 1), histtype="step", color="r")
+    ax.hist(x, bins=np.arange(-0.5, 50, 1), weights=weights, histtype="step", color="r")
     ax.axvline(peak+delay,color='k',linestyle='--')
     ax.set_xlabel("TDC [a.u]")
 
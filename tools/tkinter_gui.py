@@ -11,6 +11,7 @@ import tools.commonVars as commonVars
 import tools.analysis_helpers as analysis_helpers
 import tools.hw_info as hw_info
 import tools.calibration as calib
+import tools.dt_conv as dt_conv
 from tools.parser import CorruptionError
 from tools.tkinter_tools import *
 import os
@@ -18,7 +19,6 @@ import matplotlib.pyplot as plt
 from matplotlib.figure import Figure
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import json
-import numpy as np
 import sys
 
 
@@ -274,27 +274,29 @@ def gui():
         a date/time entry in their settings panel
         """
 
-        min_orbit = min(min(uHTR4.orbit, default=float("inf")), min(uHTR11.orbit, default=float("inf")))
-        max_orbit = max(max(uHTR4.orbit, default=-float("inf")), max(uHTR11.orbit, default=-float("inf")))
+        # Time is increasing with orbit, so the orbit range of the run index is all we need (no per event times on the loaded data)
+        run_indices = [uHTR.run_index for uHTR in (uHTR4, uHTR11) if len(uHTR.run_index) > 0]
+        min_time = min((dt_conv.orbit_to_utc_ms(run_index.orbit_min.min(), start_time, commonVars.reference_orbit) for run_index in run_indices), default=float("inf"))
+        max_time = max((dt_conv.orbit_to_utc_ms(run_index.orbit_max.max(), start_time, commonVars.reference_orbit) for run_index in run_indices), default=-float("inf"))
 
         for toolbar in toolbar_list:
             
             if hasattr(toolbar, "start_time"):
                 if lumi_bins is not None:
-                    toolbar.start_time.set_time(min(min(lumi_bins), (min_orbit.astype(np.float64) - commonVars.reference_orbit)*(26_659/299_792_458*1000) + start_time))
-                    toolbar.end_time.set_time(max(max(lumi_bins), (max_orbit.astype(np.float64) - commonVars.reference_orbit)*(26_659/299_792_458*1000) + start_time))
+                    toolbar.start_time.set_time(min(min(lumi_bins), min_time))
+                    toolbar.end_time.set_time(max(max(lumi_bins), max_time))
                 else:
                     toolbar.start_time.set_time(0)
-                    toolbar.end_time.set_time((max_orbit-min_orbit)*(26_659/299_792_458*1000))
+                    toolbar.end_time.set_time(max_time-min_time)
 
             elif hasattr(toolbar, "start_time1"):
                 for plot_index in (1, 2):
                     if lumi_bins is not None:
-                        getattr(toolbar, f"start_time{plot_index}").set_time(min(min(lumi_bins), (min_orbit.astype(np.float64) - commonVars.reference_orbit)*(26_659/299_792_458*1000) + start_time))
-                        getattr(toolbar, f"end_time{plot_index}").set_time(max(max(lumi_bins), (max_orbit.astype(np.float64) - commonVars.reference_orbit)*(26_659/299_792_458*1000) + start_time))
+                        getattr(toolbar, f"start_time{plot_index}").set_time(min(min(lumi_bins), min_time))
+                        getattr(toolbar, f"end_time{plot_index}").set_time(max(max(lumi_bins), max_time))
                     else:
                         getattr(toolbar, f"start_time{plot_index}").set_time(0)
-                        getattr(toolbar, f"end_time{plot_index}").set_time((max_orbit-min_orbit)*(26_659/299_792_458*1000))
+                        getattr(toolbar, f"end_time{plot_index}").set_time(max_time-min_time)
 
     #@@@@@@@@@@@@@@@@@ BEGIN TKINTER SETUP @@@@@@@@@@@@@@@@@@@@
 
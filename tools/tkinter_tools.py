@@ -511,24 +511,19 @@ class PlotToolbar(NavigationToolbar2Tk):
         that we can use as a cut on our data.
         """
         if cut_type == "numpy": # Returns a numpy truth array
-            theCut = np.ones(shape=(len(uHTR.run),), dtype=bool)
+            theCut = np.ones(shape=(len(uHTR),), dtype=bool)
 
             if len(theCut) == 0:
                 return theCut
 
             if hasattr(self, "start_time"):
-                theCut = (theCut) & (uHTR.orbit >= dt_conv.utc_ms_to_orbit(self.start_utc, commonVars.start_time_utc_ms, commonVars.reference_orbit)) &\
-                    (uHTR.orbit <= dt_conv.utc_ms_to_orbit(self.end_utc, commonVars.start_time_utc_ms, commonVars.reference_orbit))
+                theCut = theCut & uHTR.get_time_window(self.start_utc, self.end_utc)
                 
 
             if hasattr(self, "channel_select"):
-                chCut = np.zeros(shape=(len(uHTR.run),), dtype=bool)
-                for ch_name, ch in self.draw_channels.items():
-                    if uHTR.uHTR == "4" and "P" in ch_name:
-                        chCut = chCut | (uHTR.ch_mapped == ch)
-                    elif uHTR.uHTR == "11" and "M" in ch_name:
-                        chCut = chCut | (uHTR.ch_mapped == ch)
-                theCut = theCut & chCut
+                channels = [ch for ch_name, ch in self.draw_channels.items()
+                            if (uHTR.uHTR == "4" and "P" in ch_name) or (uHTR.uHTR == "11" and "M" in ch_name)]
+                theCut = theCut & uHTR.get_channel_groups().get_mask(channels)
 
             if hasattr(self, "region_select"):
                 
@@ -536,15 +531,15 @@ class PlotToolbar(NavigationToolbar2Tk):
                     theCut = theCut & uHTR.df.eval(self.region_select.query_string).to_numpy()
 
                 else:
-                    regionCut = np.zeros(shape=(len(uHTR.run),), dtype=bool)
+                    regionCut = np.zeros(shape=(len(uHTR),), dtype=bool)
                     if self.region_settings["Signal Region"]:
-                        regionCut = regionCut | uHTR.df.index.isin(uHTR.SR.index)
+                        regionCut = regionCut | uHTR.get_region_mask("SR")
 
                     if self.region_settings["Activation Region"]:
-                        regionCut = regionCut | uHTR.df.index.isin(uHTR.AR.index)
+                        regionCut = regionCut | uHTR.get_region_mask("AR")
 
                     if self.region_settings["Collision Products"]:
-                        regionCut = regionCut | uHTR.df.index.isin(uHTR.CP.index)
+                        regionCut = regionCut | uHTR.get_region_mask("CP")
                     theCut = theCut & regionCut
 
 
@@ -552,7 +547,7 @@ class PlotToolbar(NavigationToolbar2Tk):
 
             theCut = ""
 
-            if len(uHTR.run) == 0:
+            if len(uHTR) == 0:
                 return theCut
             
             if hasattr(self, "start_time"):
@@ -580,23 +575,17 @@ class PlotToolbar(NavigationToolbar2Tk):
                 if self.region_settings["Custom Region"]:
                     theCut = f"{theCut} & {self.region_select.query_string}"
                 else:
-                    regionCut = ""
+                    regions = []
                     if self.region_settings["Signal Region"]:
-                        regionCut = f"index.isin(@uHTR.SR.index)"
+                        regions.append("SR")
 
                     if self.region_settings["Activation Region"]:
-                        if regionCut == "":
-                            regionCut = "index.isin(@uHTR.AR.index)"
-                        else:
-                            regionCut = f"{regionCut} | index.isin(@uHTR.AR.index)"
+                        regions.append("AR")
 
                     if self.region_settings["Collision Products"]:
-                        if regionCut == "":
-                            regionCut = "index.isin(@uHTR.CP.index)"
-                        else:
-                            regionCut = f"{regionCut} | index.isin(@uHTR.CP.index)"
-                    if regionCut != "":
-                        theCut = f"{theCut} & ({regionCut})"
+                        regions.append("CP")
+                    if len(regions) > 0:
+                        theCut = f"{theCut} & ({uHTR.get_region_query(' & '.join(regions))})"
                     else:
                         return "run == -1" # If the user for some reason chooses options in such a way as to plot absolutely nothing
                         # return a query that guarentees A) Nothing breaks and B) We plot nothing
@@ -608,18 +597,16 @@ class LegoToolbar(PlotToolbar):
 
     def draw_plot(self, uHTR, theCut):
 
-        if len(uHTR.run) == 0:
+        if len(uHTR) == 0:
             plotting.plot_lego_gui(uHTR.uHTR, None, None, None)
             return
         
-        xdata = uHTR.tdc[theCut]
-        ydata = uHTR.peak_ampl[theCut]
-
-        if len(xdata) == 0:
+        if not np.any(theCut):
             plotting.plot_lego_gui(uHTR.uHTR, None, None, None)
             return
 
-        h, xbins, ybins = np.histogram2d(xdata,ydata, bins=(np.arange(-0.5,50,1),np.arange(0,180,1)))
+        histograms = uHTR.get_histograms(theCut)
+        h, xbins, ybins = histograms.histogram2d(histograms.get_counts(), np.arange(-0.5,50,1), np.arange(0,180,1))
         plotting.plot_lego_gui(uHTR.uHTR, xbins, ybins, h)
     
     @staticmethod
@@ -636,22 +623,25 @@ class ADCToolbar(PlotToolbar):
 
         binx = np.arange(min(120, min(calib.ADC_CUTS.values())), 181, 1)
         binx_tick = np.arange(min(120, min(calib.ADC_CUTS.values())//5*5), 181, 5)
+
+        if len(uHTR) != 0:
+            histograms = uHTR.get_histograms(theCut) # Every channel's histogram comes out of this
         
         for ch in uHTR.CMAP.keys():
 
-            if len(uHTR.run) == 0:
+            if len(uHTR) == 0:
                 plotting.plot_adc_gui(ch, None, binx, binx_tick, uHTR.adc_plt_tdc_width)
                 continue
         
-            chCut = theCut & (np.abs(uHTR.tdc-calib.TDC_PEAKS[ch]) < uHTR.adc_plt_tdc_width) & (uHTR.ch_mapped == uHTR.CMAP[ch])
-            x = uHTR.peak_ampl[chCut]
+            tdc_cut = np.abs(histograms.tdc_values-calib.TDC_PEAKS[ch]) < uHTR.adc_plt_tdc_width
+            x_counts = histograms.get_counts(uHTR.CMAP[ch])[tdc_cut].sum(axis=0)
             
 
-            if len(x) == 0:
+            if not np.any(x_counts):
                 plotting.plot_adc_gui(ch, None, binx, binx_tick, uHTR.adc_plt_tdc_width)
                 continue
 
-            plotting.plot_adc_gui(ch, x, binx, binx_tick, uHTR.adc_plt_tdc_width)
+            plotting.plot_adc_gui(ch, histograms.adc_values, binx, binx_tick, uHTR.adc_plt_tdc_width, weights=x_counts)
     
     @staticmethod
     def _mouse_event_to_message(event):
@@ -670,22 +660,25 @@ class TDCToolbar(PlotToolbar):
 
     def draw_plot(self, uHTR, theCut):
         delay = 0 # This is currently hardcoded as 0 in analysis, leaving it here in case that changes
+
+        if len(uHTR) != 0:
+            histograms = uHTR.get_histograms(theCut) # Every channel's histogram comes out of this
+
         for ch in uHTR.CMAP.keys():
 
-            if len(uHTR.run) == 0:
+            if len(uHTR) == 0:
                 plotting.plot_tdc_gui(ch, None, None)
                 continue
 
-            chCut = theCut & (uHTR.peak_ampl > calib.ADC_CUTS[ch]) & (uHTR.ch_mapped == uHTR.CMAP[ch])
-            x = uHTR.tdc[chCut]
-            counts, _ = np.histogram(x, bins=np.arange(-.5,50,1))
+            x_counts = histograms.get_counts(uHTR.CMAP[ch])[:, histograms.adc_values > calib.ADC_CUTS[ch]].sum(axis=1)
+            counts, _ = histograms.histogram(histograms.tdc_values, x_counts, bins=np.arange(-.5,50,1))
             peak = np.argmax(counts[delay:])
 
-            if len(x) == 0:
+            if not np.any(x_counts):
                 plotting.plot_tdc_gui(ch, None, None)
                 continue
 
-            plotting.plot_tdc_gui(ch, x, peak, delay)
+            plotting.plot_tdc_gui(ch, histograms.tdc_values, peak, delay, weights=x_counts)
     
     @staticmethod
     def _mouse_event_to_message(event):
@@ -703,52 +696,11 @@ class TDCStabilityToolbar(PlotToolbar):
     
     def draw_plot(self, uHTR, theCut):
 
-        if len(uHTR.run) == 0:
-            plotting.plot_tdc_stability_gui(uHTR.uHTR, None, None, None, None, None)
-            return
-
-        t_df = []
-        _mean = []
-        _mode = []
-        _std_dev = []
-        for ch in uHTR.CMAP.keys():
-            ch_num = uHTR.CMAP[ch]
-            sr = uHTR.df[theCut & (uHTR.df["ch"].values == ch_num) & (uHTR.df["peak_ampl"].values >= calib.ADC_CUTS[ch]) &\
-                        (uHTR.df["tdc"].values >= (calib.TDC_PEAKS[ch]-5)) & (uHTR.df["tdc"].values < (calib.TDC_PEAKS[ch]+5))]
-            if sr.empty:
-                # Changed from appending 0 to NaN so no data point is drawn
-                _mean.append(float("NaN"))
-                _mode.append(float("NaN"))
-                _std_dev.append(float("NaN"))
-                # Adds a filler line to sr so that when graphing violin plots, the x labels properly line up when dealing with empty data
-                # Passing NaN ensures no other calculations using t_df are changed
-                filler_data = {col_name : [float("NaN")] if col_name != "ch_name" else [ch] for col_name in ("bx", "tdc", "tdc_2", "ch", "ch_name", "orbit", "run", "peak_ampl")}
-                sr = pd.DataFrame(data=filler_data)
-            else:
-                _mean.append(sr.tdc.mean())
-                _mode.append(sr.tdc.mode()[0])
-                _std_dev.append(sr.tdc.std())
-
-            t_df.append(sr)
-
-
-        t_df = pd.concat(t_df)
-
-        if t_df.empty:
+        if len(uHTR) == 0:
             plotting.plot_tdc_stability_gui(uHTR.uHTR, None, None, None, None, None)
             return
 
-        try:
-            _mode_val = t_df.tdc.mode()[0]
-        except KeyError: # If we get a KeyError, this means the data is empty
-            _mode_val = None
-            _sig = None
-
-        else:
-            if len(t_df.tdc) == 1: # ensure std() doesn't break due to only one entry existing
-                _sig = 0
-            else:
-                _sig = t_df.tdc.std()
+        t_df, _mean, _mode, _std_dev, _mode_val, _sig = uHTR.get_tdc_stability(theCut)
 
         plotting.plot_tdc_stability_gui(uHTR.uHTR, t_df, _mode, _mode_val, _std_dev, _sig)
     
@@ -776,14 +728,12 @@ class OccupancyToolbar(PlotToolbar):
     
     def draw_plot(self, uHTR, theCut):
 
-        if len(uHTR.run) == 0:
+        if len(uHTR) == 0:
             plotting.plot_occupancy_gui(uHTR.uHTR, None, None)
             return
 
-        # engine python is required for this query to not crash due to trying to cast uint64 (orbit value) to int64
-        # which pandas does not like apparently
-        BR_bx = uHTR.BR.query(theCut, engine="python")["bx"]
-        SR_bx = uHTR.SR.query(theCut, engine="python")["bx"]
+        BR_bx = uHTR.get_region("BR").query(theCut)["bx"]
+        SR_bx = uHTR.get_region("SR").query(theCut)["bx"]
 
         if BR_bx.empty and SR_bx.empty:
             plotting.plot_occupancy_gui(uHTR.uHTR, None, None)
@@ -1119,19 +1069,20 @@ class RateToolbarBase(PlotToolbar):
         plot_index = 0
         for ax in self.figure.axes:
             lines_and_labels = zip(*ax.get_legend_handles_labels())
-            xlim = ax.get_xlim()
+            # The lines are np.datetime64 arrays (see dt_conv.utc_ms_to_datetime64()), so the limits get turned into dates instead
+            xlim = [np.datetime64(dates.num2date(lim).replace(tzinfo=None), "ms") for lim in ax.get_xlim()]
 
             for line, label in lines_and_labels:
                 if "+Z" in label or "-Z" in label:
-                    x = dates.date2num(line.get_xdata())
+                    x = line.get_xdata()
                     timeCut = (x >= xlim[0]) & (x <= xlim[1])
                     bin_lens = commonVars.bhm_bins[line.get_url()][timeCut] # length of each bin in the rate plots, used for calculating total elapsed time
                                                                             # units in ms
-                    time_elapsed = sum(bin_lens) # milliseconds
-                    total_counts = sum(line.get_ydata()[timeCut])
-                    try:
+                    time_elapsed = bin_lens.sum() # milliseconds
+                    total_counts = line.get_ydata()[timeCut].sum()
+                    if time_elapsed > 0:
                         average_counts = total_counts / time_elapsed
-                    except ZeroDivisionError:
+                    else:
                         average_counts = float("NaN")
                     # label = plotting.inverse_tex_escape(label)
 
@@ -1203,16 +1154,14 @@ class ChannelEventsToolbar(PlotToolbar):
     
     def draw_plot(self, uHTR, theCut):
         
-        if len(uHTR.run) == 0:
+        if len(uHTR) == 0:
             plotting.plot_channel_events_gui(uHTR.uHTR, None, None, None)
             return
 
         channels = [ch for ch in uHTR.CMAP.keys()]
 
-        # engine python is required for this query to not crash due to trying to cast uint64 (orbit value) to int64
-        # which pandas does not like apparently
-        SR_events = uHTR.SR.query(theCut, engine="python")["ch"].value_counts(sort=False)#.to_numpy()
-        # BR_events = uHTR.BR.query(theCut, engine="python")["ch"].value_counts(sort=False)#.to_numpy()
+        SR_events = uHTR.get_region("SR").query(theCut)["ch"].value_counts(sort=False)#.to_numpy()
+        # BR_events = uHTR.get_region("BR").query(theCut)["ch"].value_counts(sort=False)#.to_numpy()
 
         for ch in uHTR.CMAP.values(): # Pad pd.Series with zeros to ensure proper plotting
             if ch not in SR_events: